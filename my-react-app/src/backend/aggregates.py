@@ -0,0 +1,176 @@
+"""Running totals behind /api/stats.
+
+The totals live in a single record of the ``aggregates`` collection and are
+adjusted inside every transaction that writes sales or expenses, so reading
+them never touches the raw history. Per-day buckets (keyed by the
+``createdAt`` date) cover the daily and weekly figures. Sales and expenses
+moved to the archive by partition retention stay counted.
+
+To recompute the totals from the raw data, or only check them, for every
+shop or one (``--tenant``)::
+
+    python aggregates.py rebuild
+    python aggregates.py verify --tenant 2
+"""
+import argparse
+import sys
+from datetime import date, timedelta
+
+AGGREGATES = 'aggregates'
+AGGREGATES_ID = 1
+
+
+def empty():
+    return {
+        'id': AGGREGATES_ID,
+        'totalSales': 0,
+        'totalCOGS': 0,
+        'totalExpenses': 0,
+        'salesCount': 0,
+        'expenseCount': 0,
+        'days': {}
+    }
+
+
+def _day(agg, record):
+    return agg['days'].setdefault((record.get('createdAt') or '')[:10], {'sales': 0, 'cogs': 0, 'count': 0, 'expenses': 0})
+
+
+def apply_sale(agg, sale, sign=1):
+    day = _day(agg, sale)
+    agg['totalSales'] += sign * sale.get('total', 0)
+    agg['totalCOGS'] += sign * sale.get('cogs', 0)
+    agg['salesCount'] += sign
+    day['sales'] += sign * sale.get('total', 0)
+    day['cogs'] += sign * sale.get('cogs', 0)
+    day['count'] += sign
+
+
+def apply_expense(agg, expense, sign=1):
+    agg['totalExpenses'] += sign * expense.get('amount', 0)
+    agg['expenseCount'] += sign
+    _day(agg, expense)['expenses'] += sign * expense.get('amount', 0)
+
+
+APPLY = {'sales': apply_sale, 'expenses': apply_expense}
+
+
+def rebuild(sales, expenses):
+    agg = empty()
+    for sale in sales:
+        apply_sale(agg, sale)
+    for expense in expenses:
+        apply_expense(agg, expense)
+    return agg
+
+
+def rebuild_from(txn):
+    """Totals over everything the store holds, archived partitions included."""
+    return rebuild(txn.load('sales') + txn.store.load_archived('sales'),
+                   txn.load('expenses') + txn.store.load_archived('expenses'))
+
+
+def on_commit(txn):
+    """Store hook: fold this transaction's sales and expense writes into the totals."""
+    touched = [name for name in APPLY if name in txn.changes]
+    if not touched:
+        return
+    if any(txn.changes[name].replaced is not None for name in touched):
+        txn.replace(AGGREGATES, [rebuild_from(txn)])
+        return
+
+    current = txn.get(AGGREGATES, AGGREGATES_ID)
+    agg = {**current, 'days': {k: dict(v) for k, v in current['days'].items()}} if current else empty()
+    for name in touched:
+        apply, changes = APPLY[name], txn.changes[name]
+        for id, record in changes.updated.items():
+            apply(agg, txn.old(name, id), -1)
+            apply(agg, record)
+        for id in changes.deleted:
+            apply(agg, txn.old(name, id), -1)
+        for record in changes.inserted:
+            apply(agg, record)
+    if current:
+        txn.update(AGGREGATES, AGGREGATES_ID, agg)
+    else:
+        txn.insert(AGGREGATES, agg)
+
+
+def install(store):
+    """Register the hook and build the totals once if they don't exist yet."""
+    store.add_hook(on_commit)
+    if store.get(AGGREGATES, AGGREGATES_ID) is None:
+        with store.transaction() as txn:
+            if txn.get(AGGREGATES, AGGREGATES_ID) is None:
+                txn.replace(AGGREGATES, [rebuild_from(txn)])
+
+
+def summary(agg, today=None):
+    """Totals plus today's and this week's sales, as returned by /api/stats."""
+    today = today or date.today()
+    week_start = today - timedelta(days=today.weekday())
+    days = agg['days']
+    weekly_sales = sum(days.get((week_start + timedelta(days=i)).isoformat(), {}).get('sales', 0)
+                       for i in range((today - week_start).days + 1))
+    return {
+        'totalSales': agg['totalSales'],
+        'totalCOGS': agg['totalCOGS'],
+        'totalExpenses': agg['totalExpenses'],
+        'grossProfit': agg['totalSales'] - agg['totalCOGS'],
+        'netProfit': agg['totalSales'] - agg['totalCOGS'] - agg['totalExpenses'],
+        'salesCount': agg['salesCount'],
+        'dailySales': days.get(today.isoformat(), {}).get('sales', 0),
+        'weeklySales': weekly_sales
+    }
+
+
+def differences(stored, expected, path=''):
+    """Paths where two aggregate records disagree, allowing for float rounding."""
+    if isinstance(expected, dict) and isinstance(stored, dict):
+        found = []
+        for key in sorted(set(stored) | set(expected)):
+            # A day emptied by deletions still has a bucket of zeros
+            missing = {} if isinstance(stored.get(key, expected.get(key)), dict) else 0
+            found += differences(stored.get(key, missing), expected.get(key, missing), f'{path}.{key}' if path else key)
+        return found
+    if isinstance(expected, (int, float)) and isinstance(stored, (int, float)):
+        if abs(stored - expected) <= 1e-6 * max(1, abs(expected)):
+            return []
+    elif stored == expected:
+        return []
+    return [f'{path}: stored {stored!r}, expected {expected!r}']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain the /api/stats running totals')
+    parser.add_argument('command', choices=['rebuild', 'verify'])
+    parser.add_argument('--data-dir', default=None, help='Defaults to POS_DATA_DIR or src/backend/data')
+    parser.add_argument('--tenant', type=int, help='Id of the shop (defaults to every shop)')
+    args = parser.parse_args()
+
+    import tenants  # Imports this module, so not at the top
+    args.data_dir = args.data_dir or tenants.DATA_DIR
+    mismatched = False
+    for tenant_id in tenants.shop_ids(parser, args):
+        store = tenants.open_shop_storage(tenants.directory(args.data_dir, tenant_id), ())
+        # Only this hook: install() would first build missing totals, hiding them from verify
+        store.add_hook(on_commit)
+        with store.transaction() as txn:
+            expected = rebuild_from(txn)
+            found = differences(txn.get(AGGREGATES, AGGREGATES_ID) or empty(), expected)
+            for line in found:
+                print(f'Shop {tenant_id}: {line}')
+            if args.command == 'rebuild':
+                txn.replace(AGGREGATES, [expected])
+                print(f"Shop {tenant_id}: rebuilt totals from {expected['salesCount']} sales "
+                      f"and {expected['expenseCount']} expenses")
+            elif found:
+                mismatched = True
+            else:
+                print(f'Shop {tenant_id}: stored totals match the raw data')
+    if mismatched:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,126 +1,201 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
-import jwt
 import json
+import jwt
 import os
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from functools import wraps
+import aggregates
+import bom
+import compression
+import export
+import fifo
+import images
+import mailer
+import metrics
+import profiling
+import reminder_schedule
+import tenants
+from auth import TokenCache, issue_token
+from checkout import Checkout
+from listing import list_response
+from reports import GROUPS, parse_bound
+from storage import open_storage
 
 app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+metrics.install(app)  # First, so the time of the other response handlers is counted
+profiling.install(app)
+compression.install(app)
+CORS(app, resources={r"/api/*": {"origins": "*", "expose_headers": ["X-Next-Cursor", "ETag", profiling.HEADER]}})
 app.config['SECRET_KEY'] = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 
 
-DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
-os.makedirs(DATA_DIR, exist_ok=True)
-
-# Initialize empty data files if they don't exist
-data_files = {
-    'users.json': [],
-    'products.json': [],
-    'sales.json': [],
-    'expenses.json': [],
-    'reminders.json': [],
-    'service_fees.json': [],
-    'discounts.json': [],
-    'credit_requests.json': [],
-    'settings.json': [],
-    'batches.json': [],
-    'production.json': [],
-    'price_history.json': [],
-    'time_entries.json': [],
-    'categories.json': [],
-    'payments.json': [],
-    'emails.json': []
+DATA_DIR = tenants.DATA_DIR
+# Bearer token required to scrape /metrics; open when unset
+METRICS_TOKEN = os.environ.get('POS_METRICS_TOKEN', '')
+# Emails of the users allowed on /api/main-admin/*; nobody when unset
+MAIN_ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get('POS_MAIN_ADMIN_EMAILS', '').split(',') if email.strip()}
+if not MAIN_ADMIN_EMAILS:
+    print("Warning: POS_MAIN_ADMIN_EMAILS is not set, so nobody can use the main admin pages")
+app.config['PROFILE_DIR'] = os.environ.get('POS_PROFILE_DIR', os.path.join(DATA_DIR, 'profiles'))
+
+# Collections of the account store, shared by all shops; each shop's own are in tenants.COLLECTIONS
+COLLECTIONS = [
+    'users',
+    'tenants',
+    'payments',
+    'emails'
+]
+
+# Lookups kept indexed by the store, on top of the id index every collection gets
+INDEXES = {
+    'users': ['email', 'tenantId'],
+    'emails': ['status']
 }
 
-for filename, default_data in data_files.items():
-    file_path = os.path.join(DATA_DIR, filename)
-    if not os.path.exists(file_path):
-        with open(file_path, 'w') as f:
-            json.dump(default_data, f, indent=2)
-        print(f"Created {filename} with default data")
+accounts = open_storage(DATA_DIR, COLLECTIONS, INDEXES, only=COLLECTIONS)
+token_cache = TokenCache(accounts, app.config['SECRET_KEY'])
+outbox = mailer.Mailer(accounts)
+outbox.start()
+image_store = images.ImageStore(os.path.join(DATA_DIR, 'images'))
+shops = tenants.Tenants(accounts, DATA_DIR, image_store)
+tenants.migrate(shops, DATA_DIR)
+
+def _take_tenant():
+    """The shop this request holds (see token_required), unless it was handed back already."""
+    tenant = getattr(request, 'tenant', None)
+    if tenant is None or getattr(request, 'tenant_released', False):
+        return None
+    request.tenant_released = True
+    return tenant
+
+@app.after_request
+def release_tenant(response):
+    # Once the response is sent, as streamed ones (SSE, exports) read the shop's store until then
+    tenant = _take_tenant()
+    if tenant is not None:
+        response.call_on_close(lambda: shops.release(tenant))
+    return response
+
+@app.teardown_request
+def release_tenant_on_error(exc):
+    # Requests that failed before after_request
+    tenant = _take_tenant()
+    if tenant is not None:
+        shops.release(tenant)
 
 def load_json(filename):
-    path = os.path.join(DATA_DIR, filename)
-    if os.path.exists(path):
-        with open(path, 'r') as f:
-            return json.load(f)
-    return []
+    return request.tenant.store.load(filename[:-len('.json')])
 
 def save_json(filename, data):
-    path = os.path.join(DATA_DIR, filename)
-    with open(path, 'w') as f:
-        json.dump(data, f, indent=2)
+    request.tenant.store.save(filename[:-len('.json')], data)
+
+# EventSource can't send headers, so these endpoints also take ?access_token=
+QUERY_TOKEN_PATHS = {'/api/events'}
 
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         token = request.headers.get('Authorization')
+        if not token and request.path in QUERY_TOKEN_PATHS:
+            token = request.args.get('access_token')
         if not token:
             return jsonify({'error': 'Token is missing'}), 401
+        started = time.perf_counter()
         try:
             token = token.split(' ')[1] if ' ' in token else token
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            request.user = data
-        except:
+            # Token claims, plus the caller's user record (None if it was deleted)
+            request.user, request.current_user = token_cache.verify(token)
+        except jwt.InvalidTokenError:
             return jsonify({'error': 'Token is invalid'}), 401
+        finally:
+            metrics.JWT_VERIFY.observe(time.perf_counter() - started)
+        # The caller's shop, held until the response is sent; tokens issued before shops had ids
+        # carry none, so fall back to the user's
+        tenant_id = request.user.get('tenant') or (request.current_user or {}).get('tenantId')
+        request.tenant = shops.get(tenant_id)
+        if request.tenant is None:
+            return jsonify({'error': 'Token is invalid'}), 401
+        if request.user.get('role') == 'admin' and profiling.requested():
+            profiling.start()
         return f(*args, **kwargs)
     return decorated
 
+def main_admin_required(f):
+    """Goes under token_required. Checked against the caller's user record, not the token, so
+    dropping an email from POS_MAIN_ADMIN_EMAILS or locking the user takes effect at once."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user = request.current_user or {}
+        if user.get('locked') or user.get('email', '').lower() not in MAIN_ADMIN_EMAILS:
+            return jsonify({'error': 'Main admin access required'}), 403
+        return f(*args, **kwargs)
+    return decorated
 
 
 @app.route('/api/auth/signup', methods=['POST'])
 def signup():
     data = request.json
-    users = load_json('users.json')
     
-    if any(u['email'] == data['email'] for u in users):
+    if accounts.find('users', 'email', data['email']):
         return jsonify({'error': 'User already exists'}), 400
     
-    # First user is admin with Ultra package
-    is_first_user = len(users) == 0
-    
-    user = {
-        'id': len(users) + 1,
-        'email': data['email'],
-        'password': data['password'],
-        'name': data.get('name', ''),
-        'role': 'admin' if is_first_user else 'cashier',
-        'plan': 'ultra' if is_first_user else None,
-        'price': 1600 if is_first_user else None,
-        'active': is_first_user,  # First user is active immediately
-        'permissions': {
-            'viewSales': True,
-            'viewInventory': True,
-            'viewExpenses': False,
-            'manageProducts': False
-        } if not is_first_user else {},
-        'createdAt': datetime.now().isoformat()
-    }
-    users.append(user)
-    save_json('users.json', users)
-    
-    token = jwt.encode({'id': user['id'], 'email': user['email'], 'role': user['role']}, 
-                       app.config['SECRET_KEY'], algorithm='HS256')
+    # As before shops had ids, a user joins the shop as a cashier awaiting activation, and the
+    # first user of a new shop is its admin with Ultra package. A new shop is only opened when
+    # asked for with createShop, or by the very first signup
+    tenant_id = data.get('tenantId')
+    
+    with accounts.transaction() as txn:
+        shop_ids = [shop['id'] for shop in txn.load('tenants')]
+        if tenant_id is not None and tenant_id not in shop_ids:
+            return jsonify({'error': 'Shop not found'}), 404
+        is_first_user = tenant_id is None and (bool(data.get('createShop')) or not shop_ids)
+        if tenant_id is None and not is_first_user:
+            if len(shop_ids) > 1:
+                return jsonify({'error': 'tenantId or createShop is required'}), 400
+            tenant_id = shop_ids[0]
+        if is_first_user:
+            tenant_id = txn.next_id('tenants')
+            txn.insert('tenants', {
+                'id': tenant_id,
+                'name': data.get('shopName') or data.get('name', ''),
+                'createdAt': datetime.now().isoformat()
+            })
+        user = {
+            'id': txn.next_id('users'),
+            'tenantId': tenant_id,
+            'email': data['email'],
+            'password': data['password'],
+            'name': data.get('name', ''),
+            'role': 'admin' if is_first_user else 'cashier',
+            'plan': 'ultra' if is_first_user else None,
+            'price': 1600 if is_first_user else None,
+            'active': is_first_user,  # First user is active immediately
+            'permissions': {
+                'viewSales': True,
+                'viewInventory': True,
+                'viewExpenses': False,
+                'manageProducts': False
+            } if not is_first_user else {},
+            'createdAt': datetime.now().isoformat()
+        }
+        txn.insert('users', user)
+    
+    token = issue_token(user, app.config['SECRET_KEY'])
     
     return jsonify({'token': token, 'user': {k: v for k, v in user.items() if k != 'password'}})
 
 @app.route('/api/auth/login', methods=['POST'])
 def login():
     data = request.json
-    users = load_json('users.json')
     
-    user = next((u for u in users if u['email'] == data['email'] and u['password'] == data['password']), None)
+    user = next((u for u in accounts.find('users', 'email', data['email']) if u['password'] == data['password']), None)
     if not user:
         return jsonify({'error': 'Invalid credentials'}), 401
     
     # Include role in token for proper authorization
-    token = jwt.encode({
-        'id': user['id'], 
-        'email': user['email'], 
-        'role': user['role']
-    }, app.config['SECRET_KEY'], algorithm='HS256')
+    token = issue_token(user, app.config['SECRET_KEY'])
     
     return jsonify({'token': token, 'user': {k: v for k, v in user.items() if k != 'password'}})
 
@@ -132,7 +207,7 @@ def users_list():
         if request.user.get('role') != 'admin':
             return jsonify({'error': 'Admin access required'}), 403
         
-        users = load_json('users.json')
+        users = accounts.find('users', 'tenantId', request.tenant.id)
         return jsonify([{k: v for k, v in u.items() if k != 'password'} for u in users])
     
     # POST - Admin creating cashier
@@ -141,13 +216,13 @@ def users_list():
         return jsonify({'error': 'Admin access required'}), 403
     
     data = request.json
-    users = load_json('users.json')
     
-    if any(u['email'] == data['email'] for u in users):
+    if accounts.find('users', 'email', data['email']):
         return jsonify({'error': 'User already exists'}), 400
     
     user = {
-        'id': len(users) + 1,
+        'id': accounts.next_id('users'),
+        'tenantId': request.tenant.id,
         'email': data['email'],
         'password': data.get('password', 'changeme123'),
         'name': data['name'],
@@ -163,18 +238,17 @@ def users_list():
         }),
         'createdAt': datetime.now().isoformat()
     }
-    users.append(user)
-    save_json('users.json', users)
+    accounts.insert('users', user)
     
     return jsonify({k: v for k, v in user.items() if k != 'password'}), 201
 
 @app.route('/api/users/<int:id>', methods=['PUT', 'DELETE'])
 @token_required
 def user_detail(id):
-    users = load_json('users.json')
-    user = next((u for u in users if u['id'] == id), None)
+    user = accounts.get('users', id)
     
-    if not user:
+    # Users of other shops don't exist as far as this one is concerned
+    if not user or user.get('tenantId') != request.tenant.id:
         return jsonify({'error': 'User not found'}), 404
     
     if request.method == 'PUT':
@@ -182,16 +256,14 @@ def user_detail(id):
         # Allow user to update themselves or admin to update anyone
         if request.user.get('id') != id and request.user.get('role') != 'admin':
             return jsonify({'error': 'Unauthorized'}), 403
+        # Emails pick the user at login and grant main admin access, so they stay unique
+        if 'email' in data and any(other['id'] != id for other in accounts.find('users', 'email', data['email'])):
+            return jsonify({'error': 'User already exists'}), 400
         
-        user.update({k: v for k, v in data.items() if k != 'password' and k != 'id'})
-        save_json('users.json', users)
+        user = accounts.update('users', id, {k: v for k, v in data.items() if k not in ('password', 'id', 'tenantId')})
         
         # Generate new token with updated role
-        new_token = jwt.encode({
-            'id': user['id'], 
-            'email': user['email'], 
-            'role': user['role']
-        }, app.config['SECRET_KEY'], algorithm='HS256')
+        new_token = issue_token(user, app.config['SECRET_KEY'])
         
         return jsonify({
             'token': new_token,
@@ -202,27 +274,36 @@ def user_detail(id):
     if request.user.get('role') != 'admin':
         return jsonify({'error': 'Admin access required'}), 403
     
-    users = [u for u in users if u['id'] != id]
-    save_json('users.json', users)
+    accounts.delete('users', id)
     return '', 204
 
 @app.route('/api/products', methods=['GET', 'POST'])
 @token_required
 def products():
+    store = request.tenant.store
     if request.method == 'GET':
+        is_cashier = request.user.get('role') == 'cashier'
+        # An unchanged catalog costs a 304 without loading or serialising it
+        etag = f"products-{request.tenant.id}-{request.tenant.product_feed.version()}-{'cashier' if is_cashier else 'all'}"
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        
         products = load_json('products.json')
         
         # Cashiers don't see expense-only items
-        if request.user.get('role') == 'cashier':
+        if is_cashier:
             products = [p for p in products if not p.get('expenseOnly', False)]
         
-        return jsonify(products)
+        response = jsonify(products)
+        response.set_etag(etag)
+        return response
     
     data = request.json
-    products = load_json('products.json')
     
     product = {
-        'id': len(products) + 1,
+        'id': store.next_id('products'),
         'name': data['name'],
         'price': data.get('price', 0),
         'cost': data.get('cost', 0),
@@ -234,143 +315,155 @@ def products():
         'visibleToCashier': data.get('visibleToCashier', True),
         'createdAt': datetime.now().isoformat()
     }
-    products.append(product)
-    save_json('products.json', products)
+    try:
+        product.update(images.image_changes(image_store, data.get('image')))
+    except images.ImageTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except images.ImageError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        store.insert('products', product)
+    except bom.RecipeCycleError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify(product), 201
 
+@app.route('/api/products/changes', methods=['GET'])
+@token_required
+def product_changes():
+    """Products created, updated or deleted since the version a till last saw"""
+    since = request.args.get('since', 0, type=int)
+    product_feed = request.tenant.product_feed
+    version, changed, deleted = product_feed.since(since)
+    reset = since > version or since < product_feed.horizon()
+    if reset:
+        # The client is ahead of us (e.g. data was restored), or missed deletions
+        # that are no longer recorded; send everything again
+        version, changed, deleted = product_feed.since(0)
+    
+    # Cashiers don't see expense-only items, so to them those look deleted
+    if request.user.get('role') == 'cashier':
+        deleted += [p['id'] for p in changed if p.get('expenseOnly', False)]
+        changed = [p for p in changed if not p.get('expenseOnly', False)]
+    
+    return jsonify({'version': version, 'changes': changed, 'deleted': deleted, 'reset': reset})
+
+@app.route('/api/events', methods=['GET'])
+@token_required
+def events_stream():
+    """Server-Sent Events stream of product, stock and settings changes"""
+    last_id = request.headers.get('Last-Event-ID', request.args.get('lastEventId'))
+    try:
+        last_id = int(last_id) if last_id is not None else None
+    except ValueError:
+        return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+    
+    stream = request.tenant.event_hub.stream(request.user.get('role'), last_id)
+    response = Response(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let a proxy buffer the stream
+    return response
+
 @app.route('/api/products/<int:id>', methods=['PUT', 'DELETE'])
 @token_required
 def product_detail(id):
-    products = load_json('products.json')
-    product = next((p for p in products if p['id'] == id), None)
+    store = request.tenant.store
+    product = store.get('products', id)
     
     if not product:
         return jsonify({'error': 'Product not found'}), 404
     
     if request.method == 'PUT':
         data = request.json
-        product.update({k: v for k, v in data.items() if k != 'id'})
-        save_json('products.json', products)
+        changes = {k: v for k, v in data.items() if k not in ('id', 'image', 'imageHash')}
+        try:
+            changes.update(images.image_changes(image_store, data.get('image'), product))
+        except images.ImageTooLarge as e:
+            return jsonify({'error': str(e)}), 413
+        except images.ImageError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            product = store.update('products', id, changes)
+        except bom.RecipeCycleError as e:
+            return jsonify({'error': str(e)}), 400
         return jsonify(product)
     
-    products = [p for p in products if p['id'] != id]
-    save_json('products.json', products)
+    store.delete('products', id)
     return '', 204
 
+@app.route('/api/products/max-producible', methods=['GET'])
+@token_required
+def max_producible_all():
+    """Max units and limiting ingredient for every recipe product"""
+    return jsonify([
+        {'productId': product_id, 'maxUnits': max_units, 'limitingIngredient': limiting}
+        for product_id, (max_units, limiting) in request.tenant.producibility.all().items()
+    ])
+
 @app.route('/api/products/<int:id>/max-producible', methods=['GET'])
 @token_required
 def max_producible(id):
-    products = load_json('products.json')
-    product = next((p for p in products if p['id'] == id), None)
-    
-    if not product or not product.get('recipe'):
-        return jsonify({'maxUnits': 0, 'limitingIngredient': None})
-    
-    max_units = float('inf')
-    limiting = None
-    
-    for ingredient in product['recipe']:
-        raw = next((p for p in products if p['id'] == ingredient['productId']), None)
-        if raw:
-            available = raw.get('quantity', 0)
-            needed = ingredient['quantity']
-            possible = available / needed if needed > 0 else 0
-            if possible < max_units:
-                max_units = possible
-                limiting = raw['name']
-    
-    return jsonify({'maxUnits': int(max_units) if max_units != float('inf') else 0, 'limitingIngredient': limiting})
+    max_units, limiting = request.tenant.producibility.get(id)
+    return jsonify({'maxUnits': max_units, 'limitingIngredient': limiting})
 
 @app.route('/api/sales', methods=['GET', 'POST'])
 @token_required
 def sales():
+    store = request.tenant.store
     if request.method == 'GET':
-        sales = load_json('sales.json')
-        return jsonify(sales)
-    
-    data = request.json
-    products = load_json('products.json')
-    expenses = load_json('expenses.json')
-    
-    total_cogs = 0
-    
-    # Process each item sold
-    for item in data['items']:
-        product = next((p for p in products if p['id'] == item['productId']), None)
-        if not product:
-            continue
-        
-        quantity_sold = item['quantity']
-        
-        # If composite product with recipe
-        if product.get('recipe'):
-            for ingredient in product['recipe']:
-                raw_product = next((p for p in products if p['id'] == ingredient['productId']), None)
-                if raw_product:
-                    qty_needed = ingredient['quantity'] * quantity_sold
-                    raw_product['quantity'] = raw_product.get('quantity', 0) - qty_needed
-                    
-                    # Calculate COGS
-                    unit_cost = raw_product.get('cost', 0) / max(raw_product.get('quantity', 1) + qty_needed, 1)
-                    cost = unit_cost * qty_needed
-                    total_cogs += cost
-                    
-                    # Record expense if expenseOnly
-                    if raw_product.get('expenseOnly'):
-                        expense = {
-                            'id': len(expenses) + 1,
-                            'description': f'Used {qty_needed} {raw_product.get("unit", "units")} of {raw_product["name"]}',
-                            'amount': cost,
-                            'category': 'ingredient',
-                            'automatic': True,
-                            'saleId': len(load_json('sales.json')) + 1,
-                            'createdAt': datetime.now().isoformat()
-                        }
-                        expenses.append(expense)
+        cashier_id = request.args.get('cashierId', type=int)
+        if cashier_id:
+            sales = store.find('sales', 'cashierId', cashier_id)
         else:
-            # Simple product
-            product['quantity'] = product.get('quantity', 0) - quantity_sold
-            total_cogs += product.get('cost', 0) * quantity_sold
-    
-    save_json('products.json', products)
-    save_json('expenses.json', expenses)
-    
-    sales_list = load_json('sales.json')
-    sale = {
-        'id': len(sales_list) + 1,
-        'items': data['items'],
-        'total': data['total'],
-        'cogs': total_cogs,
-        'profit': data['total'] - total_cogs,
-        'paymentMethod': data.get('paymentMethod', 'cash'),
-        'cashierId': request.user.get('id'),
-        'createdAt': datetime.now().isoformat()
-    }
-    sales_list.append(sale)
-    save_json('sales.json', sales_list)
+            # Only the partitions covering from/to are read
+            sales = store.load_range('sales', request.args.get('from'), request.args.get('to'))
+        return list_response(sales, filters={'cashierId': int})
     
-    return jsonify(sale), 201
+    checkout = Checkout(store)
+    sale = checkout.run(request.json, request.user.get('id'))
+    response = jsonify(sale)
+    response.headers['Server-Timing'] = checkout.server_timing()
+    return response, 201
+
+# Most sales an offline till may replay in one request
+MAX_BULK_SALES = 1000
+
+@app.route('/api/sales/bulk', methods=['POST'])
+@token_required
+def sales_bulk():
+    """Replay sales queued by an offline till, all in one transaction"""
+    store = request.tenant.store
+    sales = (request.json or {}).get('sales')
+    if not isinstance(sales, list):
+        return jsonify({'error': 'sales must be a list'}), 400
+    if len(sales) > MAX_BULK_SALES:
+        return jsonify({'error': f'At most {MAX_BULK_SALES} sales per request'}), 413
+    
+    checkout = Checkout(store)
+    results = checkout.run_many(sales, request.user.get('id'))
+    counts = {status: sum(1 for r in results if r['status'] == status) for status in ('created', 'duplicate', 'error')}
+    response = jsonify({'results': results, **counts})
+    response.headers['Server-Timing'] = checkout.server_timing()
+    return response
 
 @app.route('/api/expenses', methods=['GET', 'POST'])
 @token_required
 def expenses():
+    store = request.tenant.store
     if request.method == 'GET':
-        expenses = load_json('expenses.json')
-        return jsonify(expenses)
+        expenses = store.load_range('expenses', request.args.get('from'), request.args.get('to'))
+        return list_response(expenses, filters={'category': str})
     
     data = request.json
-    expenses = load_json('expenses.json')
     
     expense = {
-        'id': len(expenses) + 1,
+        'id': store.next_id('expenses'),
         'description': data['description'],
         'amount': data['amount'],
         'category': data.get('category', 'general'),
         'automatic': False,
         'createdAt': datetime.now().isoformat()
     }
-    expenses.append(expense)
-    save_json('expenses.json', expenses)
+    store.insert('expenses', expense)
     
     return jsonify(expense), 201
 
@@ -378,8 +471,7 @@ def expenses():
 @token_required
 def get_current_user():
     """Get current user info from token"""
-    users = load_json('users.json')
-    user = next((u for u in users if u['id'] == request.user.get('id')), None)
+    user = request.current_user
     if user:
         return jsonify({k: v for k, v in user.items() if k != 'password'})
     return jsonify({'error': 'User not found'}), 404
@@ -387,39 +479,61 @@ def get_current_user():
 @app.route('/api/stats', methods=['GET'])
 @token_required
 def stats():
-    sales = load_json('sales.json')
-    expenses = load_json('expenses.json')
-    products = load_json('products.json')
-    
-    total_sales = sum(s.get('total', 0) for s in sales)
-    total_cogs = sum(s.get('cogs', 0) for s in sales)
-    total_expenses = sum(e.get('amount', 0) for e in expenses)
-    gross_profit = total_sales - total_cogs
-    net_profit = total_sales - total_cogs - total_expenses
-    
-    # Daily/Weekly stats
-    today = datetime.now().date()
-    daily_sales = sum(s.get('total', 0) for s in sales if datetime.fromisoformat(s['createdAt']).date() == today)
-    
-    week_start = today - timedelta(days=today.weekday())
-    weekly_sales = sum(s.get('total', 0) for s in sales if datetime.fromisoformat(s['createdAt']).date() >= week_start)
-    
-    return jsonify({
-        'totalSales': total_sales,
-        'totalCOGS': total_cogs,
-        'totalExpenses': total_expenses,
-        'grossProfit': gross_profit,
-        'netProfit': net_profit,
-        'salesCount': len(sales),
-        'dailySales': daily_sales,
-        'weeklySales': weekly_sales,
-        'productCount': len(products)
-    })
+    return jsonify(shop_stats(request.tenant))
 
+def shop_stats(tenant):
+    agg = tenant.store.get(aggregates.AGGREGATES, aggregates.AGGREGATES_ID) or aggregates.empty()
+    return {**aggregates.summary(agg), 'productCount': tenant.store.count('products')}
+
+@app.route('/api/reports/sales', methods=['GET'])
+@token_required
+def sales_report():
+    """Sales grouped by hour, day, product or cashier over an optional from/to period"""
+    store = request.tenant.store
+    if request.user.get('role') != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+    
+    group_by = request.args.get('groupBy', 'day')
+    if group_by not in GROUPS:
+        return jsonify({'error': f"groupBy must be one of {', '.join(GROUPS)}"}), 400
+    since, until = request.args.get('from'), request.args.get('to')
+    try:
+        bounds = (parse_bound(since) if since else None, parse_bound(until, end=True) if until else None)
+    except ValueError:
+        return jsonify({'error': 'from and to must be ISO dates or timestamps'}), 400
+    
+    rows, totals = request.tenant.sales_columns.report(group_by, *bounds)
+    if group_by in ('product', 'cashier'):
+        names = store if group_by == 'product' else accounts
+        collection = 'products' if group_by == 'product' else 'users'
+        for row in rows:
+            record = names.get(collection, row['key']) or {}
+            row['name'] = record.get('name')
+    return jsonify({'groupBy': group_by, 'from': since, 'to': until, 'rows': rows, 'totals': totals})
+
+@app.route('/api/export/<collection>', methods=['GET'])
+@token_required
+def export_collection(collection):
+    """Stream a collection as CSV or JSON lines, optionally limited to a from/to period"""
+    store = request.tenant.store
+    if request.user.get('role') != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+    if collection not in export.COLUMNS:
+        return jsonify({'error': f"Can only export {', '.join(sorted(export.COLUMNS))}"}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+    
+    chunks = export.generate(store, collection, fmt, request.args.get('from'), request.args.get('to'),
+                             request.args.get('archived') == 'true')
+    response = Response(chunks, mimetype=export.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={collection}.{fmt}'
+    return response
 
 @app.route('/api/reminders', methods=['GET', 'POST'])
 @token_required
 def reminders():
+    store = request.tenant.store
     if request.method == 'GET':
         reminders = load_json('reminders.json')
         return jsonify(reminders)
@@ -429,9 +543,8 @@ def reminders():
         return jsonify({'error': 'Admin access required'}), 403
     
     data = request.json
-    reminders = load_json('reminders.json')
     reminder = {
-        'id': len(reminders) + 1,
+        'id': store.next_id('reminders'),
         'customerName': data['customerName'],
         'productId': data['productId'],
         'frequency': data['frequency'],
@@ -441,110 +554,101 @@ def reminders():
         'createdBy': request.user.get('id'),
         'createdAt': datetime.now().isoformat()
     }
-    reminders.append(reminder)
-    save_json('reminders.json', reminders)
+    store.insert('reminders', reminder)
     return jsonify(reminder), 201
 
 @app.route('/api/reminders/<int:id>', methods=['PUT', 'DELETE'])
 @token_required
 def reminder_detail(id):
-    reminders = load_json('reminders.json')
-    reminder = next((r for r in reminders if r['id'] == id), None)
+    store = request.tenant.store
+    reminder = store.get('reminders', id)
     if not reminder:
         return jsonify({'error': 'Reminder not found'}), 404
     
     if request.method == 'PUT':
         data = request.json
-        reminder.update({k: v for k, v in data.items() if k != 'id'})
-        save_json('reminders.json', reminders)
+        reminder = store.update('reminders', id, {k: v for k, v in data.items() if k != 'id'})
         return jsonify(reminder)
     
-    reminders = [r for r in reminders if r['id'] != id]
-    save_json('reminders.json', reminders)
+    store.delete('reminders', id)
     return '', 204
 
 @app.route('/api/reminders/today', methods=['GET'])
 @token_required
 def reminders_today():
-    reminders = load_json('reminders.json')
-    today = datetime.now().date().isoformat()
-    today_reminders = [r for r in reminders if r.get('nextDate', '')[:10] <= today and r.get('status') == 'pending']
-    return jsonify(today_reminders)
+    store = request.tenant.store
+    return jsonify(reminder_schedule.due(store))
 
 @app.route('/api/price-history', methods=['GET', 'POST'])
 @token_required
 def price_history():
+    store = request.tenant.store
     if request.method == 'GET':
         history = load_json('price_history.json')
-        return jsonify(history)
+        return list_response(history, date_field='timestamp', filters={'productId': int})
     
     data = request.json
     if data['newPrice'] < data['oldPrice']:
         return jsonify({'error': 'You cannot lower prices, only increase.'}), 400
     
-    history = load_json('price_history.json')
     record = {
-        'id': len(history) + 1,
+        'id': store.next_id('price_history'),
         'productId': data['productId'],
         'oldPrice': data['oldPrice'],
         'newPrice': data['newPrice'],
         'userId': request.user.get('id'),
         'timestamp': datetime.now().isoformat()
     }
-    history.append(record)
-    save_json('price_history.json', history)
+    store.insert('price_history', record)
     return jsonify(record), 201
 
 @app.route('/api/service-fees', methods=['GET', 'POST'])
 @token_required
 def service_fees():
+    store = request.tenant.store
     if request.method == 'GET':
         fees = load_json('service_fees.json')
         return jsonify(fees)
     
     data = request.json
-    fees = load_json('service_fees.json')
     fee = {
-        'id': len(fees) + 1,
+        'id': store.next_id('service_fees'),
         'name': data['name'],
         'amount': data['amount'],
         'description': data.get('description', ''),
         'active': data.get('active', True),
         'createdAt': datetime.now().isoformat()
     }
-    fees.append(fee)
-    save_json('service_fees.json', fees)
+    store.insert('service_fees', fee)
     return jsonify(fee), 201
 
 @app.route('/api/service-fees/<int:id>', methods=['PUT', 'DELETE'])
 @token_required
 def service_fee_detail(id):
-    fees = load_json('service_fees.json')
-    fee = next((f for f in fees if f['id'] == id), None)
+    store = request.tenant.store
+    fee = store.get('service_fees', id)
     if not fee:
         return jsonify({'error': 'Fee not found'}), 404
     
     if request.method == 'PUT':
         data = request.json
-        fee.update({k: v for k, v in data.items() if k != 'id'})
-        save_json('service_fees.json', fees)
+        fee = store.update('service_fees', id, {k: v for k, v in data.items() if k != 'id'})
         return jsonify(fee)
     
-    fees = [f for f in fees if f['id'] != id]
-    save_json('service_fees.json', fees)
+    store.delete('service_fees', id)
     return '', 204
 
 @app.route('/api/discounts', methods=['GET', 'POST'])
 @token_required
 def discounts():
+    store = request.tenant.store
     if request.method == 'GET':
         discounts = load_json('discounts.json')
         return jsonify(discounts)
     
     data = request.json
-    discounts = load_json('discounts.json')
     discount = {
-        'id': len(discounts) + 1,
+        'id': store.next_id('discounts'),
         'name': data['name'],
         'percentage': data['percentage'],
         'validFrom': data['validFrom'],
@@ -552,39 +656,39 @@ def discounts():
         'active': data.get('active', True),
         'createdAt': datetime.now().isoformat()
     }
-    discounts.append(discount)
-    save_json('discounts.json', discounts)
+    store.insert('discounts', discount)
     return jsonify(discount), 201
 
 @app.route('/api/discounts/<int:id>', methods=['PUT', 'DELETE'])
 @token_required
 def discount_detail(id):
-    discounts = load_json('discounts.json')
-    discount = next((d for d in discounts if d['id'] == id), None)
+    store = request.tenant.store
+    discount = store.get('discounts', id)
     if not discount:
         return jsonify({'error': 'Discount not found'}), 404
     
     if request.method == 'PUT':
         data = request.json
-        discount.update({k: v for k, v in data.items() if k != 'id'})
-        save_json('discounts.json', discounts)
+        discount = store.update('discounts', id, {k: v for k, v in data.items() if k != 'id'})
         return jsonify(discount)
     
-    discounts = [d for d in discounts if d['id'] != id]
-    save_json('discounts.json', discounts)
+    store.delete('discounts', id)
     return '', 204
 
 @app.route('/api/credit-requests', methods=['GET', 'POST'])
 @token_required
 def credit_requests():
+    store = request.tenant.store
     if request.method == 'GET':
+        status = request.args.get('status')
+        if status:
+            return jsonify(store.find('credit_requests', 'status', status))
         requests = load_json('credit_requests.json')
         return jsonify(requests)
     
     data = request.json
-    requests = load_json('credit_requests.json')
     credit_request = {
-        'id': len(requests) + 1,
+        'id': store.next_id('credit_requests'),
         'productId': data['productId'],
         'quantity': data['quantity'],
         'customerName': data['customerName'],
@@ -593,39 +697,34 @@ def credit_requests():
         'status': 'pending',
         'createdAt': datetime.now().isoformat()
     }
-    requests.append(credit_request)
-    save_json('credit_requests.json', requests)
+    store.insert('credit_requests', credit_request)
     return jsonify(credit_request), 201
 
 @app.route('/api/credit-requests/<int:id>/approve', methods=['POST'])
 @token_required
 def approve_credit(id):
+    store = request.tenant.store
     if request.user.get('role') != 'admin':
         return jsonify({'error': 'Admin access required'}), 403
     
-    requests = load_json('credit_requests.json')
-    credit_request = next((r for r in requests if r['id'] == id), None)
+    credit_request = store.update('credit_requests', id, {
+        'status': 'approved',
+        'approvedAt': datetime.now().isoformat()
+    })
     if not credit_request:
         return jsonify({'error': 'Request not found'}), 404
-    
-    credit_request['status'] = 'approved'
-    credit_request['approvedAt'] = datetime.now().isoformat()
-    save_json('credit_requests.json', requests)
     return jsonify(credit_request)
 
 @app.route('/api/credit-requests/<int:id>/reject', methods=['POST'])
 @token_required
 def reject_credit(id):
+    store = request.tenant.store
     if request.user.get('role') != 'admin':
         return jsonify({'error': 'Admin access required'}), 403
     
-    requests = load_json('credit_requests.json')
-    credit_request = next((r for r in requests if r['id'] == id), None)
+    credit_request = store.update('credit_requests', id, {'status': 'rejected'})
     if not credit_request:
         return jsonify({'error': 'Request not found'}), 404
-    
-    credit_request['status'] = 'rejected'
-    save_json('credit_requests.json', requests)
     return jsonify(credit_request)
 
 @app.route('/api/settings', methods=['GET', 'POST'])
@@ -638,7 +737,7 @@ def settings():
     data = request.json
     settings = load_json('settings.json')
     if settings:
-        settings[0].update(data)
+        settings = [{**settings[0], **data}] + settings[1:]
     else:
         settings = [data]
     save_json('settings.json', settings)
@@ -647,19 +746,19 @@ def settings():
 @app.route('/api/batches', methods=['GET', 'POST'])
 @token_required
 def batches():
+    store = request.tenant.store
     if request.method == 'GET':
-        batches = load_json('batches.json')
         product_id = request.args.get('productId')
         if product_id:
-            batches = [b for b in batches if b['productId'] == int(product_id)]
-        return jsonify(batches)
+            return jsonify(store.find('batches', 'productId', int(product_id)))
+        return jsonify(load_json('batches.json'))
     
     data = request.json
-    batches = load_json('batches.json')
+    batch_id = store.next_id('batches')
     batch = {
-        'id': len(batches) + 1,
+        'id': batch_id,
         'productId': data['productId'],
-        'batchCode': data.get('batchCode', f"B{len(batches) + 1:04d}"),
+        'batchCode': data.get('batchCode', f"B{batch_id:04d}"),
         'buyingPrice': data['buyingPrice'],
         'sellingPrice': data['sellingPrice'],
         'quantity': data['quantity'],
@@ -667,149 +766,148 @@ def batches():
         'type': data.get('type', 'new'),
         'createdAt': datetime.now().isoformat()
     }
-    batches.append(batch)
-    save_json('batches.json', batches)
+    store.insert('batches', batch)
     return jsonify(batch), 201
 
 @app.route('/api/production', methods=['GET', 'POST'])
 @token_required
 def production():
+    store = request.tenant.store
     if request.method == 'GET':
         production = load_json('production.json')
-        return jsonify(production)
+        return list_response(production, filters={'sourceProductId': int, 'targetProductId': int})
     
     data = request.json
-    production_list = load_json('production.json')
-    batches = load_json('batches.json')
-    
-    record = {
-        'id': len(production_list) + 1,
-        'sourceProductId': data['sourceProductId'],
-        'targetProductId': data['targetProductId'],
-        'quantityUsed': data['quantityUsed'],
-        'quantityProduced': data['quantityProduced'],
-        'waste': data.get('waste', 0),
-        'userId': request.user.get('id'),
-        'createdAt': datetime.now().isoformat()
-    }
-    
-    # Deduct from old batches first (FIFO)
-    remaining_to_deduct = data['quantityUsed']
-    source_batches = sorted([b for b in batches if b['productId'] == data['sourceProductId'] and b['remaining'] > 0], key=lambda x: x['createdAt'])
-    
-    for batch in source_batches:
-        if remaining_to_deduct <= 0:
-            break
-        deduct = min(batch['remaining'], remaining_to_deduct)
-        batch['remaining'] -= deduct
-        remaining_to_deduct -= deduct
     
-    save_json('batches.json', batches)
-    production_list.append(record)
-    save_json('production.json', production_list)
+    with store.transaction() as txn:
+        record = {
+            'id': txn.next_id('production'),
+            'sourceProductId': data['sourceProductId'],
+            'targetProductId': data['targetProductId'],
+            'quantityUsed': data['quantityUsed'],
+            'quantityProduced': data['quantityProduced'],
+            'waste': data.get('waste', 0),
+            'userId': request.user.get('id'),
+            'createdAt': datetime.now().isoformat()
+        }
+        
+        # Deduct from old batches first (FIFO)
+        fifo.FifoAllocator(txn).take(data['sourceProductId'], data['quantityUsed'])
+        
+        txn.insert('production', record)
     return jsonify(record), 201
 
 @app.route('/api/categories/generate-code', methods=['POST'])
 @token_required
 def generate_code():
+    store = request.tenant.store
     data = request.json
-    products = load_json('products.json')
     prefix = data.get('prefix', 'P')
-    category_products = [p for p in products if p.get('category') == data.get('category')]
-    next_num = len(category_products) + 1
+    next_num = len(store.find('products', 'category', data.get('category'))) + 1
     code = f"{prefix}{next_num:03d}"
     return jsonify({'code': code})
 
 @app.route('/api/upload-image', methods=['POST'])
 @token_required
 def upload_image():
-    """Handle base64 image uploads for products and profiles"""
+    """Store a base64 image upload for products and profiles; returns its URL"""
     data = request.json
-    image_data = data.get('image')  # Base64 encoded image
+    image_data = data.get('image')  # Base64 encoded image or data URL
     image_type = data.get('type', 'product')  # 'product', 'profile', 'logo'
-    
-    # Store image data (in production, you'd save to file system or cloud storage)
-    # For now, we'll just return the base64 data back
-    return jsonify({'imageUrl': image_data, 'type': image_type})
+    if not isinstance(image_data, str) or not image_data:
+        return jsonify({'error': 'Image is required'}), 400
+    
+    try:
+        digest = image_store.put_data_url(image_data)
+    except images.ImageTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except images.ImageError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'imageUrl': f'/api/images/{digest}', 'hash': digest, 'type': image_type})
+
+@app.route('/api/images/<digest>', methods=['GET'])
+def get_image(digest):
+    """Serve a stored image, or its thumbnail closest to ?size= pixels.
+
+    Public, so <img> tags can load it; an image's URL never changes
+    content, so browsers and proxies may keep it for a year.
+    """
+    size = request.args.get('size', type=int)
+    found = image_store.find(digest, size)
+    if found is None:
+        return jsonify({'error': 'Image not found'}), 404
+    
+    path, mimetype = found
+    response = send_file(path, mimetype=mimetype, etag=os.path.basename(path), conditional=True)
+    response.headers['Cache-Control'] = f'public, max-age={images.CACHE_SECONDS}, immutable'
+    return response
 
 # Main Admin Routes
 @app.route('/api/main-admin/users', methods=['GET'])
 @token_required
+@main_admin_required
 def main_admin_get_users():
     """Get all users with payment info for main admin"""
-    users = load_json('users.json')
-    # Add locked field if not present
-    for user in users:
-        if 'locked' not in user:
-            user['locked'] = False
-    save_json('users.json', users)
-    return jsonify([{k: v for k, v in u.items() if k != 'password'} for u in users])
+    users = accounts.load('users')
+    # Users that were never locked have no locked field yet
+    return jsonify([{'locked': False, **{k: v for k, v in u.items() if k != 'password'}} for u in users])
+
+@app.route('/api/main-admin/tenants', methods=['GET'])
+@token_required
+@main_admin_required
+def main_admin_get_tenants():
+    """Every shop with its user count and stats, read from the shops' stores in parallel"""
+    return jsonify([{**record, 'userCount': len(accounts.find('users', 'tenantId', record['id'])), **stats}
+                    for record, stats in shops.map(shop_stats)])
 
 @app.route('/api/main-admin/payments', methods=['GET'])
 @token_required
+@main_admin_required
 def main_admin_get_payments():
     """Get all payments for main admin"""
-    payments = load_json('payments.json')
-    return jsonify(payments)
+    payments = accounts.load('payments')
+    return list_response(payments, filters={'userId': int, 'status': str})
 
 @app.route('/api/main-admin/users/<int:user_id>/lock', methods=['POST'])
 @token_required
+@main_admin_required
 def main_admin_lock_user(user_id):
     """Lock or unlock a user account"""
     data = request.json
-    users = load_json('users.json')
-    user = next((u for u in users if u['id'] == user_id), None)
+    changes = {'locked': data.get('locked', False)}
+    if changes['locked']:
+        changes['active'] = False
     
+    user = accounts.update('users', user_id, changes)
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    user['locked'] = data.get('locked', False)
-    if user['locked']:
-        user['active'] = False
-    
-    save_json('users.json', users)
     return jsonify({'success': True, 'locked': user['locked']})
 
 @app.route('/api/main-admin/send-email', methods=['POST'])
 @token_required
+@main_admin_required
 def main_admin_send_email():
-    """Send email to selected users"""
+    """Queue an email to each selected user; the mailer workers deliver them"""
     data = request.json
     user_ids = data.get('userIds', [])
     subject = data.get('subject', '')
     message = data.get('message', '')
     
-    users = load_json('users.json')
-    emails = load_json('emails.json')
-    
-    # Log emails (in production, integrate with email service like SendGrid, Mailgun, etc.)
-    for user_id in user_ids:
-        user = next((u for u in users if u['id'] == user_id), None)
-        if user:
-            email_record = {
-                'id': len(emails) + 1,
-                'userId': user_id,
-                'userEmail': user['email'],
-                'userName': user['name'],
-                'subject': subject,
-                'message': message,
-                'status': 'sent',
-                'sentAt': datetime.now().isoformat()
-            }
-            emails.append(email_record)
-    
-    save_json('emails.json', emails)
-    return jsonify({'success': True, 'emailsSent': len(user_ids)})
+    users = [accounts.get('users', user_id) for user_id in dict.fromkeys(user_ids)]
+    emails = mailer.queue_emails(accounts, [u for u in users if u], subject, message)
+    outbox.wake()
+    return jsonify({'success': True, 'emailsQueued': len(emails)}), 202
 
 @app.route('/api/main-admin/create-payment', methods=['POST'])
 @token_required
+@main_admin_required
 def main_admin_create_payment():
     """Create a payment record for a user"""
     data = request.json
-    payments = load_json('payments.json')
     
     payment = {
-        'id': len(payments) + 1,
+        'id': accounts.next_id('payments'),
         'userId': data['userId'],
         'amount': data['amount'],
         'plan': data.get('plan', 'basic'),
@@ -818,28 +916,67 @@ def main_admin_create_payment():
         'createdAt': datetime.now().isoformat()
     }
     
-    payments.append(payment)
-    save_json('payments.json', payments)
+    accounts.insert('payments', payment)
     return jsonify(payment), 201
 
 @app.route('/api/main-admin/payments/<int:payment_id>', methods=['PUT'])
 @token_required
+@main_admin_required
 def main_admin_update_payment(payment_id):
     """Update payment status"""
     data = request.json
-    payments = load_json('payments.json')
-    payment = next((p for p in payments if p['id'] == payment_id), None)
+    payment = accounts.get('payments', payment_id)
     
     if not payment:
         return jsonify({'error': 'Payment not found'}), 404
     
-    payment['status'] = data.get('status', payment['status'])
-    if payment['status'] == 'paid':
-        payment['paidAt'] = datetime.now().isoformat()
+    changes = {'status': data.get('status', payment['status'])}
+    if changes['status'] == 'paid':
+        changes['paidAt'] = datetime.now().isoformat()
     
-    save_json('payments.json', payments)
+    payment = accounts.update('payments', payment_id, changes)
     return jsonify(payment)
 
+@app.route('/api/profiles', methods=['GET'])
+@token_required
+def profiles():
+    """Saved request profiles, newest first"""
+    if request.user.get('role') != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+    # Only this shop's; profiles of requests without a token are only on disk
+    return jsonify([p for p in profiling.list_profiles(app.config['PROFILE_DIR'])
+                    if p.get('tenantId') == request.tenant.id])
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+@token_required
+def profile_detail(profile_id):
+    """A saved profile's summary, or with ?format=prof its pstats file"""
+    if request.user.get('role') != 'admin':
+        return jsonify({'error': 'Admin access required'}), 403
+    path = profiling.find(app.config['PROFILE_DIR'], profile_id)
+    summary = None
+    if path is not None:
+        with open(path) as f:
+            summary = json.load(f)
+    if summary is None or summary.get('tenantId') != request.tenant.id:
+        return jsonify({'error': 'Profile not found'}), 404
+    if request.args.get('format') == 'prof':
+        path = profiling.find(app.config['PROFILE_DIR'], profile_id, '.prof')
+        if path is None:
+            return jsonify({'error': 'Profile not found'}), 404
+        return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                         download_name=f'{profile_id}.prof')
+    return jsonify(summary)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics of this worker"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'error': 'Metrics token required'}), 401
+    with shops.stores() as stores:
+        text = metrics.render([accounts] + stores)
+    return Response(text, content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5002))
     app.run(host='0.0.0.0', port=port, debug=False)
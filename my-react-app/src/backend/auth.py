@@ -0,0 +1,72 @@
+"""Issuing and verifying the JWTs behind token_required.
+
+Tokens carry the user's shop in a ``tenant`` claim and an ``exp`` claim,
+``JWT_EXPIRES_HOURS`` (default 24) after they were issued. Verifying a
+token means an HMAC check plus looking up the caller's user record, so
+both results are kept in a bounded LRU cache keyed by the token. An entry
+lives until the token expires, or for ``NO_EXP_TTL`` seconds for older
+tokens without ``exp``. The cached user record is reloaded whenever the
+users collection changed, in any worker, so edits, deletions and locks
+are seen on the next request.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import jwt
+
+TOKEN_HOURS = float(os.environ.get('JWT_EXPIRES_HOURS', 24))
+CACHE_SIZE = int(os.environ.get('POS_TOKEN_CACHE_SIZE', 1024))
+NO_EXP_TTL = 300
+
+
+def issue_token(user, secret):
+    return jwt.encode({
+        'id': user['id'],
+        'email': user['email'],
+        'role': user['role'],
+        'tenant': user.get('tenantId'),
+        'exp': datetime.now(timezone.utc) + timedelta(hours=TOKEN_HOURS)
+    }, secret, algorithm='HS256')
+
+
+class TokenCache:
+    def __init__(self, store, secret, size=CACHE_SIZE):
+        self.store = store
+        self.secret = secret
+        self.size = size
+        self._entries = OrderedDict()  # token -> (expires at, claims, user, users version)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, token):
+        """``(claims, user record or None)``; raises ``jwt.InvalidTokenError`` for a bad token."""
+        now = time.time()
+        version = self.store.version('users')  # Read before the user, so a race only costs a reload
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry and entry[0] <= now:
+                del self._entries[token]
+                entry = None
+            if entry:
+                self._entries.move_to_end(token)
+                if entry[3] == version:
+                    self.hits += 1
+                    return entry[1], entry[2]
+            self.misses += 1
+
+        if entry:
+            expires, claims = entry[0], entry[1]  # Signature already checked; only the user changed
+        else:
+            claims = jwt.decode(token, self.secret, algorithms=['HS256'])
+            expires = claims.get('exp', now + NO_EXP_TTL)
+        user = self.store.get('users', claims.get('id'))
+        with self._lock:
+            self._entries[token] = (expires, claims, user, version)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return claims, user
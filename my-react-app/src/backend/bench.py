@@ -0,0 +1,356 @@
+"""Benchmark the hot API endpoints against a generated data directory.
+
+Drives login, product listing, checkout, stats, max-producible and
+production, and reports p50/p95/p99 latency and throughput for each.
+Requests go through Flask's test client in this process, or with
+``--gunicorn N`` over HTTP to N local gunicorn workers started for the
+run. The data directory (see ``bench_data.py``) is copied first, since
+checkouts and production runs write to it::
+
+    python bench_data.py --scale medium --out /tmp/shop
+    python bench.py --data-dir /tmp/shop --requests 500 --out before.json
+    python bench.py --data-dir /tmp/shop --requests 500 --compare before.json
+
+Results are written as JSON together with the commit and the dataset, so
+runs on different commits can be compared with ``--compare``. The storage
+engine follows ``POS_STORAGE`` as it does for the app.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from bench_data import ADMIN_EMAIL, META_FILE, PASSWORD
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PERCENTILES = (50, 95, 99)
+
+
+class InProcessClient:
+    """Requests through the Flask test client; one client per thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    """Requests over HTTP; one keep-alive connection per thread."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            # The worker closed the connection; retry once on a new one
+            conn.close()
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+        return response.status, response.read()
+
+
+class Context:
+    """Tokens and product ids the request builders pick from."""
+
+    def __init__(self, client):
+        self.admin = self.login(client, ADMIN_EMAIL)
+        products = self.get(client, '/api/products')
+        users = self.get(client, '/api/users')
+        self.raw = [p['id'] for p in products if not p.get('recipe')]
+        self.recipes = [p['id'] for p in products if p.get('recipe')]
+        self.sellable = [p for p in products if not p.get('expenseOnly')]
+        self.cashier_emails = [u['email'] for u in users if u.get('role') == 'cashier'] or [ADMIN_EMAIL]
+        self.cashier = self.login(client, self.cashier_emails[0])
+
+    @staticmethod
+    def login(client, email):
+        status, body = client.request('POST', '/api/auth/login', {'email': email, 'password': PASSWORD})
+        if status != 200:
+            raise SystemExit(f'Login as {email} failed ({status}): {body[:200]!r}')
+        return {'Authorization': 'Bearer ' + json.loads(body)['token']}
+
+    def get(self, client, path):
+        status, body = client.request('GET', path, headers=self.admin)
+        if status != 200:
+            raise SystemExit(f'GET {path} failed ({status}): {body[:200]!r}')
+        return json.loads(body)
+
+
+def login(rng, ctx):
+    return 'POST', '/api/auth/login', {'email': rng.choice(ctx.cashier_emails), 'password': PASSWORD}, None
+
+
+def products(rng, ctx):
+    return 'GET', '/api/products', None, ctx.cashier
+
+
+def checkout(rng, ctx):
+    items = [{'productId': p['id'], 'quantity': 1, 'price': p['price']}
+             for p in rng.sample(ctx.sellable, min(len(ctx.sellable), rng.randint(1, 4)))]
+    body = {'items': items, 'total': sum(i['price'] for i in items), 'paymentMethod': 'cash'}
+    return 'POST', '/api/sales', body, ctx.cashier
+
+
+def stats(rng, ctx):
+    return 'GET', '/api/stats', None, ctx.admin
+
+
+def max_producible(rng, ctx):
+    return 'GET', '/api/products/max-producible', None, ctx.admin
+
+
+def max_producible_one(rng, ctx):
+    return 'GET', f'/api/products/{rng.choice(ctx.recipes or ctx.raw)}/max-producible', None, ctx.admin
+
+
+def production(rng, ctx):
+    body = {'sourceProductId': rng.choice(ctx.raw), 'targetProductId': rng.choice(ctx.recipes or ctx.raw),
+            'quantityUsed': 1, 'quantityProduced': 1}
+    return 'POST', '/api/production', body, ctx.admin
+
+
+ENDPOINTS = {
+    'login': (login, 200),
+    'products': (products, 200),
+    'checkout': (checkout, 201),
+    'stats': (stats, 200),
+    'max_producible': (max_producible, 200),
+    'max_producible_one': (max_producible_one, 200),
+    'production': (production, 201),
+}
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an ascending list."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+
+def run_endpoint(client, ctx, build, expected, requests, concurrency, warmup, seed):
+    """Send ``requests`` requests from ``concurrency`` threads; returns the summary."""
+    rng = random.Random(-seed)
+    for _ in range(warmup):
+        client.request(*build(rng, ctx))
+    counter = itertools.count()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def worker(thread_no):
+        rng = random.Random(seed * 1000 + thread_no)
+        mine, failed = [], []
+        while next(counter) < requests:
+            request = build(rng, ctx)
+            started = time.perf_counter()
+            status, body = client.request(*request)
+            mine.append((time.perf_counter() - started) * 1000)
+            if status != expected:
+                failed.append(f'{status}: {body[:200]!r}')
+        with lock:
+            latencies.extend(mine)
+            errors.extend(failed)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    summary = {
+        'requests': len(latencies),
+        'errors': len(errors),
+        **{f'p{p}': round(percentile(latencies, p), 3) for p in PERCENTILES},
+        'mean': round(sum(latencies) / len(latencies), 3),
+        'max': round(latencies[-1], 3),
+        'throughput': round(len(latencies) / elapsed, 1),
+    }
+    if errors:
+        summary['firstError'] = errors[0]
+    return summary
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--', '.'], cwd=BACKEND_DIR,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def prepare(data_dir, in_place):
+    """The directory to run against: a copy of ``data_dir`` unless ``in_place``."""
+    if in_place:
+        return data_dir, None
+    tmp = tempfile.mkdtemp(prefix='pos-bench-')
+    target = os.path.join(tmp, 'data')
+    shutil.copytree(data_dir, target)
+    if os.environ.get('POS_STORAGE', 'json').lower() == 'sqlite' and not os.path.exists(
+            os.path.join(target, 'pos.sqlite3')):
+        subprocess.run([sys.executable, os.path.join(BACKEND_DIR, 'storage.py'), 'import', '--data-dir', target],
+                       check=True, stdout=subprocess.DEVNULL)
+    return target, tmp
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(data_dir, workers, worker_class, timeout):
+    """Start gunicorn on a free port; returns ``(process, client)`` once it answers."""
+    port = free_port()
+    env = {**os.environ, 'POS_DATA_DIR': data_dir}
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--worker-class', worker_class,
+         '--bind', f'127.0.0.1:{port}', '--timeout', str(timeout), '--log-level', 'warning', 'app:app'],
+        cwd=BACKEND_DIR, env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'gunicorn exited with status {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            # Workers load the app after binding; wait until one answers
+            client = HttpClient('127.0.0.1', port)
+            client.request('GET', '/api/stats')
+            return process, client
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f'gunicorn did not start within {timeout}s')
+
+
+def compare(results, baseline):
+    """Print each endpoint's change against a saved run."""
+    print(f"\nAgainst {baseline.get('commit') or 'baseline'} ({baseline.get('createdAt')})")
+    print(f"{'endpoint':20} {'p50':>16} {'p95':>16} {'p99':>16} {'req/s':>16}")
+    for name, summary in results['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(name)
+        if not before:
+            continue
+        cells = []
+        for key in ('p50', 'p95', 'p99', 'throughput'):
+            change = (summary[key] - before[key]) / before[key] * 100 if before[key] else 0
+            cells.append(f'{summary[key]:>8} {change:>+6.1f}%')
+        print(f'{name:20} ' + ' '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot API endpoints')
+    parser.add_argument('--data-dir', required=True, help='Data directory, e.g. written by bench_data.py')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='Comma separated subset to run')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=1, help='Client threads')
+    parser.add_argument('--warmup', type=int, default=5, help='Unmeasured requests per endpoint')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--gunicorn', type=int, metavar='WORKERS', help='Run through this many gunicorn workers')
+    parser.add_argument('--worker-class', default='sync', help='gunicorn worker class')
+    parser.add_argument('--startup-timeout', type=int, default=600, help='Seconds to wait for the app to start')
+    parser.add_argument('--in-place', action='store_true', help="Run against --data-dir itself, not a copy")
+    parser.add_argument('--out', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Results JSON of an earlier run to compare against')
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.endpoints.split(',') if n.strip()]
+    unknown = [n for n in names if n not in ENDPOINTS]
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(unknown)} (choose from {', '.join(ENDPOINTS)})")
+
+    data_dir, tmp = prepare(os.path.abspath(args.data_dir), args.in_place)
+    process = None
+    try:
+        started = time.perf_counter()
+        if args.gunicorn:
+            process, client = start_gunicorn(data_dir, args.gunicorn, args.worker_class, args.startup_timeout)
+        else:
+            os.environ['POS_DATA_DIR'] = data_dir
+            sys.path.insert(0, BACKEND_DIR)
+            import app
+            client = InProcessClient(app.app)
+        startup = time.perf_counter() - started
+        ctx = Context(client)
+
+        commit, dirty = git_commit()
+        meta_path = os.path.join(args.data_dir, META_FILE)
+        dataset = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                dataset = json.load(f)
+        results = {
+            'commit': commit,
+            'dirty': dirty,
+            'createdAt': datetime.now().isoformat(),
+            'mode': f'gunicorn x{args.gunicorn} ({args.worker_class})' if args.gunicorn else 'in-process',
+            'storage': os.environ.get('POS_STORAGE', 'json'),
+            'python': sys.version.split()[0],
+            'concurrency': args.concurrency,
+            'dataset': dataset,
+            'startupSeconds': round(startup, 2),
+            'endpoints': {},
+        }
+        print(f"{results['mode']}, {args.concurrency} client thread(s), started in {startup:.1f}s")
+        print(f"{'endpoint':20} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>9} {'req/s':>8} {'errors':>7}")
+        for name in names:
+            build, expected = ENDPOINTS[name]
+            summary = run_endpoint(client, ctx, build, expected, args.requests, args.concurrency, args.warmup,
+                                   args.seed)
+            results['endpoints'][name] = summary
+            print(f"{name:20} {summary['p50']:>8} {summary['p95']:>8} {summary['p99']:>8} {summary['max']:>9} "
+                  f"{summary['throughput']:>8} {summary['errors']:>7}")
+            if summary['errors']:
+                print(f"  first error: {summary['firstError']}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {args.out}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark response compression and the on-disk JSON formats.
+
+For the payloads of /api/products and /api/sales (built from a shop's
+data, ``--tenant``, optionally repeated ``--scale`` times to mimic a bigger
+shop) this prints, per encoding, the bytes sent, the time spent
+compressing and the transfer time saved on a ``--mbps`` link. It then
+times writing and reading the same records in each ``POS_JSON_FORMAT``.
+The shop is read from a temporary copy, as opening a store can create
+files and close partitions, so the data directory is left as it was::
+
+    python bench_compression.py --tenant 2 --scale 20 --mbps 5
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import compression
+import tenants
+from storage import JSON_FORMATS, decode_json, write_json_file
+
+
+def timed(fn, repeat):
+    """``(result, median milliseconds)`` of calling ``fn`` ``repeat`` times."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(times)
+
+
+def bench_responses(payloads, mbps, repeat):
+    print(f'Responses ({mbps} Mbit/s link)')
+    print(f"{'endpoint':16} {'encoding':9} {'bytes':>10} {'ratio':>6} {'compress ms':>12} {'saved ms':>9}")
+    for endpoint, records in payloads.items():
+        data = json.dumps(records, separators=(',', ':')).encode()
+        transfer_ms = lambda n: n * 8 / (mbps * 1000)
+        print(f"{endpoint:16} {'identity':9} {len(data):>10} {1:>6.2f} {0:>12.2f} {0:>9.1f}")
+        for encoding in compression.ENCODINGS:
+            body, ms = timed(lambda: compression.compress(data, encoding), repeat)
+            saved = transfer_ms(len(data)) - transfer_ms(len(body)) - ms
+            print(f'{endpoint:16} {encoding:9} {len(body):>10} {len(data) / len(body):>6.2f} {ms:>12.2f} {saved:>9.1f}')
+    print()
+
+
+def bench_formats(collections, repeat):
+    print('Storage formats')
+    print(f"{'collection':12} {'format':8} {'bytes':>10} {'write ms':>9} {'read ms':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.json')
+        for name, records in collections.items():
+            for fmt in JSON_FORMATS:
+                _, write_ms = timed(lambda: write_json_file(path, records, fmt), repeat)
+
+                def read():
+                    with open(path, 'rb') as f:
+                        return decode_json(f.read())
+                _, read_ms = timed(read, repeat)
+                print(f'{name:12} {fmt:8} {os.path.getsize(path):>10} {write_ms:>9.2f} {read_ms:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark response compression and storage formats')
+    parser.add_argument('--data-dir', default=tenants.DATA_DIR)
+    parser.add_argument('--tenant', type=int, default=1, help='Id of the shop whose data is used')
+    parser.add_argument('--scale', type=int, default=1, help='Repeat the records this many times')
+    parser.add_argument('--mbps', type=float, default=5, help='Link speed used for the transfer time')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tenants.directory(args.data_dir, args.tenant)
+    if not os.path.isdir(directory):
+        parser.error(f'No shop {args.tenant} in {args.data_dir}')
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, 'shop')
+        shutil.copytree(directory, copy, ignore=shutil.ignore_patterns('.lock'))
+        store = tenants.open_shop_storage(copy, ())
+        products = store.load('products') * args.scale
+        sales = store.load('sales') * args.scale
+    bench_responses({'/api/products': products, '/api/sales': sales}, args.mbps, args.repeat)
+    bench_formats({'products': products, 'sales': sales}, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Generate a synthetic shop's data directory for benchmarks.
+
+Writes ``<out>/*.json`` in the layout the backend reads: raw ingredients
+with purchase batches, recipe products built from them (some using
+other recipes), cashiers, and months of sales with a daily rush and a
+few best sellers. The same ``--seed`` always produces the same files::
+
+    python bench_data.py --scale large --out /tmp/bigshop
+    python bench_data.py --products 5000 --sales 300000 --out /tmp/shop
+
+Sales and expenses are streamed to disk, so even ``large`` (20k products,
+2M sales, 500 cashiers) needs little memory to generate. The backend
+splits them into partitions on its first start, as it does for any
+existing ``sales.json``. Every user's password is ``changeme123``; the
+admin is ``admin@example.com``.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+
+SCALES = {
+    'small': {'products': 500, 'sales': 20000, 'cashiers': 10, 'days': 90},
+    'medium': {'products': 5000, 'sales': 200000, 'cashiers': 100, 'days': 365},
+    'large': {'products': 20000, 'sales': 2000000, 'cashiers': 500, 'days': 730},
+}
+PASSWORD = 'changeme123'
+ADMIN_EMAIL = 'admin@example.com'
+# Share of products that are recipes, and of recipes that use another recipe
+RECIPE_SHARE = 0.3
+NESTED_SHARE = 0.1
+# Relative number of sales in each hour of the day
+HOURLY = [0, 0, 0, 0, 0, 0, 1, 3, 6, 7, 8, 10, 14, 12, 8, 6, 7, 10, 12, 11, 8, 5, 2, 1]
+UNITS = ['kg', 'g', 'l', 'ml', 'pcs']
+PAYMENT_METHODS = ['cash', 'cash', 'mpesa', 'mpesa', 'mpesa', 'card']
+WORDS = ['Tilapia', 'Perch', 'Rice', 'Beans', 'Maize', 'Sukuma', 'Chapati', 'Ugali', 'Chicken', 'Beef', 'Goat',
+         'Onion', 'Tomato', 'Pilau', 'Samosa', 'Mandazi', 'Tea', 'Coffee', 'Juice', 'Soda', 'Cabbage', 'Potato']
+# Not *.json, so the storage tools don't take it for a collection
+META_FILE = 'bench.meta'
+
+
+def write_records(path, records):
+    """Write ``records`` (any iterable) as a JSON array, one record per line; returns the count."""
+    count = 0
+    with open(path, 'w') as f:
+        f.write('[')
+        for record in records:
+            f.write((',\n' if count else '\n') + json.dumps(record, separators=(',', ':')))
+            count += 1
+        f.write('\n]\n')
+    return count
+
+
+def make_users(rng, cashiers, now):
+    users = [{'id': 1, 'email': ADMIN_EMAIL, 'password': PASSWORD, 'name': 'Admin', 'role': 'admin',
+              'plan': 'ultra', 'price': 1600, 'active': True, 'permissions': {}, 'createdAt': now}]
+    for n in range(1, cashiers + 1):
+        users.append({'id': n + 1, 'email': f'cashier{n}@bench.local', 'password': PASSWORD,
+                      'name': f'Cashier {n}', 'role': 'cashier', 'active': True, 'permissions': {},
+                      'createdAt': now})
+    return users
+
+
+def make_products(rng, count, now):
+    """Raw ingredients first, then recipes that only use lower ids (so there are no cycles)."""
+    raw_count = max(1, count - int(count * RECIPE_SHARE))
+    products = []
+    for product_id in range(1, count + 1):
+        name = f'{rng.choice(WORDS)} {rng.choice(WORDS)} {product_id}'
+        if product_id <= raw_count:
+            cost = rng.randint(5, 800)
+            products.append({
+                'id': product_id, 'name': name, 'price': round(cost * rng.uniform(1.2, 2.0)), 'cost': cost,
+                'quantity': rng.randint(10000, 100000), 'unit': rng.choice(UNITS), 'category': 'raw',
+                'recipe': [], 'expenseOnly': rng.random() < 0.05, 'visibleToCashier': True, 'createdAt': now
+            })
+            continue
+        ingredients = rng.sample(range(1, raw_count + 1), min(raw_count, rng.randint(2, 5)))
+        if product_id > raw_count + 1 and rng.random() < NESTED_SHARE:
+            ingredients.append(rng.randint(raw_count + 1, product_id - 1))
+        recipe = [{'productId': i, 'quantity': round(rng.uniform(0.1, 2), 2)} for i in ingredients]
+        cost = sum(products[line['productId'] - 1]['cost'] * line['quantity'] for line in recipe)
+        products.append({
+            'id': product_id, 'name': name, 'price': round(cost * rng.uniform(1.3, 2.5)), 'cost': round(cost, 2),
+            'quantity': 0, 'unit': 'pcs', 'category': 'composite', 'recipe': recipe, 'expenseOnly': False,
+            'visibleToCashier': True, 'createdAt': now
+        })
+    return products
+
+
+def make_batches(rng, products, start):
+    """Two or three purchase batches per raw product whose remainders add up to its stock."""
+    batch_id = 0
+    for product in products:
+        if product['recipe']:
+            continue
+        parts = rng.randint(2, 3)
+        for n in range(parts):
+            batch_id += 1
+            remaining = product['quantity'] // parts + (product['quantity'] % parts if n == 0 else 0)
+            yield {
+                'id': batch_id, 'productId': product['id'], 'batchCode': f'B{batch_id:06d}', 'type': 'purchase',
+                'quantity': remaining, 'remaining': remaining, 'buyingPrice': product['cost'],
+                'sellingPrice': product['price'], 'createdAt': (start + timedelta(days=n)).isoformat()
+            }
+
+
+def sale_times(rng, count, start, days):
+    """``count`` timestamps over ``days`` days from ``start``, in order, busier at meal times."""
+    hours = list(itertools.accumulate(HOURLY))
+    per_day, extra = divmod(count, days)
+    for day in range(days):
+        n = per_day + (1 if day < extra else 0)
+        offsets = rng.choices(range(24), cum_weights=hours, k=n)
+        seconds = sorted(h * 3600 + rng.randrange(3600) for h in offsets)
+        base = start + timedelta(days=day)
+        for s in seconds:
+            yield base + timedelta(seconds=s, microseconds=rng.randrange(1000000))
+
+
+def make_sales(rng, count, products, cashiers, start, days):
+    sellable = [p for p in products if not p['expenseOnly']]
+    # A few best sellers: weight falls off with rank, like real sales do
+    weights = list(itertools.accumulate(1 / (rank + 1) ** 0.8 for rank in range(len(sellable))))
+    rng.shuffle(sellable)
+    for sale_id, created in enumerate(sale_times(rng, count, start, days), 1):
+        picked = rng.choices(range(len(sellable)), cum_weights=weights, k=rng.choice((1, 1, 1, 2, 2, 3, 4)))
+        items = [{'productId': sellable[i]['id'], 'quantity': quantity, 'price': sellable[i]['price'],
+                  'cogs': round(sellable[i]['cost'] * quantity, 2)}
+                 for i, quantity in Counter(picked).items()]
+        total = sum(item['price'] * item['quantity'] for item in items)
+        cogs = round(sum(item['cogs'] for item in items), 2)
+        yield {
+            'id': sale_id, 'items': items, 'total': total, 'cogs': cogs, 'profit': round(total - cogs, 2),
+            'paymentMethod': rng.choice(PAYMENT_METHODS), 'cashierId': rng.randint(2, cashiers + 1),
+            'createdAt': created.isoformat()
+        }
+
+
+def make_expenses(rng, start, days):
+    expense_id = 0
+    for day in range(days):
+        for _ in range(rng.randint(1, 4)):
+            expense_id += 1
+            yield {
+                'id': expense_id, 'description': rng.choice(['Rent', 'Electricity', 'Water', 'Transport', 'Gas']),
+                'category': 'operational', 'amount': rng.randint(200, 20000),
+                'createdAt': (start + timedelta(days=day, hours=rng.randint(7, 20))).isoformat()
+            }
+
+
+def generate(out, products=500, sales=20000, cashiers=10, days=90, seed=1):
+    """Write the dataset into ``out``; returns what was written, as stored in ``bench.meta``."""
+    rng = random.Random(seed)
+    os.makedirs(out, exist_ok=True)
+    start = datetime(2024, 1, 1)
+    now = (start + timedelta(days=days)).isoformat()
+    catalog = make_products(rng, products, now)
+    counts = {
+        'users': write_records(os.path.join(out, 'users.json'), make_users(rng, cashiers, now)),
+        'products': write_records(os.path.join(out, 'products.json'), catalog),
+        'batches': write_records(os.path.join(out, 'batches.json'), make_batches(rng, catalog, start)),
+        'sales': write_records(os.path.join(out, 'sales.json'),
+                               make_sales(rng, sales, catalog, cashiers, start, days)),
+        'expenses': write_records(os.path.join(out, 'expenses.json'), make_expenses(rng, start, days)),
+    }
+    meta = {
+        'seed': seed,
+        'products': products,
+        'sales': sales,
+        'cashiers': cashiers,
+        'days': days,
+        'counts': counts,
+        'generatedAt': datetime.now().isoformat()
+    }
+    with open(os.path.join(out, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic shop data directory for benchmarks')
+    parser.add_argument('--out', required=True, help='Directory to write (must be empty or not exist)')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--products', type=int)
+    parser.add_argument('--sales', type=int)
+    parser.add_argument('--cashiers', type=int)
+    parser.add_argument('--days', type=int, help='Days of sales history')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if os.path.isdir(args.out) and os.listdir(args.out):
+        parser.error(f'{args.out} is not empty')
+    options = {**SCALES[args.scale],
+               **{k: v for k, v in vars(args).items() if k in SCALES['small'] and v is not None}}
+    meta = generate(args.out, seed=args.seed, **options)
+    print(', '.join(f'{count} {name}' for name, count in meta['counts'].items()) + f' written to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Flattened bills of materials for nested recipes.
+
+A recipe line may name another recipe product (a sauce in a dish), so a
+product's real requirements are found by expanding every such line into its
+own recipe, down to products without a recipe. The expansion of each recipe
+product is kept in the ``boms`` collection as ``requirements``: the raw
+products and quantity of each per unit made, in order of first use.
+
+A store hook recomputes the BOMs a transaction can affect: those of every
+product whose dependency graph (``dependsOn``) includes a product whose
+recipe was changed, or that was created or deleted. Stock-only writes such
+as checkouts leave the BOMs alone. A recipe that would make a product
+depend on itself is rejected with ``RecipeCycleError``.
+"""
+
+BOMS = 'boms'
+
+
+class RecipeCycleError(ValueError):
+    pass
+
+
+def flatten(product_id, products, _path=()):
+    """``(requirements, depends_on)`` of one product.
+
+    ``requirements`` maps each raw product id to the quantity needed per
+    unit; ``depends_on`` is every product id reached, including
+    ingredients that don't exist (yet). Missing ingredients are skipped.
+    """
+    requirements, depends_on = {}, set()
+    path = _path + (product_id,)
+    for line in products[product_id].get('recipe') or []:
+        ingredient_id = line['productId']
+        depends_on.add(ingredient_id)
+        if ingredient_id in path:
+            names = [products[i].get('name', str(i)) for i in path[path.index(ingredient_id):] + (ingredient_id,)]
+            raise RecipeCycleError(f"Recipe cycle: {' -> '.join(names)}")
+        ingredient = products.get(ingredient_id)
+        if ingredient is None:
+            continue
+        if ingredient.get('recipe'):
+            nested, nested_depends = flatten(ingredient_id, products, path)
+            depends_on |= nested_depends
+            for raw_id, quantity in nested.items():
+                requirements[raw_id] = requirements.get(raw_id, 0) + quantity * line['quantity']
+        else:
+            requirements[ingredient_id] = requirements.get(ingredient_id, 0) + line['quantity']
+    return requirements, depends_on
+
+
+def bom_record(product_id, products):
+    requirements, depends_on = flatten(product_id, products)
+    return {
+        'id': product_id,
+        'requirements': [{'productId': raw_id, 'quantity': quantity} for raw_id, quantity in requirements.items()],
+        'dependsOn': sorted(depends_on, key=str)
+    }
+
+
+def build_all(products):
+    """BOM records for every recipe product, skipping (and reporting) any caught in a cycle."""
+    by_id = {}
+    for product in products:
+        by_id.setdefault(product.get('id'), product)
+    records = []
+    for product_id, product in by_id.items():
+        if product.get('recipe'):
+            try:
+                records.append(bom_record(product_id, by_id))
+            except RecipeCycleError as e:
+                print(f"No BOM for product {product_id}: {e}")
+    return records
+
+
+def on_commit(txn):
+    """Store hook: recompute the BOMs that this transaction's product writes affect."""
+    changes = txn.changes.get('products')
+    if not changes:
+        return
+    if changes.replaced is not None:
+        txn.replace(BOMS, build_all(changes.replaced))
+        return
+
+    changed = {id for id, product in changes.updated.items()
+               if (txn.old('products', id) or {}).get('recipe') != product.get('recipe')}
+    changed |= {product.get('id') for product in changes.inserted} | set(changes.deleted)
+    if not changed:
+        return
+
+    affected = changed | {bom['id'] for bom in txn.load(BOMS) if changed.intersection(bom['dependsOn'])}
+    products = {}
+    for product in txn.load('products'):
+        products.setdefault(product.get('id'), product)
+    for product_id in affected:
+        product = products.get(product_id)
+        existing = txn.get(BOMS, product_id)
+        if product and product.get('recipe'):
+            record = bom_record(product_id, products)
+            if existing:
+                txn.update(BOMS, product_id, record)
+            else:
+                txn.insert(BOMS, record)
+        elif existing:
+            txn.delete(BOMS, product_id)
+
+
+def install(store):
+    """Register the hook and build the BOMs once if there are none yet."""
+    store.add_hook(on_commit)
+    if store.count(BOMS) == 0:
+        with store.transaction() as txn:
+            records = build_all(txn.load('products'))
+            if records and txn.store.count(BOMS) == 0:
+                txn.replace(BOMS, records)
+
+
+def requirements(store_or_txn, product_id):
+    """Flattened requirement lines of a product, or None if it has no BOM."""
+    bom = store_or_txn.get(BOMS, product_id)
+    return bom['requirements'] if bom else None
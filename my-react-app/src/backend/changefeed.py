@@ -0,0 +1,102 @@
+"""Change versions for delta sync of a collection.
+
+Every write to a tracked collection bumps the collection's version counter
+(kept in the ``sync_versions`` collection) and stamps each written record
+with that value in ``syncVersion``. Deleted records leave a tombstone in
+``<collection>_tombstones``. A client that remembers the last version it saw
+can then ask for just the records created, updated or deleted since.
+
+Both collections are indexed on ``syncVersion`` (see ``tenants.INDEXES``),
+so ``since`` looks up the versions after the client's instead of scanning
+the collection. Tombstones more than ``POS_SYNC_HORIZON`` versions old are
+pruned, a tenth of that at a time; the newest pruned version is kept as the
+feed's horizon, and a client that last synced before it has to resync from
+scratch.
+"""
+import os
+
+VERSIONS = 'sync_versions'
+VERSIONS_ID = 1
+HORIZON = int(os.environ.get('POS_SYNC_HORIZON', 10000))
+PRUNE_EVERY = max(1, HORIZON // 10)
+
+
+class ChangeFeed:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.tombstones = f'{name}_tombstones'
+        self.horizon_key = f'{name}_horizon'
+        store.add_hook(self.on_commit)
+
+    def version(self):
+        counters = self.store.get(VERSIONS, VERSIONS_ID)
+        return counters.get(self.name, 0) if counters else 0
+
+    def horizon(self):
+        """Newest version whose tombstones were pruned; clients older than this must resync."""
+        counters = self.store.get(VERSIONS, VERSIONS_ID)
+        return counters.get(self.horizon_key, 0) if counters else 0
+
+    def on_commit(self, txn):
+        """Store hook: stamp this transaction's writes and record deletions."""
+        changes = txn.changes.get(self.name)
+        if not changes:
+            return
+        counters = txn.get(VERSIONS, VERSIONS_ID)
+        start = version = counters.get(self.name, 0) if counters else 0
+        deleted = set(changes.deleted)
+
+        if changes.replaced is not None:
+            version += 1
+            kept = {r.get('id') for r in changes.replaced}
+            deleted |= {r.get('id') for r in self.store.load(self.name)} - kept
+            changes.replaced = [{**r, 'syncVersion': version} for r in changes.replaced]
+        else:
+            for id, record in changes.updated.items():
+                version += 1
+                changes.updated[id] = {**record, 'syncVersion': version}
+            for i, record in enumerate(changes.inserted):
+                version += 1
+                changes.inserted[i] = {**record, 'syncVersion': version}
+
+        if deleted:
+            tombstone_id = txn.next_id(self.tombstones)
+            for record_id in sorted(deleted, key=str):
+                version += 1
+                txn.insert(self.tombstones, {'id': tombstone_id, 'recordId': record_id, 'syncVersion': version})
+                tombstone_id += 1
+
+        updates = {self.name: version}
+        # Pruning costs a pass over the tombstones, so only when a multiple of PRUNE_EVERY was passed
+        if version // PRUNE_EVERY > start // PRUNE_EVERY:
+            pruned = [t for t in txn.store.load(self.tombstones) if t['syncVersion'] <= version - HORIZON]
+            for tombstone in pruned:
+                txn.delete(self.tombstones, tombstone['id'])
+            if pruned:
+                updates[self.horizon_key] = max(t['syncVersion'] for t in pruned)
+        if counters:
+            txn.update(VERSIONS, VERSIONS_ID, updates)
+        else:
+            txn.insert(VERSIONS, {'id': VERSIONS_ID, **updates})
+
+    def _changed_since(self, name, version, current):
+        if current - version > self.store.count(name):
+            # Further behind than the collection is long: one pass is cheaper than a lookup per version
+            return [r for r in self.store.load(name) if r.get('syncVersion', 0) > version]
+        found = []
+        for v in range(version + 1, current + 1):
+            found += self.store.find(name, 'syncVersion', v)
+        return found
+
+    def since(self, version):
+        """``(current version, records changed since version, ids deleted since version)``.
+
+        Deletions before ``horizon()`` are no longer known.
+        """
+        current = self.version()
+        changed = self._changed_since(self.name, version, current)
+        changed_ids = {r.get('id') for r in changed}
+        deleted = [t['recordId'] for t in self._changed_since(self.tombstones, version, current)
+                   if t['recordId'] not in changed_ids]
+        return current, changed, deleted
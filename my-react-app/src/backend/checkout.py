@@ -0,0 +1,259 @@
+"""Checkout engine behind POST /api/sales.
+
+A checkout resolves every cart line and the raw materials of its flattened
+bill of materials (see ``bom``) against the product index in one pass, adds
+up how much stock the cart consumes per product, and
+then writes the stock changes, the automatic ingredient expenses and the sale
+in a single store transaction.
+
+``run_many`` replays a batch of sales queued by an offline till the same way,
+all in one transaction. Each sale carries a client-generated ``clientId``, so
+replaying a batch twice doesn't record its sales twice, and the time it was
+rung up (``createdAt``).
+
+Stock is costed first in, first out: each line takes its quantity from the
+oldest open batches of the products it consumes (see ``fifo``) and the sale
+records the cost of every line, along with the batches it came from. Stock
+not covered by any batch is costed the way it was before batches existed.
+"""
+import time
+from datetime import datetime
+
+import bom
+from fifo import FifoAllocator
+
+
+class Checkout:
+    """One sale being checked out. ``timings`` holds per-stage milliseconds."""
+
+    def __init__(self, store):
+        self.store = store
+        self.timings = {}
+
+    def _stage(self, name, started):
+        now = time.perf_counter()
+        self.timings[name] = round((now - started) * 1000, 3)
+        return now
+
+    def server_timing(self):
+        """``Server-Timing`` header value for the recorded stages."""
+        return ', '.join(f'{name};dur={ms}' for name, ms in self.timings.items())
+
+    def run(self, data, cashier_id):
+        started = time.perf_counter()
+        with self.store.transaction() as txn:
+            t = self._stage('lock', started)
+            products, boms = self.resolve(txn, data['items'])
+            t = self._stage('resolve', t)
+            stock, ingredient_costs, total_cogs, lines = self.deduct(data['items'], products, boms, FifoAllocator(txn))
+            t = self._stage('deduct', t)
+            sale = self.commit(txn, data, cashier_id, products, stock, ingredient_costs, total_cogs, lines=lines)
+        self._stage('commit', t)
+        self._stage('total', started)
+        return sale
+
+    def run_many(self, sales, cashier_id):
+        """Check out a batch of offline sales; returns one result per sale.
+
+        A result's ``status`` is ``created`` (with ``sale`` and any stock
+        ``shortfalls``), ``duplicate`` (with the existing ``saleId``) or
+        ``error``. Invalid sales are skipped without affecting the rest.
+        """
+        started = time.perf_counter()
+        results = []
+        with self.store.transaction() as txn:
+            t = self._stage('lock', started)
+            seen = {}  # clientId -> sale id, for repeats within the batch
+            allocator = FifoAllocator(txn)
+            for data in sales:
+                results.append(self._replay(txn, data, cashier_id, seen, allocator))
+            t = self._stage('checkout', t)
+        self._stage('commit', t)
+        self._stage('total', started)
+        return results
+
+    def _replay(self, txn, data, cashier_id, seen, allocator):
+        error, created_at = self.validate_offline(data)
+        client_id = data.get('clientId') if isinstance(data, dict) else None
+        if error:
+            return {'clientId': client_id, 'status': 'error', 'error': error}
+
+        if client_id not in seen:
+            # A repeat carries the first try's createdAt, so only that partition needs looking at
+            existing = self.store.find_range('sales', 'clientId', client_id, created_at, created_at)
+            if existing:
+                seen[client_id] = existing[0]['id']
+        if client_id in seen:
+            return {'clientId': client_id, 'status': 'duplicate', 'saleId': seen[client_id]}
+
+        products, boms = self.resolve(txn, data['items'])
+        stock, ingredient_costs, total_cogs, lines = self.deduct(data['items'], products, boms, allocator)
+        sale = self.commit(txn, data, cashier_id, products, stock, ingredient_costs, total_cogs,
+                           lines=lines, created_at=created_at, extra={'clientId': client_id})
+        seen[client_id] = sale['id']
+
+        shortfalls = []
+        for product_id, quantity in stock.items():
+            if quantity < 0:
+                before = products[product_id].get('quantity', 0)
+                shortfalls.append({
+                    'productId': product_id,
+                    'name': products[product_id].get('name'),
+                    'shortBy': min(before - quantity, -quantity)
+                })
+        return {'clientId': client_id, 'status': 'created', 'sale': sale, 'shortfalls': shortfalls}
+
+    @staticmethod
+    def validate_offline(data):
+        """``(error, createdAt)`` for one queued sale; ``error`` is None if it is usable."""
+        if not isinstance(data, dict):
+            return 'Sale must be an object', None
+        if not isinstance(data.get('clientId'), str) or not data['clientId']:
+            return 'clientId is required', None
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            return 'items are required', None
+        for item in items:
+            if (not isinstance(item, dict) or not isinstance(item.get('productId'), int)
+                    or not isinstance(item.get('quantity'), (int, float)) or item['quantity'] <= 0):
+                return 'Each item needs a productId and a positive quantity', None
+        if not isinstance(data.get('total'), (int, float)):
+            return 'total is required', None
+        try:
+            created_at = datetime.fromisoformat(data['createdAt'])
+        except (KeyError, TypeError, ValueError):
+            return 'createdAt must be an ISO timestamp', None
+        if created_at.tzinfo is not None:
+            # Stored timestamps are server local time
+            created_at = created_at.astimezone().replace(tzinfo=None)
+        return None, created_at.isoformat()
+
+    @staticmethod
+    def resolve(txn, items):
+        """``(products, boms)``: every product the cart touches, keyed by id (``None``
+        if it doesn't exist), and the requirement lines of each recipe product sold.
+
+        A recipe product without a stored BOM falls back to its own recipe.
+        """
+        products, boms = {}, {}
+        for item in items:
+            product_id = item['productId']
+            if product_id not in products:
+                products[product_id] = txn.get('products', product_id)
+            product = products[product_id]
+            if product and product.get('recipe') and product_id not in boms:
+                boms[product_id] = bom.requirements(txn, product_id) or product['recipe']
+            for ingredient in boms.get(product_id, ()):
+                if ingredient['productId'] not in products:
+                    products[ingredient['productId']] = txn.get('products', ingredient['productId'])
+        return products, boms
+
+    @staticmethod
+    def consume(allocator, product, quantity, unit_cost):
+        """``(cost, batches)`` of using ``quantity`` of a product.
+
+        Batches are taken oldest first; whatever they don't cover costs
+        ``unit_cost`` a unit.
+        """
+        if allocator is None:
+            return unit_cost * quantity, []
+        taken, uncovered = allocator.take(product['id'], quantity)
+        cost = unit_cost * uncovered
+        batches = []
+        for batch, used in taken:
+            cost += batch.get('buyingPrice', 0) * used
+            batches.append({'batchId': batch['id'], 'quantity': used, 'unitCost': batch.get('buyingPrice', 0)})
+        return cost, batches
+
+    @classmethod
+    def deduct(cls, items, products, boms, allocator=None):
+        """Work out new stock levels, ingredient costs and the sale's COGS.
+
+        Returns ``(stock, ingredient_costs, total_cogs, lines)`` where
+        ``stock`` maps product id to its quantity after the sale,
+        ``ingredient_costs`` maps an expense-only ingredient's id to
+        ``[quantity used, cost]`` and ``lines`` holds the ``cogs`` and
+        ``batches`` of each cart line. Without an ``allocator`` no batches
+        are consumed.
+        """
+        stock = {}
+        ingredient_costs = {}
+        total_cogs = 0
+        lines = []
+
+        for item in items:
+            line = {'cogs': 0, 'batches': []}
+            lines.append(line)
+            product = products.get(item['productId'])
+            if not product:
+                continue
+            quantity_sold = item['quantity']
+
+            if not product.get('recipe'):
+                # Simple product
+                stock[product['id']] = stock.get(product['id'], product.get('quantity', 0)) - quantity_sold
+                cost, batches = cls.consume(allocator, product, quantity_sold, product.get('cost', 0))
+                line['cogs'] += cost
+                line['batches'] += batches
+                total_cogs += cost
+                continue
+
+            # Composite product: consume the raw materials of its flattened recipe
+            for ingredient in boms[product['id']]:
+                raw = products.get(ingredient['productId'])
+                if not raw:
+                    continue
+                qty_needed = ingredient['quantity'] * quantity_sold
+                available = stock.get(raw['id'], raw.get('quantity', 0))
+                stock[raw['id']] = available - qty_needed
+
+                # Without batches, raw product cost is spread over the stock on hand before this line
+                cost, batches = cls.consume(allocator, raw, qty_needed, raw.get('cost', 0) / max(available, 1))
+                line['cogs'] += cost
+                line['batches'] += batches
+                total_cogs += cost
+                if raw.get('expenseOnly'):
+                    used = ingredient_costs.setdefault(raw['id'], [0, 0])
+                    used[0] += qty_needed
+                    used[1] += cost
+
+        return stock, ingredient_costs, total_cogs, lines
+
+    @staticmethod
+    def commit(txn, data, cashier_id, products, stock, ingredient_costs, total_cogs,
+               lines=None, created_at=None, extra=None):
+        now = created_at or datetime.now().isoformat()
+        sale_id = txn.next_id('sales')
+
+        for product_id, quantity in stock.items():
+            txn.update('products', product_id, {'quantity': quantity})
+
+        expense_id = txn.next_id('expenses')
+        expenses = []
+        for product_id, (quantity, cost) in ingredient_costs.items():
+            raw = products[product_id]
+            expenses.append({
+                'id': expense_id + len(expenses),
+                'description': f'Used {quantity} {raw.get("unit", "units")} of {raw["name"]}',
+                'amount': cost,
+                'category': 'ingredient',
+                'automatic': True,
+                'saleId': sale_id,
+                'createdAt': now
+            })
+        if expenses:
+            txn.insert_many('expenses', expenses)
+
+        sale = {
+            'id': sale_id,
+            'items': [{**item, **line} for item, line in zip(data['items'], lines)] if lines else data['items'],
+            'total': data['total'],
+            'cogs': total_cogs,
+            'profit': data['total'] - total_cogs,
+            'paymentMethod': data.get('paymentMethod', 'cash'),
+            'cashierId': cashier_id,
+            'createdAt': now,
+            **(extra or {})
+        }
+        txn.insert('sales', sale)
+        return sale
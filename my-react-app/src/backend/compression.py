@@ -0,0 +1,52 @@
+"""gzip/deflate compression of /api responses.
+
+Responses of at least ``POS_COMPRESS_MIN_BYTES`` are compressed with the
+best encoding the client's ``Accept-Encoding`` allows. Streamed responses
+(SSE, exports, JSON-lines listings), images and anything already encoded
+are sent as they are. Set ``POS_COMPRESS_MIN_BYTES=0`` to turn it off.
+
+A compressed body is a different representation, so its strong ETag is
+downgraded to a weak one; ``If-None-Match`` checks have to compare weakly.
+"""
+import gzip
+import os
+import zlib
+
+from flask import request
+
+MIN_BYTES = int(os.environ.get('POS_COMPRESS_MIN_BYTES', 1024))
+LEVEL = int(os.environ.get('POS_COMPRESS_LEVEL', 6))
+ENCODINGS = ('gzip', 'deflate')
+
+
+def compress(data, encoding, level=LEVEL):
+    if encoding == 'gzip':
+        return gzip.compress(data, level, mtime=0)
+    return zlib.compress(data, level)
+
+
+def compress_response(response):
+    """``after_request`` handler."""
+    if not MIN_BYTES or not request.path.startswith('/api/'):
+        return response
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code in (204, 206, 304) or 'Content-Encoding' in response.headers
+            or (response.mimetype or '').startswith('image/')):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_BYTES:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def install(app):
+    app.after_request(compress_response)
@@ -0,0 +1,211 @@
+"""Change notifications pushed to tills over Server-Sent Events.
+
+A store hook turns every write to products (including the stock deducted by
+a sale) and settings into compact events in the ``events`` collection, so
+every gunicorn worker sees them. Each event is addressed to an audience:
+``all``, ``admin`` or ``cashier``. Cashiers never get events about
+``expenseOnly`` products; a product that becomes expense-only looks deleted to
+them. The newest ``POS_EVENTS_RETAIN`` events are kept; older ones are
+dropped in batches, each time another tenth of that many has been written.
+
+Within a worker one ``EventHub`` thread polls the store for new events and
+hands them to every open stream, so streams only wait on their own queue
+and never poll the store themselves. Run gunicorn with the gevent worker
+(see the Procfile) so each open stream costs a greenlet instead of a thread.
+
+Streams send a heartbeat comment every ``POS_SSE_HEARTBEAT`` seconds and
+close after ``POS_SSE_MAX_SECONDS`` so workers are recycled; the browser then
+reconnects with ``Last-Event-ID`` and gets everything it missed. A ``reset``
+event tells a client that missed more than is retained to reload from
+/api/products/changes and /api/settings.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+EVENTS = 'events'
+RETAIN = int(os.environ.get('POS_EVENTS_RETAIN', 1000))
+TRIM_EVERY = max(1, RETAIN // 10)
+HEARTBEAT_SECONDS = float(os.environ.get('POS_SSE_HEARTBEAT', 15))
+MAX_STREAM_SECONDS = float(os.environ.get('POS_SSE_MAX_SECONDS', 300))
+POLL_SECONDS = 0.5
+RETRY_MS = 3000
+QUEUE_SIZE = 1000
+
+
+def _visible(product):
+    return not product.get('expenseOnly', False)
+
+
+def _product_events(changes, old):
+    """``(type, audience, product)`` for one transaction's product writes."""
+    if changes.replaced is not None:
+        yield 'products.reset', 'all', None
+        return
+    for product in changes.inserted:
+        yield 'product.created', 'all' if _visible(product) else 'admin', product
+    for id, product in changes.updated.items():
+        was, now = _visible(old(id) or {}), _visible(product)
+        if was and now:
+            yield 'product.updated', 'all', product
+        elif not was and not now:
+            yield 'product.updated', 'admin', product
+        else:
+            # Cashiers see the product appear or disappear
+            yield 'product.updated', 'admin', product
+            yield 'product.created' if now else 'product.deleted', 'cashier', product
+    for id in changes.deleted:
+        product = old(id) or {'id': id}
+        yield 'product.deleted', 'all' if _visible(product) else 'admin', product
+
+
+def on_commit(txn):
+    """Store hook: record this transaction's product and settings changes as events."""
+    found = []
+    if 'products' in txn.changes:
+        found += _product_events(txn.changes['products'], lambda id: txn.old('products', id))
+    if 'settings' in txn.changes:
+        found.append(('settings.updated', 'all', None))
+    if not found:
+        return
+
+    event_id = txn.next_id(EVENTS)
+    for type, audience, product in found:
+        data = {}
+        if product is not None:
+            data['productId'] = product.get('id')
+            if type != 'product.deleted':
+                data['syncVersion'] = product.get('syncVersion')
+                data['quantity'] = product.get('quantity')
+        txn.insert(EVENTS, {'id': event_id, 'type': type, 'audience': audience, 'data': data})
+        event_id += 1
+
+    # Trimming costs a pass over the events, so only when a multiple of TRIM_EVERY was passed
+    first, last = event_id - len(found), event_id - 1
+    if last // TRIM_EVERY > (first - 1) // TRIM_EVERY:
+        for event in txn.store.load(EVENTS):
+            if event['id'] <= last - RETAIN:
+                txn.delete(EVENTS, event['id'])
+
+
+def install(store):
+    store.add_hook(on_commit)
+
+
+def audiences(role):
+    return {'all', 'cashier'} if role == 'cashier' else {'all', 'admin'}
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+class EventHub:
+    """Per-worker fan-out of new events to open streams.
+
+    The polling thread starts with the first subscriber and only runs
+    while there are subscribers.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = 0
+
+    def latest_id(self):
+        return self.store.next_id(EVENTS) - 1
+
+    def subscribe(self):
+        subscriber = queue.Queue(QUEUE_SIZE)
+        with self._lock:
+            if not self._subscribers:
+                self._last_id = self.latest_id()
+            self._subscribers.add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-hub', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _run(self):
+        while True:
+            time.sleep(POLL_SECONDS)
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                self._poll()
+            except Exception:
+                pass  # A store error must not kill the hub; try again next round
+
+    def _poll(self):
+        latest = self.latest_id()
+        if latest == self._last_id:
+            return
+        if latest < self._last_id:
+            # Events were restored from an older copy of the data
+            fresh = [{'id': latest, 'type': 'reset', 'data': {}}]
+        else:
+            fresh = [e for e in (self.store.get(EVENTS, id) for id in range(self._last_id + 1, latest + 1)) if e]
+        self._last_id = latest
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            for event in fresh:
+                try:
+                    subscriber.put_nowait(event)
+                except queue.Full:
+                    # Too slow to keep up: the stream ends once drained and the
+                    # client resumes from Last-Event-ID
+                    self.unsubscribe(subscriber)
+                    break
+
+    def backlog(self, last_id):
+        """Events after ``last_id``, or a single reset event if some are no longer kept."""
+        latest = self.latest_id()
+        if last_id > latest or (last_id < latest and self.store.get(EVENTS, last_id + 1) is None):
+            return [{'id': latest, 'type': 'reset', 'data': {}}]
+        return [e for e in (self.store.get(EVENTS, id) for id in range(last_id + 1, latest + 1)) if e]
+
+    def stream(self, role, last_id=None):
+        """Generate the SSE stream for one client."""
+        wanted = audiences(role)
+        subscriber = self.subscribe()
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            sent = self.latest_id() if last_id is None else last_id
+            if last_id is not None:
+                for event in self.backlog(last_id):
+                    if event['type'] == 'reset' or event.get('audience') in wanted:
+                        yield format_event(event)
+                    sent = event['id']
+
+            deadline = time.monotonic() + MAX_STREAM_SECONDS
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event = subscriber.get(timeout=min(HEARTBEAT_SECONDS, remaining))
+                except queue.Empty:
+                    if subscriber not in self._subscribers:
+                        return
+                    yield ': ping\n\n'
+                    continue
+                if event['type'] == 'reset':
+                    yield format_event(event)
+                    sent = event['id']
+                elif event['id'] > sent:
+                    if event.get('audience') in wanted:
+                        yield format_event(event)
+                    sent = event['id']
+        finally:
+            self.unsubscribe(subscriber)
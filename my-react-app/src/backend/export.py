@@ -0,0 +1,115 @@
+"""CSV and JSON-lines exports of sales, expenses and inventory.
+
+Rows are generated straight from ``Storage.iter_range``, so an export is
+written as it is read: the JSON engine holds one partition of a
+partitioned collection at a time and SQLite one row. Sales are flattened
+into one row per cart line, repeating the sale's own fields on each.
+Both formats carry the same columns.
+
+The same exports run offline against a data directory, without the API::
+
+    python export.py sales --from 2025-01-01 --to 2025-12-31 > sales.csv
+    python export.py expenses --tenant 2 --format jsonl --archived -o expenses.jsonl
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+
+import tenants
+
+FORMATS = ('csv', 'jsonl')
+MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+# Rows buffered per chunk of CSV output
+CHUNK_ROWS = 500
+
+SALE_COLUMNS = ['saleId', 'createdAt', 'cashierId', 'paymentMethod', 'clientId', 'saleTotal', 'saleCogs',
+                'productId', 'quantity', 'price', 'lineCogs']
+COLUMNS = {
+    'sales': SALE_COLUMNS,
+    'expenses': ['id', 'createdAt', 'description', 'category', 'amount', 'automatic', 'saleId'],
+    'products': ['id', 'name', 'category', 'unit', 'quantity', 'cost', 'price', 'expenseOnly', 'createdAt'],
+    'batches': ['id', 'productId', 'batchCode', 'type', 'quantity', 'remaining', 'buyingPrice', 'sellingPrice',
+                'createdAt'],
+}
+
+
+def sale_rows(sale):
+    """One row per cart line of a sale."""
+    shared = {
+        'saleId': sale.get('id'),
+        'createdAt': sale.get('createdAt'),
+        'cashierId': sale.get('cashierId'),
+        'paymentMethod': sale.get('paymentMethod'),
+        'clientId': sale.get('clientId'),
+        'saleTotal': sale.get('total'),
+        'saleCogs': sale.get('cogs'),
+    }
+    for item in sale.get('items') or []:
+        yield {
+            **shared,
+            'productId': item.get('productId'),
+            'quantity': item.get('quantity'),
+            'price': item.get('price'),
+            'lineCogs': item.get('cogs'),
+        }
+
+
+def rows(store, collection, since=None, until=None, archived=False):
+    columns = COLUMNS[collection]
+    for record in store.iter_range(collection, since, until, archived):
+        if collection == 'sales':
+            yield from sale_rows(record)
+        else:
+            yield {column: record.get(column) for column in columns}
+
+
+def generate(store, collection, fmt='csv', since=None, until=None, archived=False):
+    """The export as a stream of text chunks."""
+    records = rows(store, collection, since, until, archived)
+    if fmt == 'jsonl':
+        for row in records:
+            yield json.dumps(row) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, COLUMNS[collection], extrasaction='ignore')
+    writer.writeheader()
+    for n, row in enumerate(records, 1):
+        writer.writerow(row)
+        if n % CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export POS data as CSV or JSON lines')
+    parser.add_argument('collection', choices=sorted(COLUMNS))
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--from', dest='since', help='ISO date or timestamp')
+    parser.add_argument('--to', dest='until', help='ISO date or timestamp, inclusive')
+    parser.add_argument('--archived', action='store_true', help='Include partitions moved to data/archive')
+    parser.add_argument('--data-dir', default=tenants.DATA_DIR, help='Defaults to POS_DATA_DIR or src/backend/data')
+    parser.add_argument('--tenant', type=int, default=1, help='Id of the shop to export')
+    parser.add_argument('-o', '--output', help='File to write (defaults to stdout)')
+    args = parser.parse_args()
+
+    directory = tenants.directory(args.data_dir, args.tenant)
+    if not os.path.isdir(directory):
+        parser.error(f'No shop {args.tenant} in {args.data_dir}')
+    store = tenants.open_shop_storage(directory, ())
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        for chunk in generate(store, args.collection, args.format, args.since, args.until, args.archived):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""First-in, first-out consumption of stock batches.
+
+Every product with open batches (``remaining`` above zero) has a record in
+``batch_queues`` listing them oldest first as ``[createdAt, batch id]``
+pairs. A store hook keeps the queues in step with every batch write:
+opened batches are inserted in order, used-up or deleted ones removed, so
+nothing ever re-sorts a product's batches.
+
+``FifoAllocator`` takes stock from the front of those queues for
+production and checkout, touching only the batches it actually consumes.
+"""
+import bisect
+from collections import deque
+
+QUEUES = 'batch_queues'
+
+
+def _is_open(batch):
+    return batch is not None and batch.get('remaining', 0) > 0
+
+
+def _entry(batch):
+    return [batch.get('createdAt', ''), batch['id']]
+
+
+def build_all(batches):
+    """Queue records for every product with open batches."""
+    queues = {}
+    for batch in batches:
+        if _is_open(batch):
+            queues.setdefault(batch['productId'], []).append(_entry(batch))
+    return [{'id': product_id, 'open': sorted(entries)} for product_id, entries in queues.items()]
+
+
+def on_commit(txn):
+    """Store hook: move the batches this transaction opened, used up or deleted in their queues."""
+    changes = txn.changes.get('batches')
+    if not changes:
+        return
+    if changes.replaced is not None:
+        txn.replace(QUEUES, build_all(changes.replaced))
+        return
+
+    removed, added = {}, {}  # product id -> queue entries
+    pairs = [(txn.old('batches', id), batch) for id, batch in changes.updated.items()]
+    pairs += [(None, batch) for batch in changes.inserted]
+    pairs += [(txn.old('batches', id), None) for id in changes.deleted]
+    for old, new in pairs:
+        was_open, now_open = _is_open(old), _is_open(new)
+        if was_open and now_open and _entry(old) == _entry(new) and old['productId'] == new['productId']:
+            continue
+        if was_open:
+            removed.setdefault(old['productId'], []).append(_entry(old))
+        if now_open:
+            added.setdefault(new['productId'], []).append(_entry(new))
+
+    for product_id in removed.keys() | added.keys():
+        record = txn.get(QUEUES, product_id)
+        entries = list(record['open']) if record else []
+        for entry in removed.get(product_id, ()):
+            # Consumed batches sit at the front, so this finds them straight away
+            if entry in entries:
+                entries.remove(entry)
+        for entry in added.get(product_id, ()):
+            bisect.insort(entries, entry)
+        if record and entries:
+            txn.update(QUEUES, product_id, {'open': entries})
+        elif record:
+            txn.delete(QUEUES, product_id)
+        elif entries:
+            txn.insert(QUEUES, {'id': product_id, 'open': entries})
+
+
+def install(store):
+    """Register the hook and build the queues once if there are none yet."""
+    store.add_hook(on_commit)
+    if store.count(QUEUES) == 0:
+        with store.transaction() as txn:
+            records = build_all(txn.load('batches'))
+            if records and txn.store.count(QUEUES) == 0:
+                txn.replace(QUEUES, records)
+
+
+class FifoAllocator:
+    """Takes stock from open batches, oldest first, inside one transaction.
+
+    Keep one allocator per transaction so successive takes (several cart
+    lines, or every sale of a bulk upload) continue where the last one
+    stopped.
+    """
+
+    def __init__(self, txn):
+        self.txn = txn
+        self._queues = {}  # product id -> batch ids not yet used up in this transaction
+
+    def _queue(self, product_id):
+        if product_id not in self._queues:
+            record = self.txn.get(QUEUES, product_id)
+            self._queues[product_id] = deque(batch_id for _, batch_id in record['open']) if record else deque()
+        return self._queues[product_id]
+
+    def take(self, product_id, quantity):
+        """Consume up to ``quantity``; returns ``([(batch, quantity taken)], quantity left uncovered)``."""
+        queue = self._queue(product_id)
+        taken = []
+        while quantity > 0 and queue:
+            batch = self.txn.get('batches', queue[0])
+            available = batch.get('remaining', 0) if batch else 0
+            if available <= 0:
+                queue.popleft()
+                continue
+            used = min(available, quantity)
+            self.txn.update('batches', batch['id'], {'remaining': available - used})
+            taken.append((batch, used))
+            quantity -= used
+            if used == available:
+                queue.popleft()
+        return taken, quantity
@@ -0,0 +1,224 @@
+"""Content-addressed storage for product images.
+
+Uploaded images (base64 data URLs, as the admin screens send them) are
+decoded and written once to ``data/images/<aa>/<sha256>``, named by the
+hash of their bytes, so an image is stored once however many products
+use it and a URL never changes meaning. When Pillow is installed, a
+thumbnail is written next to it for each of ``POS_THUMBNAIL_SIZES``
+(``<hash>_<size>``). Without Pillow the original is served for every size.
+
+Products keep only ``imageHash``; the image itself is served from
+/api/images/<hash> with a year-long immutable cache lifetime. ``migrate``
+moves inline images still stored in product records out into the store.
+Each shop does so when it opens; to do it for every shop, or one, with
+the app stopped::
+
+    python images.py migrate
+    python images.py migrate --tenant 2
+"""
+import argparse
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional: no thumbnails
+    Image = None
+
+MAX_BYTES = int(os.environ.get('POS_IMAGE_MAX_BYTES', 5 * 1024 * 1024))
+THUMBNAIL_SIZES = tuple(int(s) for s in os.environ.get('POS_THUMBNAIL_SIZES', '64,256').split(',') if s.strip())
+CACHE_SECONDS = 365 * 24 * 3600
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+URL_RE = re.compile(r'^(?:.*/)?api/images/([0-9a-f]{64})(?:\?.*)?$')
+DATA_URL_RE = re.compile(r'^data:([\w/+.-]*)(;base64)?,', re.IGNORECASE)
+
+# Leading bytes of the formats we accept
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+class ImageError(ValueError):
+    pass
+
+
+class ImageTooLarge(ImageError):
+    pass
+
+
+def sniff(data):
+    """The image type of ``data`` from its leading bytes, or None."""
+    for signature, mimetype in SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def decode_data_url(value):
+    """Bytes of a base64 ``data:`` URL (or bare base64); raises ``ImageError``."""
+    match = DATA_URL_RE.match(value)
+    payload = value[match.end():] if match else value
+    if len(payload) * 3 // 4 > MAX_BYTES:
+        raise ImageTooLarge(f'Images are limited to {MAX_BYTES} bytes')
+    try:
+        return base64.b64decode(payload, validate=False)
+    except (binascii.Error, ValueError):
+        raise ImageError('Image is not valid base64')
+
+
+def is_data_url(value):
+    return isinstance(value, str) and value[:5].lower() == 'data:'
+
+
+class ImageStore:
+    def __init__(self, directory, sizes=THUMBNAIL_SIZES):
+        self.directory = directory
+        self.sizes = sizes
+
+    def path(self, digest, size=None):
+        name = digest if size is None else f'{digest}_{size}'
+        return os.path.join(self.directory, digest[:2], name)
+
+    def put(self, data):
+        """Store image bytes (and thumbnails); returns the content hash."""
+        if len(data) > MAX_BYTES:
+            raise ImageTooLarge(f'Images are limited to {MAX_BYTES} bytes')
+        if sniff(data) is None:
+            raise ImageError('Only JPEG, PNG, GIF and WebP images are accepted')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write(path, data)
+            self._thumbnails(digest, data)
+        return digest
+
+    def put_data_url(self, value):
+        return self.put(decode_data_url(value))
+
+    def _write(self, path, data):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _thumbnails(self, digest, data):
+        if Image is None:
+            return
+        try:
+            original = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+            keep_format = original.format in ('PNG', 'GIF') or 'A' in original.getbands()
+            for size in self.sizes:
+                thumb = original.copy()
+                thumb.thumbnail((size, size))
+                out = io.BytesIO()
+                if keep_format:
+                    thumb.save(out, 'PNG', optimize=True)
+                else:
+                    thumb.convert('RGB').save(out, 'JPEG', quality=85, optimize=True)
+                self._write(self.path(digest, size), out.getvalue())
+        except (OSError, ValueError) as e:
+            # Corrupt or unsupported image data: serve the original for every size
+            print(f"No thumbnails for image {digest}: {e}")
+
+    def find(self, digest, size=None):
+        """``(path, mimetype)`` of an image or the closest thumbnail at least ``size`` wide, or None."""
+        if not HASH_RE.match(digest or ''):
+            return None
+        path = self.path(digest)
+        if size is not None:
+            for candidate in sorted(s for s in self.sizes if s >= size):
+                if os.path.exists(self.path(digest, candidate)):
+                    path = self.path(digest, candidate)
+                    break
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(16)
+        except FileNotFoundError:
+            return None
+        return path, sniff(head) or 'application/octet-stream'
+
+
+def image_changes(images, value, current=None):
+    """Product fields for an ``image`` value sent by a client.
+
+    A data URL is stored and referenced by ``imageHash``; an /api/images
+    URL is turned back into its hash; any other URL is kept as ``image``
+    and an empty string removes the image. ``None`` changes nothing.
+    Fields of ``current`` (the stored product) that no longer apply are
+    set to None, as updates can't remove keys.
+    """
+    if value is None:
+        return {}
+    match = URL_RE.match(value) if isinstance(value, str) else None
+    if is_data_url(value):
+        changes = {'imageHash': images.put_data_url(value)}
+    elif match:
+        changes = {'imageHash': match.group(1)}
+    elif value:
+        changes = {'image': value}
+    else:
+        changes = {}
+    for field in ('image', 'imageHash'):
+        if field not in changes and (current or {}).get(field) is not None:
+            changes[field] = None
+    return changes
+
+
+def migrate(store, images):
+    """Move inline data URL images out of product records; returns how many moved.
+
+    Run with the app's hooks installed so tills see the change (it is one
+    ``products.reset``).
+    """
+    with store.transaction() as txn:
+        products = txn.load('products')
+        migrated, moved = [], 0
+        for product in products:
+            if is_data_url(product.get('image')):
+                try:
+                    digest = images.put_data_url(product['image'])
+                except ImageError as e:
+                    print(f"Left the image of product {product.get('id')} inline: {e}")
+                    migrated.append(product)
+                    continue
+                migrated.append({**{k: v for k, v in product.items() if k != 'image'}, 'imageHash': digest})
+                moved += 1
+            else:
+                migrated.append(product)
+        if moved:
+            txn.replace('products', migrated)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Product image store maintenance')
+    sub = parser.add_subparsers(dest='command', required=True)
+    mig = sub.add_parser('migrate', help='Move inline product images into data/images (run with the app stopped)')
+    mig.add_argument('--data-dir', default=None, help='Defaults to POS_DATA_DIR or src/backend/data')
+    mig.add_argument('--tenant', type=int, help='Id of the shop to migrate (defaults to every shop)')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        import tenants  # Imports this module, so not at the top
+        args.data_dir = args.data_dir or tenants.DATA_DIR
+        image_store = ImageStore(os.path.join(args.data_dir, 'images'))
+        for tenant_id in tenants.shop_ids(parser, args):
+            # Opening a shop installs its hooks and then migrates, as on its first request in the app
+            tenant = tenants.Tenant(tenant_id, tenants.directory(args.data_dir, tenant_id), image_store)
+            left = sum(is_data_url(p.get('image')) for p in tenant.store.load('products'))
+            print(f'Shop {tenant_id}: inline images left: {left}')
+
+
+if __name__ == '__main__':
+    main()
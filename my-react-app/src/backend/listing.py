@@ -0,0 +1,82 @@
+"""Server-side filtering, cursor pagination and streaming for list endpoints.
+
+Query parameters understood by ``list_response``:
+
+* ``from`` / ``to``: keep records whose date field falls in the range. Both
+  accept a date (``2025-12-01``, ``to`` inclusive of that whole day) or a full
+  ISO timestamp.
+* any field passed in ``filters`` (e.g. ``cashierId``), matched exactly.
+* ``limit`` / ``cursor``: return at most ``limit`` records (capped at
+  ``MAX_LIMIT`` unless streaming). When more remain, the ``X-Next-Cursor``
+  response header holds the cursor for the next page.
+* ``format=jsonl`` (or ``Accept: application/x-ndjson``): stream one JSON
+  record per line with chunked encoding instead of building one JSON array.
+
+Without any of these the endpoint returns the whole collection as before.
+"""
+import json
+from itertools import islice
+
+from flask import Response, jsonify, request, stream_with_context
+
+from storage import in_range
+
+MAX_LIMIT = 1000
+NDJSON = 'application/x-ndjson'
+
+
+def wants_stream():
+    return request.args.get('format') == 'jsonl' or request.accept_mimetypes.best == NDJSON
+
+
+def stream_jsonl(records):
+    def generate():
+        for record in records:
+            yield json.dumps(record) + '\n'
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+
+def list_response(records, date_field='createdAt', filters=None):
+    """Filter, paginate and serialise ``records`` according to the query string.
+
+    ``filters`` maps query parameter names to the type their values are
+    converted to before comparing with the record field of the same name.
+    """
+    args = request.args
+    since, until = args.get('from'), args.get('to')
+    wanted = {}
+    for field, type_ in (filters or {}).items():
+        if field in args:
+            value = args.get(field, type=type_)
+            if value is None:
+                return jsonify({'error': f'Invalid {field}'}), 400
+            wanted[field] = value
+
+    limit = args.get('limit', type=int)
+    offset = args.get('cursor', 0, type=int)
+    if ('limit' in args and (limit is None or limit < 1)) or ('cursor' in args and offset < 0):
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+
+    def select():
+        # Yields (position, record) so the cursor can point past the last one returned
+        for position in range(offset, len(records)):
+            record = records[position]
+            if (since or until) and not in_range(record.get(date_field, ''), since, until):
+                continue
+            if any(record.get(field) != value for field, value in wanted.items()):
+                continue
+            yield position, record
+
+    if wants_stream():
+        selected = select() if limit is None else islice(select(), limit)
+        return stream_jsonl(record for _, record in selected)
+
+    if limit is None:
+        return jsonify([record for _, record in select()])
+
+    limit = min(limit, MAX_LIMIT)
+    page = list(islice(select(), limit + 1))
+    response = jsonify([record for _, record in page[:limit]])
+    if len(page) > limit:
+        response.headers['X-Next-Cursor'] = str(page[limit - 1][0] + 1)
+    return response
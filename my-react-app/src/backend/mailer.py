@@ -0,0 +1,201 @@
+"""Outbound email queue.
+
+Queued emails are records in the ``emails`` collection, so the queue
+survives restarts: ``queue_emails`` inserts them with status ``queued``
+and returns at once. Every process runs ``POS_MAIL_WORKERS`` worker
+threads. A worker claims up to ``POS_MAIL_BATCH`` due emails in one
+transaction (status ``sending``), which keeps workers in other processes
+off them, and sends the batch over its own SMTP connection. The
+connection stays open for the next batch until the queue runs dry.
+
+Each email ends up ``sent`` (with ``sentAt``) or, after a temporary
+failure, ``queued`` again with ``nextAttemptAt`` pushed back
+exponentially from ``POS_MAIL_BACKOFF`` seconds. It becomes ``failed``
+once the server rejects it outright or ``POS_MAIL_MAX_ATTEMPTS`` tries
+are used up. Emails left ``sending`` by a worker that died are queued
+again after ``CLAIM_TIMEOUT`` seconds.
+
+Delivery goes to ``SMTP_HOST``:``SMTP_PORT``, optionally with STARTTLS
+and a login. Without ``SMTP_HOST`` no workers run and emails stay queued.
+For local testing, point it at the stand-in server in ``smtp_sink.py``.
+"""
+import os
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.utils import formataddr
+
+EMAILS = 'emails'
+SMTP_HOST = os.environ.get('SMTP_HOST', '')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 25))
+SMTP_USER = os.environ.get('SMTP_USER', '')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '').lower() in ('1', 'true', 'yes')
+SENDER = os.environ.get('SMTP_SENDER', 'POS <noreply@localhost>')
+WORKERS = int(os.environ.get('POS_MAIL_WORKERS', 2))
+BATCH = int(os.environ.get('POS_MAIL_BATCH', 50))
+MAX_ATTEMPTS = int(os.environ.get('POS_MAIL_MAX_ATTEMPTS', 5))
+BACKOFF_SECONDS = float(os.environ.get('POS_MAIL_BACKOFF', 30))
+POLL_SECONDS = 5
+CLAIM_TIMEOUT = 600
+SMTP_TIMEOUT = 30
+
+
+def queue_emails(store, users, subject, message):
+    """Queue one email per user record; returns the records."""
+    now = datetime.now().isoformat()
+    with store.transaction() as txn:
+        email_id = txn.next_id(EMAILS)
+        emails = [{
+            'id': email_id + i,
+            'userId': user['id'],
+            'userEmail': user['email'],
+            'userName': user.get('name', ''),
+            'subject': subject,
+            'message': message,
+            'status': 'queued',
+            'attempts': 0,
+            'createdAt': now,
+            'nextAttemptAt': now
+        } for i, user in enumerate(users)]
+        if emails:
+            txn.insert_many(EMAILS, emails)
+    return emails
+
+
+def build_message(email):
+    msg = EmailMessage()
+    msg['From'] = SENDER
+    msg['To'] = formataddr((email.get('userName') or '', email['userEmail']))
+    msg['Subject'] = email.get('subject', '')
+    msg.set_content(email.get('message', ''))
+    return msg
+
+
+def _permanent(error):
+    """Whether retrying can't help: the server refused the recipient or message for good."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+class Mailer:
+    def __init__(self, store, workers=WORKERS, batch=BATCH):
+        self.store = store
+        self.workers = workers
+        self.batch = batch
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the worker threads, if an SMTP host is configured."""
+        if not SMTP_HOST or self._threads:
+            return
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'mailer-{n}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        """Tell idle workers there is new mail, instead of waiting for the next poll."""
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def claim(self):
+        """Mark up to ``batch`` due emails as ``sending`` and return them."""
+        now = datetime.now()
+        stale = (now - timedelta(seconds=CLAIM_TIMEOUT)).isoformat()
+        with self.store.transaction() as txn:
+            # Writers are serialised, so nobody else can claim these before we commit
+            due = [e for e in self.store.find(EMAILS, 'status', 'queued')
+                   if e.get('nextAttemptAt', '') <= now.isoformat()]
+            due += [e for e in self.store.find(EMAILS, 'status', 'sending') if e.get('claimedAt', '') < stale]
+            due.sort(key=lambda e: e['id'])
+            claimed = []
+            for email in due[:self.batch]:
+                claimed.append(txn.update(EMAILS, email['id'], {'status': 'sending', 'claimedAt': now.isoformat()}))
+        return claimed
+
+    def deliver(self, smtp, emails):
+        """Send a batch over ``smtp``; returns ``(results, smtp)`` where results maps id to an error or None.
+
+        A dropped connection is reopened once per batch.
+        """
+        results = {}
+        for email in emails:
+            try:
+                if smtp is None:
+                    smtp = self.connect()
+                try:
+                    smtp.send_message(build_message(email))
+                except smtplib.SMTPServerDisconnected:
+                    smtp = self.connect()
+                    smtp.send_message(build_message(email))
+                results[email['id']] = None
+            except (smtplib.SMTPException, OSError) as e:
+                results[email['id']] = e
+                if not isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+                    smtp = self.close(smtp)
+        return results, smtp
+
+    def record(self, emails, results):
+        """Store each email's new status."""
+        now = datetime.now()
+        with self.store.transaction() as txn:
+            for email in emails:
+                error = results[email['id']]
+                attempts = email.get('attempts', 0) + 1
+                if error is None:
+                    changes = {'status': 'sent', 'sentAt': now.isoformat(), 'attempts': attempts}
+                elif _permanent(error) or attempts >= MAX_ATTEMPTS:
+                    changes = {'status': 'failed', 'lastError': str(error), 'attempts': attempts}
+                else:
+                    delay = BACKOFF_SECONDS * 2 ** (attempts - 1)
+                    changes = {
+                        'status': 'queued',
+                        'lastError': str(error),
+                        'attempts': attempts,
+                        'nextAttemptAt': (now + timedelta(seconds=delay)).isoformat()
+                    }
+                txn.update(EMAILS, email['id'], changes)
+
+    @staticmethod
+    def connect():
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_STARTTLS:
+            smtp.starttls()
+        if SMTP_USER:
+            smtp.login(SMTP_USER, SMTP_PASSWORD)
+        return smtp
+
+    @staticmethod
+    def close(smtp):
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+        return None
+
+    def _run(self):
+        smtp = None
+        while not self._stop.is_set():
+            try:
+                emails = self.claim()
+                if emails:
+                    results, smtp = self.deliver(smtp, emails)
+                    self.record(emails, results)
+                    continue
+            except Exception as e:
+                # Keep the worker alive; claimed emails are requeued after CLAIM_TIMEOUT
+                print(f"Mail worker failed: {e}")
+            # Queue is empty (or failing): release the connection and wait
+            smtp = self.close(smtp)
+            self._wake.wait(POLL_SECONDS)
+            self._wake.clear()
+        self.close(smtp)
@@ -0,0 +1,191 @@
+"""Request, storage and auth metrics in the Prometheus text format.
+
+``install(app)`` times every request and counts it per route (the URL
+rule, so ``/api/products/<int:id>`` is one series) and status. It also
+has the storage engines report each read and write of collection data on
+disk, so the time and bytes per collection are counted. With the JSON
+engine those reads are the cache misses; SQLite reports every query.
+``JWT_VERIFY`` times token verification. ``render(stores)`` adds the
+collection sizes and cache hit counts at scrape time, for the
+``/metrics`` route, summed over the stores (the account store and each
+shop's) so the series don't multiply with the number of shops.
+
+Recording one observation takes a bisect and a short lock, a few
+microseconds per request, so the metrics stay on under load. Each
+gunicorn worker keeps its own numbers: a scrape sees the worker that
+answered it. ``pos_process_start_time_seconds`` tells those series apart
+and shows restarts.
+
+With ``POS_SLOW_REQUEST_MS`` set, requests slower than that are logged
+with the storage I/O they did.
+"""
+import bisect
+import os
+import threading
+import time
+
+from flask import request
+
+import storage
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SLOW_REQUEST_MS = float(os.environ.get('POS_SLOW_REQUEST_MS', 0))
+# Upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+IO_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+JWT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01)
+START_TIME = time.time()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [per-bucket counts (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = sorted((k, (list(counts), total)) for k, (counts, total) in self._series.items())
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{_labels(self.labels, label_values, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, label_values)} {total}'
+            yield f'{self.name}_count{_labels(self.labels, label_values)} {cumulative}'
+
+
+REQUEST_SECONDS = Histogram('pos_http_request_duration_seconds', 'Time to build the response, per route.',
+                            ('route', 'method'))
+REQUESTS = Counter('pos_http_requests_total', 'Requests handled, per route and status.', ('route', 'method', 'status'))
+IO_SECONDS = Histogram('pos_storage_io_duration_seconds', 'Time spent reading or writing collection data on disk.',
+                       ('collection', 'op'), IO_BUCKETS)
+IO_BYTES = Counter('pos_storage_io_bytes_total', 'Bytes of collection data read from or written to disk.',
+                   ('collection', 'op'))
+JWT_VERIFY = Histogram('pos_jwt_verify_duration_seconds', 'Time to verify a request token (cache hits included).',
+                       (), JWT_BUCKETS)
+METRICS = [REQUEST_SECONDS, REQUESTS, IO_SECONDS, IO_BYTES, JWT_VERIFY]
+
+# Start time and storage I/O of the request the current thread is handling
+_request_io = threading.local()
+
+
+def observe_io(op, collection, seconds, nbytes):
+    IO_SECONDS.observe(seconds, collection, op)
+    IO_BYTES.inc(nbytes, collection, op)
+    totals = getattr(_request_io, 'totals', None)
+    if totals is not None:
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += nbytes
+
+
+def _before_request():
+    _request_io.started = time.perf_counter()
+    _request_io.totals = [0, 0.0, 0]
+
+
+def _after_request(response):
+    started = getattr(_request_io, 'started', None)
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    ops, io_seconds, io_bytes = _request_io.totals
+    _request_io.started = _request_io.totals = None
+    req = request._get_current_object()  # One context lookup instead of one per attribute
+    route = req.url_rule.rule if req.url_rule else '<unmatched>'
+    REQUEST_SECONDS.observe(seconds, route, req.method)
+    REQUESTS.inc(1, route, req.method, str(response.status_code))
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        print(f"Slow request: {req.method} {req.full_path.rstrip('?')} {response.status_code} "
+              f"{seconds * 1000:.1f}ms, storage {io_seconds * 1000:.1f}ms in {ops} reads/writes ({io_bytes} bytes)")
+    return response
+
+
+def install(app):
+    """Time every request of ``app`` and record storage I/O.
+
+    Install before other ``after_request`` handlers (such as compression)
+    so their time is counted too: Flask runs them in reverse order.
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    storage.io_observer = observe_io
+
+
+def render(stores):
+    """All metrics as Prometheus text, with collection sizes and cache counters summed over ``stores``."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    records, cache = {}, {}
+    for store in stores:
+        for name in store.collections:
+            records[name] = records.get(name, 0) + store.count(name)
+        for name, counts in store.cache_stats().items():
+            totals = cache.setdefault(name, {'hits': 0, 'misses': 0})
+            totals['hits'] += counts['hits']
+            totals['misses'] += counts['misses']
+
+    lines += ['# HELP pos_collection_records Records in each collection.', '# TYPE pos_collection_records gauge']
+    for name, count in sorted(records.items()):
+        lines.append(f'pos_collection_records{_labels(("collection",), (name,))} {count}')
+
+    for kind, help in (('hits', 'Collection reads served from the in-process cache.'),
+                       ('misses', 'Collection reads that reloaded the collection from disk.')):
+        lines += [f'# HELP pos_storage_cache_{kind}_total {help}', f'# TYPE pos_storage_cache_{kind}_total counter']
+        for name, counts in sorted(cache.items()):
+            lines.append(f'pos_storage_cache_{kind}_total{_labels(("collection",), (name,))} {counts[kind]}')
+
+    lines += ['# HELP pos_process_start_time_seconds Start time of this worker since the epoch.',
+              '# TYPE pos_process_start_time_seconds gauge',
+              f'pos_process_start_time_seconds {START_TIME}']
+    return '\n'.join(lines) + '\n'
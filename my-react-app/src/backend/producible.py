@@ -0,0 +1,81 @@
+"""How many units of each recipe product the current stock can make.
+
+All recipe products are computed together: the catalog's stock becomes one
+vector and the flattened recipes (see ``bom``) one sparse matrix in
+coordinate form (a row, column and needed quantity per raw material line),
+so every line is
+divided out and every recipe's minimum is taken in a handful of NumPy
+operations. The result is cached until the products collection changes.
+"""
+import numpy as np
+
+import bom
+
+
+def compute(products, boms=None):
+    """``{product id: (max units, limiting ingredient name)}`` for every product with a recipe.
+
+    ``boms`` maps a product id to its flattened requirement lines, used
+    instead of the product's own recipe when present. Ingredients that no
+    longer exist are ignored and an ingredient needed in a quantity of zero
+    or less allows no units, as in the per-product calculation this
+    replaces.
+    """
+    boms = boms or {}
+    column = {}
+    for i, product in enumerate(products):
+        column.setdefault(product.get('id'), i)
+    stock = np.array([product.get('quantity') or 0 for product in products], dtype=float)
+
+    recipe_products = [product for product in products if product.get('recipe')]
+    rows, cols, needed = [], [], []
+    for row, product in enumerate(recipe_products):
+        for ingredient in boms.get(product['id']) or product['recipe']:
+            col = column.get(ingredient['productId'])
+            if col is not None:
+                rows.append(row)
+                cols.append(col)
+                needed.append(ingredient['quantity'])
+
+    results = {product['id']: (0, None) for product in recipe_products}
+    if not rows:
+        return results
+    rows, cols, needed = np.array(rows), np.array(cols), np.array(needed, dtype=float)
+
+    possible = np.zeros(len(needed))
+    usable = needed > 0
+    possible[usable] = stock[cols[usable]] / needed[usable]
+
+    # Lines are grouped by recipe row; take each group's minimum and its first line at that minimum
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    lowest = np.minimum.reduceat(possible, starts)
+    group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(rows)]))
+    at_lowest = np.flatnonzero(possible == lowest[group])
+    _, first = np.unique(group[at_lowest], return_index=True)
+    limiting = cols[at_lowest[first]]
+
+    for g, start in enumerate(starts):
+        product = recipe_products[rows[start]]
+        results[product['id']] = (int(lowest[g]), products[limiting[g]]['name'])
+    return results
+
+
+class Producibility:
+    """``compute`` over the store's products, cached per products version."""
+
+    def __init__(self, store):
+        self.store = store
+        self._cached = (None, None)
+
+    def all(self):
+        version = self.store.version('products')
+        cached_version, results = self._cached
+        if results is None or cached_version != version:
+            # BOMs only change together with products, so the products version covers them too
+            boms = {record['id']: record['requirements'] for record in self.store.load(bom.BOMS)}
+            results = compute(self.store.load('products'), boms)
+            self._cached = (version, results)
+        return results
+
+    def get(self, product_id):
+        return self.all().get(product_id, (0, None))
@@ -0,0 +1,171 @@
+"""Opt-in cProfile of single requests.
+
+A request asks to be profiled with ``X-Profile: 1`` (or ``?profile=1``).
+It is profiled when it also carries an admin token, in which case the
+profile starts once ``token_required`` has accepted it, or the
+``X-Profile-Secret`` header matches ``POS_PROFILE_SECRET``. The secret
+lets a till profile its own requests with its cashier token, and the
+profile then covers the whole request, token check included. Anyone else
+asking is served normally.
+
+Each profile is saved in ``app.config['PROFILE_DIR']`` as ``<id>.prof``
+(open it with ``python -m pstats`` or snakeviz) and ``<id>.json``, a
+summary with the request, its duration and the top functions by
+cumulative and by own time. Only the newest ``POS_PROFILE_KEEP`` are
+kept. The response carries the id in ``X-Profile-Id``. Streamed
+responses are profiled up to the point the stream starts.
+
+A worker profiles one request at a time; a request asking while another
+is profiled is served without a profile. Under the gevent worker the
+profiler sees everything its thread runs, so a profile also includes the
+other requests' greenlets that ran while it was on. Profile on a quiet
+worker, or with the sync worker, for a clean picture of one request.
+"""
+import cProfile
+import json
+import os
+import pstats
+import re
+import secrets
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, g, request
+
+SECRET = os.environ.get('POS_PROFILE_SECRET', '')
+KEEP = int(os.environ.get('POS_PROFILE_KEEP', 50))
+TOP = int(os.environ.get('POS_PROFILE_TOP', 25))
+HEADER = 'X-Profile-Id'
+ID_RE = re.compile(r'^[0-9T]+-[0-9a-f]+$')
+
+# Held while a request is profiled; only one profiler can be on per thread, and greenlets share it
+_active = threading.Lock()
+
+
+def requested():
+    return request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1'
+
+
+def start():
+    """Start profiling the current request (once)."""
+    if g.get('profiler') is not None or not _active.acquire(blocking=False):
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # Python 3.12+: something else in this process is being profiled
+        _active.release()
+        return
+    g.profiler = profiler
+    g.profile_started = time.perf_counter()
+
+
+def _before_request():
+    if SECRET and requested() and secrets.compare_digest(request.headers.get('X-Profile-Secret', ''), SECRET):
+        start()
+
+
+def _short(filename):
+    """``package/module.py`` rather than the full path, so flask/app.py and our app.py stay apart."""
+    return '/'.join(filename.replace(os.sep, '/').split('/')[-2:])
+
+
+def _top(stats, key):
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3 if key == 'cumulative' else 2], reverse=True)
+    return [{
+        'function': f'{_short(filename)}:{line}({name})',
+        'calls': calls,
+        'ownSeconds': round(own, 6),
+        'cumulativeSeconds': round(cumulative, 6)
+    } for (filename, line, name), (_, calls, own, cumulative, _) in rows[:TOP]]
+
+
+def _stop():
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _active.release()
+    return profiler
+
+
+def _after_request(response):
+    profiler = _stop()
+    if profiler is None:
+        return response
+    seconds = time.perf_counter() - g.pop('profile_started')
+
+    directory = current_app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    profile_id = f'{datetime.now():%Y%m%dT%H%M%S%f}-{secrets.token_hex(3)}'
+    profiler.dump_stats(os.path.join(directory, f'{profile_id}.prof'))
+    stats = pstats.Stats(profiler)
+    user = getattr(request, 'user', None) or {}
+    tenant = getattr(request, 'tenant', None)
+    summary = {
+        'id': profile_id,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'route': request.url_rule.rule if request.url_rule else None,
+        'status': response.status_code,
+        'userId': user.get('id'),
+        'role': user.get('role'),
+        'tenantId': tenant.id if tenant else None,
+        'seconds': round(seconds, 6),
+        'functionCalls': stats.total_calls,
+        'createdAt': datetime.now().isoformat(),
+        'topCumulative': _top(stats, 'cumulative'),
+        'topOwn': _top(stats, 'own')
+    }
+    path = os.path.join(directory, f'{profile_id}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(path + '.tmp', path)  # The listing never sees half a summary
+    prune(directory)
+    response.headers[HEADER] = profile_id
+    return response
+
+
+def prune(directory, keep=KEEP):
+    """Delete all but the newest ``keep`` profiles."""
+    ids = sorted(f[:-len('.json')] for f in os.listdir(directory) if f.endswith('.json'))
+    for profile_id in ids[:max(0, len(ids) - keep)]:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, profile_id + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory):
+    """Summaries of the saved profiles, newest first, without their function tables."""
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted((f for f in os.listdir(directory) if f.endswith('.json')), reverse=True):
+        try:
+            with open(os.path.join(directory, name)) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue  # Pruned since the listing
+        profiles.append({k: v for k, v in summary.items() if not k.startswith('top')})
+    return profiles
+
+
+def find(directory, profile_id, suffix='.json'):
+    """Path of a saved profile file, or None."""
+    if not ID_RE.match(profile_id or ''):
+        return None
+    path = os.path.join(directory, profile_id + suffix)
+    return path if os.path.exists(path) else None
+
+
+def install(app):
+    """Profile requests that ask for it.
+
+    Install after ``metrics`` and before compression so the profile
+    covers the other response handlers (Flask runs them in reverse order).
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(lambda exc: _stop())  # Requests that failed before after_request
@@ -0,0 +1,178 @@
+"""Due-date index and recurrence of customer reminders.
+
+A store hook keeps one ``reminder_index`` record listing every pending
+reminder, and every fulfilled recurring one, as ``[date, reminder id]``
+pairs sorted by the date part of ``nextDate``. "Due today" is then a
+bisect to the end of today, reading only the reminders up to it, and
+never a scan of every reminder.
+
+``ReminderScheduler`` is a background thread that rolls fulfilled
+recurring reminders forward once their date has come: ``nextDate``
+moves to the next occurrence after today and the reminder is pending
+again. ``daily`` repeats every day, ``weekly`` every seven days from
+``nextDate`` and ``specific`` on the weekdays named in ``days``.
+Pending reminders are never moved, so one that was missed stays due
+until it is fulfilled. Work is done in transactions of
+``POS_REMINDER_BATCH`` reminders. Every worker may run a scheduler;
+each change is re-checked inside its transaction, so they never
+advance a reminder twice.
+"""
+import bisect
+import os
+import threading
+from datetime import date, datetime, timedelta
+
+INDEX = 'reminder_index'
+INDEX_ID = 1
+RECURRING = ('daily', 'weekly', 'specific')
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+INTERVAL_SECONDS = float(os.environ.get('POS_REMINDER_INTERVAL', 300))
+BATCH = int(os.environ.get('POS_REMINDER_BATCH', 200))
+
+
+def _entry(reminder):
+    """Index entry of a reminder, or None if it isn't tracked."""
+    if reminder is None or not reminder.get('nextDate'):
+        return None
+    status = reminder.get('status')
+    if status == 'pending' or (status == 'fulfilled' and reminder.get('frequency') in RECURRING):
+        return [reminder['nextDate'][:10], reminder['id']]
+    return None
+
+
+def build(reminders):
+    return {'id': INDEX_ID, 'due': sorted(e for e in map(_entry, reminders) if e)}
+
+
+def on_commit(txn):
+    """Store hook: move this transaction's reminder writes in the index."""
+    changes = txn.changes.get('reminders')
+    if not changes:
+        return
+    if changes.replaced is not None:
+        index = build(changes.replaced)
+    else:
+        pairs = [(txn.old('reminders', id), r) for id, r in changes.updated.items()]
+        pairs += [(None, r) for r in changes.inserted]
+        pairs += [(txn.old('reminders', id), None) for id in changes.deleted]
+        current = txn.get(INDEX, INDEX_ID)
+        due = list(current['due']) if current else []
+        for old, new in pairs:
+            before, after = _entry(old), _entry(new)
+            if before == after:
+                continue
+            if before:
+                i = bisect.bisect_left(due, before)
+                if i < len(due) and due[i] == before:
+                    del due[i]
+            if after:
+                bisect.insort(due, after)
+        index = {'id': INDEX_ID, 'due': due}
+    if txn.get(INDEX, INDEX_ID):
+        txn.update(INDEX, INDEX_ID, index)
+    else:
+        txn.insert(INDEX, index)
+
+
+def install(store):
+    """Register the hook and build the index once if there is none yet."""
+    store.add_hook(on_commit)
+    if store.get(INDEX, INDEX_ID) is None:
+        with store.transaction() as txn:
+            if txn.get(INDEX, INDEX_ID) is None:
+                txn.insert(INDEX, build(txn.load('reminders')))
+
+
+def due_entries(store_or_txn, until):
+    """Index entries dated up to and including ``until`` (an ISO date)."""
+    index = store_or_txn.get(INDEX, INDEX_ID)
+    if not index:
+        return []
+    due = index['due']
+    return due[:bisect.bisect_right(due, [until, float('inf')])]
+
+
+def due(store, day=None):
+    """Pending reminders whose ``nextDate`` is on or before ``day`` (default today), oldest first."""
+    until = (day or date.today()).isoformat()
+    reminders = (store.get('reminders', id) for _, id in due_entries(store, until))
+    return [r for r in reminders if r and r.get('status') == 'pending']
+
+
+def next_occurrence(reminder, after):
+    """The first date of the reminder's schedule later than ``after``, or None."""
+    start = date.fromisoformat(reminder['nextDate'][:10])
+    frequency = reminder.get('frequency')
+    weekdays = {WEEKDAYS.index(d[:3].lower()) for d in reminder.get('days') or [] if d[:3].lower() in WEEKDAYS}
+    if frequency == 'daily':
+        return max(start, after) + timedelta(days=1) if start <= after else start
+    if frequency == 'weekly' or (frequency == 'specific' and not weekdays):
+        if start > after:
+            return start
+        return start + timedelta(weeks=(after - start).days // 7 + 1)
+    if frequency == 'specific':
+        day = max(start, after + timedelta(days=1))
+        while day.weekday() not in weekdays:
+            day += timedelta(days=1)
+        return day
+    return None
+
+
+def advance(txn, reminder_id, today):
+    """Roll one fulfilled recurring reminder forward if its date has come; returns whether it moved."""
+    reminder = txn.get('reminders', reminder_id)
+    if (not reminder or reminder.get('status') != 'fulfilled' or reminder.get('frequency') not in RECURRING
+            or reminder.get('nextDate', '')[:10] > today.isoformat()):
+        return False
+    txn.update('reminders', reminder_id, {
+        'nextDate': next_occurrence(reminder, today).isoformat(),
+        'status': 'pending',
+        'lastFulfilledDate': reminder['nextDate'][:10],
+        'advancedAt': datetime.now().isoformat()
+    })
+    return True
+
+
+def advance_due(store, today=None, batch=BATCH):
+    """Roll every fulfilled reminder that has come due, ``batch`` per transaction; returns how many moved."""
+    today = today or date.today()
+    candidates = [id for _, id in due_entries(store, today.isoformat())]
+    moved = 0
+    for start in range(0, len(candidates), batch):
+        chunk = candidates[start:start + batch]
+        # Most entries up to today are pending reminders, which stay put; skip them without locking
+        chunk = [id for id in chunk if (store.get('reminders', id) or {}).get('status') == 'fulfilled']
+        if chunk:
+            with store.transaction() as txn:
+                moved += sum(advance(txn, id, today) for id in chunk)
+    return moved
+
+
+class ReminderScheduler:
+    """Background thread running ``advance_due`` every ``INTERVAL_SECONDS``."""
+
+    def __init__(self, store, interval=INTERVAL_SECONDS):
+        self.store = store
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='reminder-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the thread and wait for a round in progress to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                advance_due(self.store)
+            except Exception as e:
+                # Keep the scheduler alive; the next round retries
+                print(f"Reminder scheduler failed: {e}")
+            self._stop.wait(self.interval)
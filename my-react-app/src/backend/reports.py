@@ -0,0 +1,231 @@
+"""Sales breakdowns behind /api/reports/sales.
+
+Every sale line item is kept in NumPy columns: when it was sold (int64
+seconds, taking the stored local timestamps at face value), sale, product
+and cashier ids, quantity, total and cogs. Grouping by hour, day, product
+or cashier over any period is then a mask and a few ``bincount`` calls.
+
+Sales are almost only ever appended, so the columns are built once per
+worker (archived sales included) and then extended with the sales whose
+ids are new whenever the sales collection changed. A transaction that
+updates, deletes or replaces sales bumps a counter in ``sales_edits``
+instead, and the columns are rebuilt once it moved. A line's total is its
+share of the sale total, by ``price * quantity``, so discounts and fees
+are spread over the lines and the line totals add up to the sale. Lines
+recorded before per-line cogs existed get the same share of the sale's
+cogs.
+"""
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+GROUPS = ('hour', 'day', 'product', 'cashier')
+EPOCH = datetime(1970, 1, 1)
+EDITS = 'sales_edits'
+EDITS_ID = 1
+# How far a ``to`` value reaches, by its length, so it covers everything it is a prefix of
+_REACH = {10: timedelta(days=1), 13: timedelta(hours=1), 16: timedelta(minutes=1)}
+
+COLUMNS = {
+    'ts': np.int64,
+    'sale': np.int64,
+    'product': np.int64,
+    'cashier': np.int64,
+    'quantity': np.float64,
+    'total': np.float64,
+    'cogs': np.float64,
+}
+
+
+def _seconds(moment):
+    return int((moment.replace(tzinfo=None) - EPOCH).total_seconds())
+
+
+def parse_bound(value, end=False):
+    """Seconds for a ``from``/``to`` value (an ISO date or timestamp); raises ``ValueError``.
+
+    For ``end`` it is the first second after the period ``value`` names.
+    """
+    moment = datetime.fromisoformat(value)
+    if end:
+        moment += _REACH.get(len(value), timedelta(seconds=1))
+    return _seconds(moment)
+
+
+def factorize(keys):
+    """``(distinct keys ascending, index into them of every key)``.
+
+    Keys in a compact range (hours, days, ids) are counted into a lookup
+    table instead of being sorted.
+    """
+    if not len(keys):
+        return keys, np.zeros(0, dtype=np.intp)
+    low = keys.min()
+    span = int(keys.max() - low) + 1
+    if span > 4 * len(keys) + 65536:
+        return np.unique(keys, return_inverse=True)
+    present = np.zeros(span, dtype=bool)
+    present[keys - low] = True
+    position = np.cumsum(present) - 1
+    return np.flatnonzero(present) + low, position[keys - low]
+
+
+def sale_lines(sale):
+    """Column values of each line of one sale."""
+    try:
+        ts = _seconds(datetime.fromisoformat(sale['createdAt']))
+    except (KeyError, TypeError, ValueError):
+        return []
+    items = [item for item in sale.get('items') or [] if isinstance(item, dict)]
+    weights = [(item.get('price') or 0) * (item.get('quantity') or 0) for item in items]
+    if not any(weights):
+        weights = [item.get('quantity') or 0 for item in items]
+    subtotal = sum(weights)
+    lines = []
+    for item, weight in zip(items, weights):
+        share = weight / subtotal if subtotal else 1 / len(items)
+        lines.append((
+            ts,
+            sale['id'],
+            item.get('productId') or 0,
+            sale.get('cashierId') or 0,
+            item.get('quantity') or 0,
+            (sale.get('total') or 0) * share,
+            item['cogs'] if 'cogs' in item else (sale.get('cogs') or 0) * share
+        ))
+    return lines
+
+
+class SalesColumns:
+    """The columnar line items of one store's sales, kept up to date on demand."""
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._version = None
+        self._next_id = None
+        self._edits = None
+        self._clear()
+        store.add_hook(self.on_commit)
+
+    @staticmethod
+    def on_commit(txn):
+        """Store hook: count the transactions that change sales other than by adding them."""
+        changes = txn.changes.get('sales')
+        if not changes or (changes.replaced is None and not changes.updated and not changes.deleted):
+            return
+        record = txn.get(EDITS, EDITS_ID)
+        if record:
+            txn.update(EDITS, EDITS_ID, {'count': record['count'] + 1})
+        else:
+            txn.insert(EDITS, {'id': EDITS_ID, 'count': 1})
+
+    def _edit_count(self):
+        record = self.store.get(EDITS, EDITS_ID)
+        return record['count'] if record else 0
+
+    def _clear(self):
+        self.size = 0
+        self._columns = {name: np.empty(1024, dtype) for name, dtype in COLUMNS.items()}
+
+    def _append(self, lines):
+        if not lines:
+            return
+        needed = self.size + len(lines)
+        capacity = len(self._columns['ts'])
+        if needed > capacity:
+            while capacity < needed:
+                capacity *= 2
+            for name, column in self._columns.items():
+                grown = np.empty(capacity, column.dtype)
+                grown[:self.size] = column[:self.size]
+                self._columns[name] = grown
+        rows = np.array(lines, dtype=np.float64).T
+        for (name, column), values in zip(self._columns.items(), rows):
+            column[self.size:needed] = values
+        self.size = needed
+
+    def refresh(self):
+        """Catch up with the sales written since the last call."""
+        version = self.store.version('sales')
+        if version == self._version:
+            return
+        edits = self._edit_count()
+        next_id = self.store.next_id('sales')
+        if self._next_id is None or next_id < self._next_id or edits != self._edits:
+            # First use, sales changed in place, or the data was restored from an older copy
+            self._clear()
+            sales = self.store.load_archived('sales') + self.store.load('sales')
+        else:
+            sales = [sale for sale in (self.store.get('sales', id) for id in range(self._next_id, next_id)) if sale]
+        lines = []
+        for sale in sales:
+            lines += sale_lines(sale)
+        self._append(lines)
+        self._version, self._next_id, self._edits = version, next_id, edits
+
+    def columns(self):
+        """Views of the current columns, after catching up."""
+        with self._lock:
+            self.refresh()
+            return {name: column[:self.size] for name, column in self._columns.items()}
+
+    def report(self, group_by, since=None, until=None):
+        """Rows of ``key``, ``quantity``, ``total``, ``cogs``, ``profit``, ``lines``
+        and ``sales`` per group, in key order, plus the same sums for the period.
+
+        ``since`` and ``until`` are seconds from ``parse_bound``.
+        """
+        c = self.columns()
+        mask = np.ones(len(c['ts']), dtype=bool)
+        if since is not None:
+            mask &= c['ts'] >= since
+        if until is not None:
+            mask &= c['ts'] < until
+        c = {name: column[mask] for name, column in c.items()}
+
+        if group_by == 'hour':
+            keys = c['ts'] // 3600
+        elif group_by == 'day':
+            keys = c['ts'] // 86400
+        else:
+            keys = c[group_by]
+        unique, group = factorize(keys)
+        n = len(unique)
+        sums = {name: np.bincount(group, weights=c[name], minlength=n) for name in ('quantity', 'total', 'cogs')}
+        lines = np.bincount(group, minlength=n)
+        # A sale with several lines in one group counts once there
+        stride = int(c['sale'].max(initial=0)) + 1
+        pairs = np.sort(group.astype(np.int64) * stride + c['sale'])
+        first = np.r_[True, pairs[1:] != pairs[:-1]] if len(pairs) else np.zeros(0, dtype=bool)
+        sales = np.bincount(pairs[first] // stride, minlength=n)
+
+        columns = zip(self._labels(group_by, unique), sums['quantity'].tolist(), sums['total'].tolist(), sums['cogs'].tolist(),
+                      lines.tolist(), sales.tolist())
+        rows = [{
+            'key': key,
+            'quantity': quantity,
+            'total': total,
+            'cogs': cogs,
+            'profit': total - cogs,
+            'lines': line_count,
+            'sales': sale_count
+        } for key, quantity, total, cogs, line_count, sale_count in columns]
+        totals = {
+            'quantity': float(c['quantity'].sum()),
+            'total': float(c['total'].sum()),
+            'cogs': float(c['cogs'].sum()),
+            'profit': float(c['total'].sum() - c['cogs'].sum()),
+            'lines': len(c['ts']),
+            'sales': int(np.count_nonzero(np.diff(np.sort(c['sale'])))) + 1 if len(c['sale']) else 0
+        }
+        return rows, totals
+
+    @staticmethod
+    def _labels(group_by, keys):
+        if group_by == 'hour':
+            return (keys * 3600).astype('datetime64[s]').astype(str).tolist()
+        if group_by == 'day':
+            return keys.astype('datetime64[D]').astype(str).tolist()
+        return keys.tolist()
@@ -0,0 +1,102 @@
+"""A local stand-in SMTP server for development and tests.
+
+It accepts every message and appends it, with its envelope, as one JSON
+line to ``--out`` (or prints it). Point the backend at it with
+``SMTP_HOST=localhost SMTP_PORT=1025``::
+
+    python smtp_sink.py --port 1025 --out /tmp/outbox.jsonl
+
+Only the commands smtplib needs for plain delivery are implemented.
+``--fail-rate`` refuses that share of messages with a temporary error,
+to exercise retries.
+"""
+import argparse
+import json
+import random
+import socketserver
+import threading
+from datetime import datetime
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.reply('220 localhost smtp_sink ready')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                sender, recipients = command.split(':', 1)[1].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for raw in self.rfile:
+                    if raw in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(raw[1:] if raw.startswith(b'..') else raw)
+                if random.random() < self.server.fail_rate:
+                    self.reply('451 Try again later')
+                else:
+                    self.server.store(sender, recipients, b''.join(data).decode(errors='replace'))
+                    self.reply('250 OK queued')
+                sender, recipients = None, []
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, out=None, fail_rate=0.0):
+        super().__init__(address, SMTPHandler)
+        self.out = out
+        self.fail_rate = fail_rate
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def store(self, sender, recipients, data):
+        message = {'receivedAt': datetime.now().isoformat(), 'from': sender, 'to': recipients, 'data': data}
+        with self._lock:
+            self.messages.append(message)
+            if self.out:
+                with open(self.out, 'a') as f:
+                    f.write(json.dumps(message) + '\n')
+            else:
+                print(f"Message from {sender} to {', '.join(recipients)} ({len(data)} bytes)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local SMTP server that stores every message it receives')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--out', help='Append messages as JSON lines to this file')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Share of messages refused with 451')
+    args = parser.parse_args()
+    with SMTPSink((args.host, args.port), args.out, args.fail_rate) as server:
+        print(f'SMTP sink listening on {args.host}:{args.port}')
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1745 @@
+"""Storage engines for the POS backend.
+
+Every collection is a list of JSON records, most of them keyed by an integer
+``id``. The engine is chosen with the ``POS_STORAGE`` environment variable:
+
+* ``json`` (default) keeps one ``data/<collection>.json`` file per collection.
+  Append-heavy collections (``POS_LOG_COLLECTIONS``, by default sales,
+  expenses, price_history, emails and events) keep that file as a snapshot and write
+  each mutation as one line of ``data/<collection>.log``. The log is folded
+  back into the snapshot in the background once it grows past
+  ``POS_LOG_COMPACT_BYTES``.
+
+  Collections that only grow with time (``POS_PARTITION_COLLECTIONS``, by
+  default sales and expenses) are split into ``data/<collection>/`` with one
+  partition per month (or day, ``POS_PARTITION_PERIOD``) of ``createdAt``.
+  Only the current period is written through a log; finished periods are
+  closed into gzipped JSON that is only rewritten if a late write lands in
+  it. Date-filtered reads (``load_range``) skip partitions outside the range.
+  With ``POS_PARTITION_KEEP=n`` partitions older than the newest ``n``
+  periods are moved to ``data/archive/<collection>/`` and no longer loaded.
+  An existing ``<collection>.json`` is split once on first start and then
+  left untouched.
+
+  Collection files are written indented (``POS_JSON_FORMAT=pretty``, the
+  default), without whitespace (``compact``) or as gzipped compact JSON
+  (``gzip``). Files in any of these formats are read back transparently.
+* ``sqlite`` keeps one table per collection in ``data/pos.sqlite3`` (override
+  with ``POS_SQLITE_PATH``) with an index on ``id``, so single-record reads and
+  writes no longer touch the rest of the collection. The collections the JSON
+  engine would partition get an index on ``createdAt`` instead.
+
+Every collection can be looked up by ``id`` in O(1), and the fields listed in
+the ``indexes`` mapping passed to ``open_storage`` (for example ``email`` on
+users) are indexed as well, so ``find`` does not scan the collection. The
+indexes are updated on every write rather than rebuilt.
+
+All writes go through ``Storage.transaction()``: changes to any number of
+collections are buffered and committed as one unit, and writers are
+serialised across threads and gunicorn workers for the transaction's
+lifetime. SQLite commits in a single database transaction. The JSON engine
+writes every new file and log entry first, records them in a commit journal
+(``data/.commit.json``), then applies them; a journal left behind by a
+crashed worker is rolled forward on the next start.
+
+The JSON engine serialises workers with ``flock``. Under gunicorn's gevent
+worker a lock held by another worker is waited for on gevent's thread
+pool, so the worker's other greenlets (open SSE streams included) keep
+running meanwhile. SQLite's wait for a busy database is not gevent-aware
+and holds up the whole worker until the other writer commits.
+
+Both engines keep parsed collections in a per-process cache keyed by a
+version (file inode/mtime/size for JSON, a generation counter for SQLite), so
+a gunicorn worker only re-parses a collection after some worker changed it.
+Records handed out by the store are shared with that cache and must be
+treated as read-only; change them through ``update``.
+
+Existing JSON files can be copied into SQLite once with::
+
+    python storage.py import
+
+and partitions can be closed and archived without waiting for a restart
+with::
+
+    python storage.py maintain
+
+After changing ``POS_JSON_FORMAT``, existing files can be rewritten in the
+new format with::
+
+    python storage.py reformat
+"""
+import argparse
+import gzip
+import itertools
+import json
+import os
+import queue
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single worker only
+    fcntl = None
+
+
+def _gevent_patched():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def _flock(fd, mode):
+    """``fcntl.flock``, waiting on gevent's thread pool when the lock is taken
+    and gevent has patched threading, instead of blocking every greenlet."""
+    if mode == fcntl.LOCK_UN or not _gevent_patched():
+        fcntl.flock(fd, mode)
+        return
+    try:
+        fcntl.flock(fd, mode | fcntl.LOCK_NB)
+    except BlockingIOError:
+        import gevent
+        gevent.get_hub().threadpool.apply(fcntl.flock, (fd, mode))
+
+DEFAULT_LOG_COLLECTIONS = 'sales,expenses,price_history,emails,events'
+DEFAULT_LOG_COMPACT_BYTES = 1024 * 1024
+DEFAULT_PARTITION_COLLECTIONS = 'sales,expenses'
+
+# Partitioned collections are split on this field's date
+PARTITION_FIELD = 'createdAt'
+UNDATED = 'undated'
+MANIFEST = 'manifest.json'
+# Manifest key of the highest id in archived partitions, so their ids aren't reused
+ARCHIVED_MAX_ID = 'archivedMaxId'
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+# How collection files are written; they are read back in any of these
+JSON_FORMATS = ('pretty', 'compact', 'gzip')
+JSON_FORMAT = os.environ.get('POS_JSON_FORMAT', 'pretty').lower()
+GZIP_LEVEL = 6
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Optional ``observer(op, collection, seconds, bytes)`` told about every read
+# ('read') and write ('write') of collection data on disk; see metrics.py
+io_observer = None
+
+
+def _observe_io(op, name, started, nbytes):
+    if io_observer is not None:
+        io_observer(op, name, time.perf_counter() - started, nbytes)
+
+
+def in_range(value, since, until):
+    """``value`` is an ISO timestamp; ``since``/``until`` are ISO dates or timestamps.
+
+    ``until`` is inclusive of everything it is a prefix of, so ``2025-12-01``
+    covers that whole day.
+    """
+    if since and value < since:
+        return False
+    if until and value[:len(until)] > until:
+        return False
+    return True
+
+
+def _period_in_range(period, since, until):
+    """Whether any timestamp starting with ``period`` can be ``in_range``."""
+    if since:
+        n = min(len(period), len(since))
+        if period[:n] < since[:n]:
+            return False
+    if until:
+        n = min(len(period), len(until))
+        if period[:n] > until[:n]:
+            return False
+    return True
+
+
+class CollectionIndex:
+    """In-memory lookups over one collection: id -> record and field -> records.
+
+    ``by_id`` points at the first record with each id, matching what a linear
+    ``next()`` scan would return.
+    """
+
+    def __init__(self, fields=(), records=()):
+        self.fields = tuple(fields)
+        self.by_id = {}
+        self.by_field = {field: {} for field in self.fields}
+        self.max_id = 0
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        id = record.get('id')
+        self.by_id.setdefault(id, record)
+        if isinstance(id, int) and id > self.max_id:
+            self.max_id = id
+        for field in self.fields:
+            self.by_field[field].setdefault(record.get(field), []).append(record)
+
+    def _unlink(self, field, record):
+        values = self.by_field[field]
+        bucket = values.get(record.get(field), [])
+        for i, r in enumerate(bucket):
+            if r is record:
+                del bucket[i]
+                break
+        if not bucket:
+            values.pop(record.get(field), None)
+
+    def remove(self, record):
+        id = record.get('id')
+        if self.by_id.get(id) is record:
+            del self.by_id[id]
+        for field in self.fields:
+            self._unlink(field, record)
+
+    def replace(self, old, new):
+        """Put ``new`` in place of ``old``; where a field's value is unchanged it keeps its place, as in a scan."""
+        id = old.get('id')
+        if self.by_id.get(id) is old:
+            del self.by_id[id]
+        self.by_id[new.get('id')] = new
+        if isinstance(new.get('id'), int) and new['id'] > self.max_id:
+            self.max_id = new['id']
+        for field in self.fields:
+            bucket = self.by_field[field].get(old.get(field), [])
+            i = next((i for i, r in enumerate(bucket) if r is old), None)
+            if i is not None and old.get(field) == new.get(field):
+                bucket[i] = new
+                continue
+            self._unlink(field, old)
+            self.by_field[field].setdefault(new.get(field), []).append(new)
+
+    def find(self, field, value):
+        return list(self.by_field[field].get(value, ()))
+
+
+class _Changes:
+    """Pending writes to one collection inside a transaction."""
+
+    def __init__(self):
+        self.replaced = None  # Full new contents, when the whole collection is rewritten
+        self.updated = {}  # id -> new record
+        self.deleted = set()
+        self.inserted = []
+
+
+class Transaction:
+    """Buffered writes across collections, committed together by the engine.
+
+    Reads through the transaction see its own pending writes. Obtain one
+    from ``Storage.transaction()``.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.changes = {}  # name -> _Changes
+
+    def _changes(self, name):
+        if name not in self.changes:
+            self.changes[name] = _Changes()
+        return self.changes[name]
+
+    def get(self, name, id):
+        changes = self.changes.get(name)
+        if changes:
+            if changes.replaced is not None:
+                return next((r for r in changes.replaced if r.get('id') == id), None)
+            if id in changes.updated:
+                return changes.updated[id]
+            inserted = next((r for r in changes.inserted if r.get('id') == id), None)
+            if inserted is not None or id in changes.deleted:
+                return inserted
+        return self.store.get(name, id)
+
+    def load(self, name):
+        """The collection as it will be once this transaction commits."""
+        changes = self.changes.get(name)
+        if changes is None:
+            return self.store.load(name)
+        if changes.replaced is not None:
+            return list(changes.replaced)
+        records = [changes.updated.get(r.get('id'), r) for r in self.store.load(name)
+                   if r.get('id') not in changes.deleted]
+        return records + changes.inserted
+
+    def old(self, name, id):
+        """The committed version of a record, ignoring this transaction's changes."""
+        return self.store.get(name, id)
+
+    def next_id(self, name):
+        next_id = self.store.next_id(name)
+        changes = self.changes.get(name)
+        if changes:
+            pending = changes.inserted if changes.replaced is None else changes.replaced
+            ids = [r['id'] for r in pending if isinstance(r.get('id'), int)]
+            next_id = max([next_id] + [i + 1 for i in ids])
+        return next_id
+
+    def insert(self, name, record):
+        self.insert_many(name, [record])
+        return record
+
+    def insert_many(self, name, records):
+        changes = self._changes(name)
+        (changes.inserted if changes.replaced is None else changes.replaced).extend(records)
+        return records
+
+    def update(self, name, id, changes):
+        current = self.get(name, id)
+        if current is None:
+            return None
+        record = {**current, **changes}
+        pending = self._changes(name)
+        for records in (pending.replaced, pending.inserted):
+            if records is not None and any(r is current for r in records):
+                records[next(i for i, r in enumerate(records) if r is current)] = record
+                return record
+        pending.updated[id] = record
+        return record
+
+    def delete(self, name, id):
+        if self.get(name, id) is None:
+            return False
+        pending = self._changes(name)
+        if pending.replaced is not None:
+            pending.replaced = [r for r in pending.replaced if r.get('id') != id]
+            return True
+        pending.inserted = [r for r in pending.inserted if r.get('id') != id]
+        pending.updated.pop(id, None)
+        if self.store.get(name, id) is not None:
+            pending.deleted.add(id)
+        return True
+
+    def replace(self, name, records):
+        changes = _Changes()
+        changes.replaced = list(records)
+        self.changes[name] = changes
+
+
+class Storage:
+    """Record-level operations shared by every engine.
+
+    Engines provide ``_begin`` (serialise writers) and ``_commit`` (apply a
+    transaction). The generic reads below are for whole-collection engines:
+    they only need ``_records``, the cached list shared by every reader.
+    """
+
+    def __init__(self, collections=(), indexes=None):
+        self.collections = list(collections)
+        self.indexes = dict(indexes or {})
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._cache = {}  # name -> (version, records)
+        self._index_cache = {}  # name -> (records the index was built from, CollectionIndex)
+        self._hooks = []
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def cache_stats(self):
+        """Cache hit/miss counters per collection."""
+        names = sorted(set(self.hits) | set(self.misses))
+        return {name: {'hits': self.hits[name], 'misses': self.misses[name]} for name in names}
+
+    def add_hook(self, hook):
+        """Call ``hook(txn)`` before every commit so it can add derived writes."""
+        self._hooks.append(hook)
+
+    @contextmanager
+    def transaction(self):
+        """Yield a ``Transaction`` and commit it when the block exits cleanly.
+
+        A transaction opened while another one is active on the same thread
+        joins the outer one.
+        """
+        current = getattr(self._local, 'txn', None)
+        if current is not None:
+            yield current
+            return
+        with self._lock, self._begin():
+            txn = Transaction(self)
+            self._local.txn = txn
+            try:
+                yield txn
+                if txn.changes:
+                    for hook in self._hooks:
+                        hook(txn)
+                self._commit(txn)
+            finally:
+                self._local.txn = None
+
+    def _begin(self):
+        raise NotImplementedError
+
+    def _commit(self, txn):
+        raise NotImplementedError
+
+    def _records(self, name):
+        raise NotImplementedError
+
+    def load(self, name):
+        return list(self._records(name))
+
+    def version(self, name):
+        """A value that changes whenever the collection does, in any process."""
+        raise NotImplementedError
+
+    def close(self):
+        """Release the store's files, connections and threads. It can't be used afterwards."""
+        raise NotImplementedError
+
+    def load_range(self, name, since=None, until=None):
+        """Records whose ``createdAt`` is ``in_range(since, until)``."""
+        if not (since or until):
+            return self.load(name)
+        return [r for r in self._records(name) if in_range(r.get(PARTITION_FIELD, ''), since, until)]
+
+    def load_archived(self, name):
+        """Records moved out of the store by partition archival."""
+        return []
+
+    def iter_range(self, name, since=None, until=None, archived=False):
+        """``load_range`` as an iterator, after the matching archived records if ``archived``.
+
+        Engines override it to avoid holding a whole large collection in
+        memory at once.
+        """
+        if archived:
+            yield from (r for r in self.load_archived(name) if in_range(r.get(PARTITION_FIELD, ''), since, until))
+        yield from self.load_range(name, since, until)
+
+    def _indexed(self, name):
+        """The current cached records of a collection together with their index."""
+        records = self._records(name)
+        built_from, index = self._index_cache.get(name, (None, None))
+        if built_from is not records:
+            index = CollectionIndex(self.indexes.get(name, ()), records)
+            self._index_cache[name] = (records, index)
+        return records, index
+
+    def _index(self, name):
+        return self._indexed(name)[1]
+
+    def count(self, name):
+        return len(self._records(name))
+
+    def next_id(self, name):
+        return self._index(name).max_id + 1
+
+    def get(self, name, id):
+        return self._index(name).by_id.get(id)
+
+    def find(self, name, field, value):
+        if field in self.indexes.get(name, ()):
+            return self._index(name).find(field, value)
+        return [r for r in self._records(name) if r.get(field) == value]
+
+    def find_range(self, name, field, value, since=None, until=None):
+        """``find`` limited to records whose ``createdAt`` is ``in_range(since, until)``."""
+        return [r for r in self.find(name, field, value) if in_range(r.get(PARTITION_FIELD, ''), since, until)]
+
+    def save(self, name, records):
+        with self.transaction() as txn:
+            txn.replace(name, records)
+
+    def insert(self, name, record):
+        self.insert_many(name, [record])
+        return record
+
+    def insert_many(self, name, records):
+        with self.transaction() as txn:
+            return txn.insert_many(name, records)
+
+    def update(self, name, id, changes):
+        with self.transaction() as txn:
+            return txn.update(name, id, changes)
+
+    def delete(self, name, id):
+        with self.transaction() as txn:
+            return txn.delete(name, id)
+
+
+def encode_json(records, fmt=None):
+    """``records`` serialised in ``fmt`` (default ``POS_JSON_FORMAT``)."""
+    fmt = fmt or JSON_FORMAT
+    if fmt == 'pretty':
+        return json.dumps(records, indent=2).encode()
+    data = json.dumps(records, separators=(',', ':')).encode()
+    return gzip.compress(data, GZIP_LEVEL, mtime=0) if fmt == 'gzip' else data
+
+
+def decode_json(data):
+    """Records from the bytes of a collection file in any of ``JSON_FORMATS``."""
+    if data[:2] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    return json.loads(data)
+
+
+def write_temp_json(path, records, fmt=None, name=None):
+    """Write ``records`` next to ``path`` and return the temp file's path.
+
+    ``name`` is the collection reported to ``io_observer``, if any.
+    """
+    started = time.perf_counter()
+    data = encode_json(records, fmt)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    if name:
+        _observe_io('write', name, started, len(data))
+    return tmp_path
+
+
+def write_json_file(path, records, fmt=None, name=None):
+    # Write to a temp file first so readers never see a half-written file
+    os.replace(write_temp_json(path, records, fmt, name), path)
+
+
+class AppendLog:
+    """A JSON snapshot plus an append-only JSON-lines log of mutations.
+
+    Each log line is either ``{"op": "put", "record": {...}}`` (replace the
+    first record with that id, or append it) or ``{"op": "delete", "id": n}``.
+    Both carry the full outcome, so replaying a line twice is harmless; that
+    is what makes a crash between writing the snapshot and truncating the log
+    safe. A torn last line from a crash mid-write is ignored on replay and cut
+    off before the next append.
+
+    Every process keeps the replayed records in memory and only reads log
+    bytes appended since its last look, so other gunicorn workers' writes are
+    picked up without re-reading the snapshot.
+    """
+
+    def __init__(self, snapshot_path, compact_bytes=DEFAULT_LOG_COMPACT_BYTES, on_compact_needed=None, fields=(),
+                 name=None):
+        self.snapshot_path = snapshot_path
+        self.name = name or os.path.basename(snapshot_path)[:-len('.json')]
+        self.fields = fields
+        self.log_path = snapshot_path[:-len('.json')] + '.log'
+        self.compact_bytes = compact_bytes
+        self.on_compact_needed = on_compact_needed
+        self._lock = threading.RLock()
+        self._log = open(self.log_path, 'a+b')
+        self._snapshot_key = None
+        self._offset = 0
+        self._records = []
+        self._positions = {}  # id -> index of the first record with that id
+        self.index = CollectionIndex(fields)
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def _file_lock(self, mode):
+        if fcntl is None:
+            yield
+            return
+        _flock(self._log.fileno(), mode)
+        try:
+            yield
+        finally:
+            _flock(self._log.fileno(), fcntl.LOCK_UN)
+
+    def _stat_snapshot(self):
+        try:
+            st = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _reset(self, records):
+        self._records = list(records)
+        self._positions = {}
+        for i, record in enumerate(self._records):
+            self._positions.setdefault(record.get('id'), i)
+        self.index = CollectionIndex(self.fields, self._records)
+
+    def _apply(self, entries):
+        deleted = set()  # A run of deletes costs one pass over the records
+        for entry in entries:
+            if entry.get('op') == 'delete':
+                if entry.get('id') in self._positions:
+                    deleted.add(entry['id'])
+                continue
+            if deleted:
+                self._reset([r for r in self._records if r.get('id') not in deleted])
+                deleted = set()
+            if entry.get('op') == 'put':
+                record = entry['record']
+                i = self._positions.get(record.get('id'))
+                if i is None:
+                    self._positions[record.get('id')] = len(self._records)
+                    self._records.append(record)
+                    self.index.add(record)
+                else:
+                    self.index.replace(self._records[i], record)
+                    self._records[i] = record
+        if deleted:
+            self._reset([r for r in self._records if r.get('id') not in deleted])
+
+    def _refresh(self):
+        # Caller holds self._lock and at least a shared file lock
+        key = self._stat_snapshot()
+        size = os.fstat(self._log.fileno()).st_size
+        if key == self._snapshot_key and size == self._offset:
+            self.hits += 1
+            return
+        self.misses += 1
+        started = time.perf_counter()
+        if key != self._snapshot_key or size < self._offset:
+            records = []
+            if key is not None:
+                with open(self.snapshot_path, 'rb') as f:
+                    data = f.read()
+                records = decode_json(data)
+                _observe_io('read', self.name, started, len(data))
+                started = time.perf_counter()
+            self._reset(records)
+            self._snapshot_key = key
+            self._offset = 0
+        if size <= self._offset:
+            return
+        self._log.seek(self._offset)
+        chunk = self._log.read(size - self._offset)
+        _observe_io('read', self.name, started, len(chunk))
+        end = chunk.rfind(b'\n') + 1  # Anything after the last newline is a torn write
+        entries = []
+        for line in chunk[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = None
+            if not isinstance(entry, dict) or (entry.get('op') == 'put' and not isinstance(entry.get('record'), dict)):
+                print(f"Skipping corrupt line in {self.log_path}")
+                continue
+            entries.append(entry)
+        self._apply(entries)
+        self._offset += end
+
+    def records(self):
+        with self._lock, self._file_lock(fcntl and fcntl.LOCK_SH):
+            self._refresh()
+            return list(self._records)
+
+    def _get(self, id):
+        i = self._positions.get(id)
+        return self._records[i] if i is not None else None
+
+    def get(self, id):
+        with self._lock, self._file_lock(fcntl and fcntl.LOCK_SH):
+            self._refresh()
+            return self._get(id)
+
+    def find(self, field, value):
+        with self._lock, self._file_lock(fcntl and fcntl.LOCK_SH):
+            self._refresh()
+            if field in self.fields:
+                return self.index.find(field, value)
+            return [r for r in self._records if r.get(field) == value]
+
+    def count(self):
+        with self._lock, self._file_lock(fcntl and fcntl.LOCK_SH):
+            self._refresh()
+            return len(self._records)
+
+    def version(self):
+        return self._stat_snapshot(), os.fstat(self._log.fileno()).st_size
+
+    def next_id(self):
+        with self._lock, self._file_lock(fcntl and fcntl.LOCK_SH):
+            self._refresh()
+            return self.index.max_id + 1
+
+    def _append(self, entries):
+        # Caller holds self._lock and the exclusive file lock, already refreshed
+        if os.fstat(self._log.fileno()).st_size > self._offset:
+            self._log.truncate(self._offset)
+        started = time.perf_counter()
+        data = b''.join(json.dumps(e).encode() + b'\n' for e in entries)
+        self._log.write(data)
+        self._log.flush()
+        _observe_io('write', self.name, started, len(data))
+        self._offset += len(data)
+        self._apply(entries)
+        if self._offset > self.compact_bytes and self.on_compact_needed:
+            self.on_compact_needed(self)
+
+    def append(self, entries):
+        with self._lock, self._file_lock(fcntl and fcntl.LOCK_EX):
+            self._refresh()
+            self._append(entries)
+
+    def _replace(self, records):
+        write_json_file(self.snapshot_path, records, name=self.name)
+        self._log.truncate(0)
+        self._reset(records)
+        self._snapshot_key = self._stat_snapshot()
+        self._offset = 0
+
+    def replace(self, records):
+        """Write ``records`` as the new snapshot and empty the log."""
+        with self._lock, self._file_lock(fcntl and fcntl.LOCK_EX):
+            self._replace(records)
+
+    def compact(self):
+        with self._lock:
+            if self.closed:  # Its partition was closed or dropped since the compaction was scheduled
+                return
+            with self._file_lock(fcntl and fcntl.LOCK_EX):
+                self._refresh()
+                if self._offset:
+                    self._replace(self._records)
+
+    @property
+    def closed(self):
+        return self._log.closed
+
+    def close(self):
+        """Close the log file, once no other thread is in the middle of using it."""
+        with self._lock:
+            self._log.close()
+
+
+class _Compactor(threading.Thread):
+    """Background thread for storage upkeep: folding oversized logs into
+    their snapshots and closing finished partitions.
+
+    ``pending`` takes ``(description, callable)`` pairs.
+    """
+
+    def __init__(self):
+        super().__init__(name='storage-compactor', daemon=True)
+        self.pending = queue.Queue()
+
+    def stop(self):
+        """Exit once the jobs queued so far are done."""
+        self.pending.put((None, None))
+
+    def run(self):
+        while True:
+            what, job = self.pending.get()
+            if job is None:
+                return
+            try:
+                job()
+            except Exception as e:
+                print(f"{what} failed: {e}")
+
+
+def read_gzip_json(path, name=None):
+    """``(file version, records)`` of a gzipped JSON file, reported to ``io_observer`` as ``name``."""
+    started = time.perf_counter()
+    with open(path, 'rb') as raw:
+        st = os.fstat(raw.fileno())
+        with gzip.GzipFile(fileobj=raw) as f:
+            records = json.load(f)
+    if name:
+        _observe_io('read', name, started, st.st_size)
+    return (st.st_ino, st.st_mtime_ns, st.st_size), records
+
+
+def write_gzip_json(path, records, name=None):
+    started = time.perf_counter()
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with gzip.open(tmp_path, 'wt') as f:
+        json.dump(records, f)
+    if name:
+        _observe_io('write', name, started, os.path.getsize(tmp_path))
+    os.replace(tmp_path, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class PartitionedLog:
+    """A collection split into one partition per period of ``createdAt``.
+
+    A partition is either open, an ``AppendLog`` (``<period>.json`` plus
+    ``<period>.log``), or closed, gzipped JSON (``<period>.json.gz``) that
+    only changes when a late write lands in it. New periods start open;
+    ``maintain`` closes every open partition but the current one.
+    ``manifest.json`` keeps the record count and id range of the closed
+    partitions so counting, ``next_id`` and id lookups don't decompress
+    them; entries are checked against the file they describe. It also keeps
+    the highest id ever archived, which ``next_id`` never goes below.
+
+    Offers the same operations as ``AppendLog`` so the JSON engine can treat
+    it as one. Writes (``append``, ``replace``, ``maintain``) must hold the
+    engine's commit lock.
+    """
+
+    def __init__(self, directory, period='month', fields=(), compact_bytes=DEFAULT_LOG_COMPACT_BYTES,
+                 on_compact_needed=None, on_new_partition=None, keep=0, archive_dir=None, name=None):
+        self.directory = directory
+        self.name = name or os.path.basename(directory)
+        self.log_path = directory
+        self.period = period
+        self.width = 10 if period == 'day' else 7
+        self.fields = fields
+        self.compact_bytes = compact_bytes
+        self.on_compact_needed = on_compact_needed
+        self.on_new_partition = on_new_partition
+        self.keep = keep
+        self.archive_dir = archive_dir
+        self._lock = threading.RLock()
+        self._open = {}  # period -> AppendLog
+        self._closed = {}  # period -> (file version, records, CollectionIndex)
+        self._manifest = (None, {})  # (file version, entries)
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def hits(self):
+        return sum(log.hits for log in list(self._open.values()))
+
+    @property
+    def misses(self):
+        return sum(log.misses for log in list(self._open.values()))
+
+    def _path(self, period, suffix='.json'):
+        return os.path.join(self.directory, period + suffix)
+
+    def partition_of(self, record):
+        value = record.get(PARTITION_FIELD)
+        if isinstance(value, str) and _DATE_RE.match(value):
+            return value[:self.width]
+        return UNDATED
+
+    def current_period(self):
+        return date.today().isoformat()[:self.width]
+
+    def _scan(self):
+        """Sorted ``(period, closed)`` pairs on disk, opening logs for new open partitions."""
+        open_periods, closed_periods = set(), set()
+        for name in os.listdir(self.directory):
+            if name.endswith('.json.gz'):
+                closed_periods.add(name[:-len('.json.gz')])
+            elif name.endswith('.json') and name != MANIFEST:
+                open_periods.add(name[:-len('.json')])
+        open_periods -= closed_periods  # Left over from an interrupted close; the gzip file is complete
+        with self._lock:
+            for period in set(self._open) - open_periods:
+                # Closed or archived by another worker; readers still holding the log fall back in _read
+                self._open.pop(period).close()
+            for period in open_periods - set(self._open):
+                self._open[period] = AppendLog(self._path(period), self.compact_bytes, self.on_compact_needed,
+                                               self.fields, self.name)
+        return sorted([(p, False) for p in open_periods] + [(p, True) for p in closed_periods])
+
+    def _closed_partition(self, period):
+        """``(records, index)`` of a closed partition, cached until its file changes."""
+        path = self._path(period, '.json.gz')
+        cached = self._closed.get(period)
+        if cached:
+            st = os.stat(path)
+            if cached[0] == (st.st_ino, st.st_mtime_ns, st.st_size):
+                return cached[1], cached[2]
+        version, records = read_gzip_json(path, self.name)
+        index = CollectionIndex(self.fields, records)
+        self._closed[period] = (version, records, index)
+        return records, index
+
+    def _read(self, period, closed, from_log, from_closed):
+        if not closed:
+            log = self._open.get(period)
+            if log is not None:
+                try:
+                    result = from_log(log)
+                except ValueError:  # I/O on the closed file
+                    if not log.closed:
+                        raise
+                else:
+                    if not os.path.exists(self._path(period, '.json.gz')):
+                        return result
+            # Closed since the scan; the gzip file has everything the log had
+        try:
+            return from_closed(*self._closed_partition(period))
+        except FileNotFoundError:  # Archived since the scan
+            return from_closed([], CollectionIndex(self.fields))
+
+    def _stats(self, period):
+        """``(count, lowest int id, highest int id)`` of a closed partition."""
+        path = self._path(period, '.json.gz')
+        entry = self._read_manifest().get(period)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return 0, 0, 0
+        if entry and entry['version'] == [st.st_ino, st.st_mtime_ns, st.st_size]:
+            return entry['count'], entry['minId'], entry['maxId']
+        records, _ = self._closed_partition(period)
+        entry = self._manifest_entry(period, records)
+        return entry['count'], entry['minId'], entry['maxId']
+
+    def _read_manifest(self):
+        path = self._path(MANIFEST, '')
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return {}
+        version = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if self._manifest[0] != version:
+            with open(path, 'r') as f:
+                self._manifest = (version, json.load(f))
+        return self._manifest[1]
+
+    def _manifest_entry(self, period, records):
+        st = os.stat(self._path(period, '.json.gz'))
+        ids = [r['id'] for r in records if isinstance(r.get('id'), int)]
+        return {
+            'version': [st.st_ino, st.st_mtime_ns, st.st_size],
+            'count': len(records),
+            'minId': min(ids, default=0),
+            'maxId': max(ids, default=0)
+        }
+
+    def _write_manifest(self, updates, removed=()):
+        manifest = {k: v for k, v in self._read_manifest().items() if k not in removed}
+        manifest.update(updates)
+        write_json_file(self._path(MANIFEST, ''), manifest, 'compact')
+
+    def records(self):
+        result = []
+        for period, closed in self._scan():
+            result += self._read(period, closed, AppendLog.records, lambda records, index: records)
+        return result
+
+    def range(self, since=None, until=None):
+        """Records ``in_range(since, until)``, reading only the partitions that can hold them."""
+        result = []
+        for period, closed in self._scan():
+            if period == UNDATED or _period_in_range(period, since, until):
+                records = self._read(period, closed, AppendLog.records, lambda records, index: records)
+                result += [r for r in records if in_range(r.get(PARTITION_FIELD, ''), since, until)]
+        return result
+
+    def iter_range(self, since=None, until=None):
+        """Like ``range``, but one partition at a time. Closed partitions that
+        aren't cached already are read without being cached."""
+        for period, closed in self._scan():
+            if period == UNDATED or _period_in_range(period, since, until):
+                if closed and period not in self._closed:
+                    try:
+                        records = read_gzip_json(self._path(period, '.json.gz'), self.name)[1]
+                    except FileNotFoundError:  # Archived since the scan
+                        records = []
+                else:
+                    records = self._read(period, closed, AppendLog.records, lambda records, index: records)
+                yield from (r for r in records if in_range(r.get(PARTITION_FIELD, ''), since, until))
+
+    def get(self, id):
+        for period, closed in self._scan():
+            if closed and isinstance(id, int):
+                count, low, high = self._stats(period)
+                if not count or not low <= id <= high:
+                    continue
+            record = self._read(period, closed, lambda log: log.get(id), lambda records, index: index.by_id.get(id))
+            if record is not None:
+                return record
+        return None
+
+    def find(self, field, value):
+        result = []
+        for period, closed in self._scan():
+            result += self._read(
+                period, closed, lambda log: log.find(field, value),
+                lambda records, index: index.find(field, value) if field in self.fields
+                else [r for r in records if r.get(field) == value])
+        return result
+
+    def find_range(self, field, value, since=None, until=None):
+        """Like ``find``, reading only the partitions that can hold records ``in_range(since, until)``."""
+        result = []
+        for period, closed in self._scan():
+            if period == UNDATED or _period_in_range(period, since, until):
+                records = self._read(
+                    period, closed, lambda log: log.find(field, value),
+                    lambda records, index: index.find(field, value) if field in self.fields
+                    else [r for r in records if r.get(field) == value])
+                result += [r for r in records if in_range(r.get(PARTITION_FIELD, ''), since, until)]
+        return result
+
+    def version(self):
+        return tuple((period, self._stats(period) if closed else
+                      self._read(period, closed, AppendLog.version, lambda r, i: self._stats(period)))
+                     for period, closed in self._scan())
+
+    def count(self):
+        return sum(self._stats(period)[0] if closed else self._read(period, closed, AppendLog.count, lambda r, i: len(r))
+                   for period, closed in self._scan())
+
+    def next_id(self):
+        highest = self._read_manifest().get(ARCHIVED_MAX_ID, 0)
+        for period, closed in self._scan():
+            if closed:
+                highest = max(highest, self._stats(period)[2])
+            else:
+                highest = max(highest, self._read(period, closed, AppendLog.next_id, lambda r, i: i.max_id + 1) - 1)
+        return highest + 1
+
+    def _locate(self, partitions, stats, id):
+        """The period holding the record with ``id``, if any."""
+        for period, closed in partitions.items():
+            if closed:
+                count, low, high = stats[period]
+                if isinstance(id, int) and (not count or not low <= id <= high):
+                    continue
+                if id in self._closed_partition(period)[1].by_id:
+                    return period
+            elif self._open[period].get(id) is not None:
+                return period
+        return None
+
+    def _open_log(self, period):
+        if period not in self._open:
+            write_json_file(self._path(period), [])
+            self._open[period] = AppendLog(self._path(period), self.compact_bytes, self.on_compact_needed,
+                                           self.fields, self.name)
+            if self.on_new_partition:
+                self.on_new_partition()
+        return self._open[period]
+
+    def _rewrite(self, period, entries):
+        records = list(self._closed_partition(period)[0])
+        for entry in entries:
+            if entry['op'] == 'put':
+                id = entry['record'].get('id')
+                i = next((i for i, r in enumerate(records) if r.get('id') == id), None)
+                if i is None:
+                    records.append(entry['record'])
+                else:
+                    records[i] = entry['record']
+            else:
+                records = [r for r in records if r.get('id') != entry['id']]
+        write_gzip_json(self._path(period, '.json.gz'), records, self.name)
+        self._write_manifest({period: self._manifest_entry(period, records)})
+
+    def append(self, entries):
+        """Apply put/delete entries, routing each record to its period's partition."""
+        with self._lock:
+            partitions = dict(self._scan())
+            stats = {period: self._stats(period) for period, closed in partitions.items() if closed}
+            groups = {}
+            for entry in entries:
+                if entry.get('op') == 'put':
+                    record = entry['record']
+                    period = self.partition_of(record)
+                    found = self._locate(partitions, stats, record.get('id')) if record.get('id') is not None else None
+                    if found is not None and found != period:
+                        # Its date changed: move it
+                        groups.setdefault(found, []).append({'op': 'delete', 'id': record.get('id')})
+                    groups.setdefault(period, []).append(entry)
+                elif entry.get('op') == 'delete':
+                    found = self._locate(partitions, stats, entry.get('id'))
+                    if found is not None:
+                        groups.setdefault(found, []).append(entry)
+            for period, group in groups.items():
+                if partitions.get(period):
+                    self._rewrite(period, group)
+                else:
+                    self._open_log(period).append(group)
+
+    def replace(self, records):
+        """Rewrite the whole collection: past periods closed, the current one open."""
+        with self._lock:
+            groups = {}
+            for record in records:
+                groups.setdefault(self.partition_of(record), []).append(record)
+            current = self.current_period()
+            existing = dict(self._scan())
+            updates = {}
+            for period, group in groups.items():
+                if period >= current:
+                    _remove(self._path(period, '.json.gz'))
+                    self._open_log(period).replace(group)
+                else:
+                    write_gzip_json(self._path(period, '.json.gz'), group, self.name)
+                    updates[period] = self._manifest_entry(period, group)
+                    self._drop_open(period)
+            for period in set(existing) - set(groups):
+                _remove(self._path(period, '.json.gz'))
+                self._drop_open(period)
+            self._write_manifest(updates, removed=set(existing) - set(updates))
+
+    def _drop_open(self, period):
+        log = self._open.pop(period, None)
+        if log is not None:
+            log.close()
+        _remove(self._path(period))
+        _remove(self._path(period, '.log'))
+
+    def compact(self):
+        for log in list(self._open.values()):
+            log.compact()
+
+    def close(self):
+        with self._lock:
+            for period in list(self._open):
+                self._open.pop(period).close()
+
+    def _oldest_kept(self, current):
+        """The oldest period ``keep`` leaves in the live store."""
+        if self.period == 'day':
+            return (date.fromisoformat(current) - timedelta(days=self.keep - 1)).isoformat()
+        year, month = map(int, current.split('-'))
+        months = year * 12 + month - 1 - (self.keep - 1)
+        return f'{months // 12:04d}-{months % 12 + 1:02d}'
+
+    def maintain(self):
+        """Close the open partitions of finished periods and archive those past ``keep``.
+
+        Returns the periods closed and the periods archived.
+        """
+        with self._lock:
+            current = self.current_period()
+            partitions = self._scan()
+            closed_now, archived = [], []
+            updates = {}
+            for period, closed in partitions:
+                if closed or period == UNDATED or period >= current:
+                    continue
+                log = self._open[period]
+                with log._lock, log._file_lock(fcntl and fcntl.LOCK_EX):
+                    log._refresh()
+                    records = list(log._records)
+                    write_gzip_json(self._path(period, '.json.gz'), records, self.name)
+                    updates[period] = self._manifest_entry(period, records)
+                self._drop_open(period)  # After the file lock is released, as this closes the file
+                closed_now.append(period)
+
+            # Leftovers of interrupted closes and of logs reopened during one
+            for name in os.listdir(self.directory):
+                base = name[:-len('.json')] if name.endswith('.json') else name[:-len('.log')] if name.endswith('.log') else None
+                if base and name != MANIFEST and os.path.exists(self._path(base, '.json.gz')):
+                    _remove(os.path.join(self.directory, name))
+
+            closed = [p for p, c in self._scan() if c]
+            manifest = self._read_manifest()
+            for period in closed:
+                if period not in updates and period not in manifest:
+                    updates[period] = self._manifest_entry(period, self._closed_partition(period)[0])
+            if self.keep and self.archive_dir:
+                oldest = self._oldest_kept(current)
+                os.makedirs(self.archive_dir, exist_ok=True)
+                archived_max_id = manifest.get(ARCHIVED_MAX_ID, 0)
+                for period in closed:
+                    if period != UNDATED and period < oldest:
+                        archived_max_id = max(archived_max_id, updates[period]['maxId'] if period in updates
+                                              else self._stats(period)[2])
+                        os.replace(self._path(period, '.json.gz'), os.path.join(self.archive_dir, period + '.json.gz'))
+                        archived.append(period)
+            if archived:
+                updates[ARCHIVED_MAX_ID] = archived_max_id
+            if updates or archived:
+                self._write_manifest({p: e for p, e in updates.items() if p not in archived}, removed=archived)
+            return closed_now, archived
+
+    def archived(self):
+        """Records of every archived partition, oldest first."""
+        if not self.archive_dir or not os.path.isdir(self.archive_dir):
+            return []
+        result = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            if name.endswith('.json.gz'):
+                result += read_gzip_json(os.path.join(self.archive_dir, name), self.name)[1]
+        return result
+
+    def iter_archived(self, since=None, until=None):
+        """Archived records ``in_range(since, until)``, one partition at a time."""
+        if not self.archive_dir or not os.path.isdir(self.archive_dir):
+            return
+        for name in sorted(os.listdir(self.archive_dir)):
+            period = name[:-len('.json.gz')]
+            if name.endswith('.json.gz') and (period == UNDATED or _period_in_range(period, since, until)):
+                records = read_gzip_json(os.path.join(self.archive_dir, name), self.name)[1]
+                yield from (r for r in records if in_range(r.get(PARTITION_FIELD, ''), since, until))
+
+
+class JsonStorage(Storage):
+    """One pretty-printed JSON file per collection (the original layout)."""
+
+    def __init__(self, data_dir, collections=(), log_collections=(), compact_bytes=DEFAULT_LOG_COMPACT_BYTES,
+                 indexes=None, partition_collections=(), partition_period='month', partition_keep=0):
+        super().__init__(collections, indexes)
+        self.data_dir = data_dir
+        self.compact_bytes = compact_bytes
+        self.partition_period = partition_period
+        self.partition_keep = partition_keep
+        os.makedirs(data_dir, exist_ok=True)
+        for name in self.collections:
+            path = self._path(name)
+            if name not in partition_collections and not os.path.exists(path):
+                write_json_file(path, [])
+                print(f"Created {name}.json with default data")
+        self._compactor = None
+        self._logs = {
+            name: AppendLog(self._path(name), compact_bytes, self._schedule_compaction, self.indexes.get(name, ()),
+                            name)
+            for name in log_collections if name not in partition_collections
+        }
+        self._partitions = {}
+        self._journal_path = os.path.join(data_dir, '.commit.json')
+        self._lock_file = open(os.path.join(data_dir, '.lock'), 'a+b')
+        with self._lock, self._begin(recover=False):
+            for name in partition_collections:
+                self._partitions[name] = self._logs[name] = self._open_partitions(name)
+            self._recover()
+
+    def _partitioned(self, name, directory):
+        return PartitionedLog(directory, self.partition_period, self.indexes.get(name, ()), self.compact_bytes,
+                              self._schedule_compaction, self._schedule_maintenance, self.partition_keep,
+                              os.path.join(self.data_dir, 'archive', name), name)
+
+    def _open_partitions(self, name):
+        """The partitioned log of ``name``, splitting ``<name>.json`` and its log into it on first use."""
+        directory = os.path.join(self.data_dir, name)
+        if not os.path.isdir(directory):
+            records = []
+            if os.path.exists(self._path(name)):
+                log = AppendLog(self._path(name))
+                records = log.records()
+                log.close()
+            tmp_dir = directory + '.tmp'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            split = self._partitioned(name, tmp_dir)
+            split.replace(records)
+            split.close()
+            os.rename(tmp_dir, directory)
+            if records:
+                print(f"Split {len(records)} {name} records into {directory}; {name}.json is no longer used")
+        return self._partitioned(name, directory)
+
+    def _path(self, name):
+        return os.path.join(self.data_dir, f'{name}.json')
+
+    @contextmanager
+    def _begin(self, recover=True):
+        if fcntl is not None:
+            _flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            if recover:
+                self._recover()
+            yield
+        finally:
+            if fcntl is not None:
+                _flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _recover(self):
+        """Finish a commit that a crashed or failed writer left half-applied."""
+        if not os.path.exists(self._journal_path):
+            return
+        try:
+            with open(self._journal_path, 'r') as f:
+                journal = json.load(f)
+        except ValueError:
+            # The crash happened while the journal itself was written, so nothing was applied yet
+            os.remove(self._journal_path)
+            return
+        for tmp_name, name in journal['renames']:
+            tmp_path = os.path.join(self.data_dir, tmp_name)
+            if os.path.exists(tmp_path):
+                os.replace(tmp_path, os.path.join(self.data_dir, name))
+        for name, entries in journal['logs'].items():
+            self._logs[name].append(entries)
+        os.remove(self._journal_path)
+        print(f"Recovered interrupted commit from {self._journal_path}")
+
+    def _commit(self, txn):
+        renames = []  # (temp path, final path, name, new records, index, index edits)
+        log_entries = {}
+        for name, changes in txn.changes.items():
+            if name in self._logs:
+                if changes.replaced is not None:
+                    self._logs[name].replace(changes.replaced)
+                    continue
+                entries = [{'op': 'put', 'record': r} for r in changes.updated.values()]
+                entries += [{'op': 'delete', 'id': id} for id in changes.deleted]
+                entries += [{'op': 'put', 'record': r} for r in changes.inserted]
+                if entries:
+                    log_entries[name] = entries
+                continue
+            if changes.replaced is not None:
+                items, index, edits = list(changes.replaced), None, []
+            else:
+                items, index = self._indexed(name)
+                items, edits = self._apply_changes(items, index, changes)
+            path = self._path(name)
+            renames.append((write_temp_json(path, items, name=name), path, name, items, index, edits))
+
+        journal = None
+        if len(renames) + sum(len(e) for e in log_entries.values()) > 1:
+            journal = {
+                'renames': [(os.path.basename(tmp), os.path.basename(path)) for tmp, path, *_ in renames],
+                'logs': log_entries
+            }
+            write_json_file(self._journal_path, journal, 'compact')
+        for tmp_path, path, name, items, index, edits in renames:
+            os.replace(tmp_path, path)
+            self._cache[name] = (self._version(os.stat(path)), items)
+            if index is not None:
+                for edit, *args in edits:
+                    edit(*args)
+                self._index_cache[name] = (items, index)
+        for name, entries in log_entries.items():
+            self._logs[name].append(entries)
+        if journal is not None:
+            os.remove(self._journal_path)
+
+    @staticmethod
+    def _apply_changes(items, index, changes):
+        """New record list for ``changes`` plus the index edits that match it.
+
+        The edits are returned rather than made so the shared index is only
+        touched once the new file is in place.
+        """
+        items = list(items)
+        edits = []
+        if changes.updated:
+            positions = {id(r): i for i, r in enumerate(items)}
+            for record_id, record in changes.updated.items():
+                old = index.by_id.get(record_id)
+                if old is not None:
+                    items[positions[id(old)]] = record
+                    edits.append((index.replace, old, record))
+        if changes.deleted:
+            edits += [(index.remove, r) for r in items if r.get('id') in changes.deleted]
+            items = [r for r in items if r.get('id') not in changes.deleted]
+        items.extend(changes.inserted)
+        edits += [(index.add, r) for r in changes.inserted]
+        return items, edits
+
+    def _schedule(self, what, job):
+        with self._lock:
+            if self._compactor is None:
+                self._compactor = _Compactor()
+                self._compactor.start()
+        self._compactor.pending.put((what, job))
+
+    def _schedule_compaction(self, log):
+        self._schedule(f'Compaction of {log.log_path}', log.compact)
+
+    def _schedule_maintenance(self):
+        self._schedule('Partition maintenance', self.maintain)
+
+    def compact(self):
+        """Fold every mutation log into its snapshot now."""
+        for log in self._logs.values():
+            log.compact()
+
+    def close(self):
+        with self._lock:
+            compactor, self._compactor = self._compactor, None
+        if compactor is not None:
+            # Its jobs take the store lock, so wait for them outside it
+            compactor.stop()
+            compactor.join()
+        with self._lock:
+            for log in self._logs.values():
+                log.close()
+            self._lock_file.close()
+
+    def maintain(self):
+        """Close finished partitions and archive old ones now."""
+        results = {}
+        with self._lock, self._begin():
+            for name, partitions in self._partitions.items():
+                results[name] = partitions.maintain()
+        return results
+
+    def reformat(self, fmt=None):
+        """Rewrite every collection file and partition snapshot in ``fmt`` (default
+        ``POS_JSON_FORMAT``); returns ``{path: (bytes before, bytes after)}``."""
+        paths = [os.path.join(self.data_dir, f) for f in os.listdir(self.data_dir)
+                 if f.endswith('.json') and not f.startswith('.')]
+        for name in self._partitions:
+            directory = os.path.join(self.data_dir, name)
+            paths += [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.json') and f != MANIFEST]
+        sizes = {}
+        with self._lock, self._begin():
+            for path in sorted(paths):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                write_json_file(path, decode_json(data), fmt)
+                sizes[path] = (len(data), os.path.getsize(path))
+        return sizes
+
+    def cache_stats(self):
+        stats = super().cache_stats()
+        for name, log in self._logs.items():
+            stats[name] = {'hits': log.hits, 'misses': log.misses}
+        return stats
+
+    @staticmethod
+    def _version(st):
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _records(self, name):
+        path = self._path(name)
+        try:
+            version = self._version(os.stat(path))
+        except FileNotFoundError:
+            self._cache[name] = (None, [])
+            return self._cache[name][1]
+        cached = self._cache.get(name)
+        if cached and cached[0] == version:
+            self.hits[name] += 1
+            return cached[1]
+        self.misses[name] += 1
+        started = time.perf_counter()
+        # Key the cache on the file actually read, in case it was replaced after the stat
+        with open(path, 'rb') as f:
+            version = self._version(os.fstat(f.fileno()))
+            data = f.read()
+        records = decode_json(data)
+        _observe_io('read', name, started, len(data))
+        self._cache[name] = (version, records)
+        return records
+
+    def load(self, name):
+        if name in self._logs:
+            return self._logs[name].records()
+        return super().load(name)
+
+    def version(self, name):
+        if name in self._logs:
+            return self._logs[name].version()
+        try:
+            return self._version(os.stat(self._path(name)))
+        except FileNotFoundError:
+            return None
+
+    def load_range(self, name, since=None, until=None):
+        if name in self._partitions:
+            return self._partitions[name].range(since, until)
+        if name in self._logs and (since or until):
+            return [r for r in self._logs[name].records() if in_range(r.get(PARTITION_FIELD, ''), since, until)]
+        return super().load_range(name, since, until)
+
+    def load_archived(self, name):
+        if name in self._partitions:
+            return self._partitions[name].archived()
+        return []
+
+    def iter_range(self, name, since=None, until=None, archived=False):
+        if name not in self._partitions:
+            return super().iter_range(name, since, until, archived)
+        partitions = self._partitions[name]
+        if archived:
+            return itertools.chain(partitions.iter_archived(since, until), partitions.iter_range(since, until))
+        return partitions.iter_range(since, until)
+
+    def count(self, name):
+        if name in self._logs:
+            return self._logs[name].count()
+        return super().count(name)
+
+    def next_id(self, name):
+        if name in self._logs:
+            return self._logs[name].next_id()
+        return super().next_id(name)
+
+    def get(self, name, id):
+        if name in self._logs:
+            return self._logs[name].get(id)
+        return super().get(name, id)
+
+    def find(self, name, field, value):
+        if name in self._logs:
+            return self._logs[name].find(field, value)
+        return super().find(name, field, value)
+
+    def find_range(self, name, field, value, since=None, until=None):
+        if name in self._partitions:
+            return self._partitions[name].find_range(field, value, since, until)
+        return super().find_range(name, field, value, since, until)
+
+
+_NAME_RE = re.compile(r'^[a-z][a-z0-9_]*$')
+
+
+class SqliteStorage(Storage):
+    """One table per collection: ``(seq, id, data)`` with an index on ``id``.
+
+    ``seq`` preserves insertion order so ``load`` returns records in the same
+    order the JSON files did. Secondary indexes are SQLite expression indexes
+    on ``json_extract(data, '$.<field>')``.
+    """
+
+    def __init__(self, db_path, collections=(), indexes=None):
+        super().__init__(collections, indexes)
+        self.db_path = db_path
+        self._created = set()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS _versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+        for name in self.collections:
+            self._ensure_table(name)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close this thread's connection. Other threads' connections can only be
+        closed by their own thread; they go when the store is garbage collected."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _ensure_table(self, name):
+        if name in self._created:
+            return
+        if not _NAME_RE.match(name):
+            raise ValueError(f'Invalid collection name: {name!r}')
+        conn = self._conn()
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{name}" '
+                     '(seq INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER, data TEXT NOT NULL)')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}_id" ON "{name}" (id)')
+        for field in self.indexes.get(name, ()):
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}_{field}" ON "{name}" ({self._field_expr(field)})')
+        self._created.add(name)
+
+    @staticmethod
+    def _field_expr(field):
+        # Inlined rather than bound so queries match the expression indexes
+        if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', field):
+            raise ValueError(f'Invalid field name: {field!r}')
+        return f"json_extract(data, '$.{field}')"
+
+    def _query(self, name, sql, params=()):
+        self._ensure_table(name)
+        return self._conn().execute(sql.format(t=f'"{name}"'), params)
+
+    @contextmanager
+    def _begin(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _commit(self, txn):
+        conn = self._conn()
+        for name, changes in txn.changes.items():
+            self._ensure_table(name)
+            table = f'"{name}"'
+            insert_sql = f'INSERT INTO {table} (id, data) VALUES (?, ?)'
+            started = time.perf_counter()
+            if changes.replaced is not None:
+                rows = [(r.get('id'), json.dumps(r)) for r in changes.replaced]
+                conn.execute(f'DELETE FROM {table}')
+                conn.executemany(insert_sql, rows)
+                nbytes = sum(len(data) for _, data in rows)
+            else:
+                updated = [(json.dumps(r), id) for id, r in changes.updated.items()]
+                inserted = [(r.get('id'), json.dumps(r)) for r in changes.inserted]
+                conn.executemany(
+                    f'UPDATE {table} SET data = ? WHERE seq = '
+                    f'(SELECT seq FROM {table} WHERE id = ? ORDER BY seq LIMIT 1)', updated)
+                conn.executemany(f'DELETE FROM {table} WHERE id = ?', [(id,) for id in changes.deleted])
+                conn.executemany(insert_sql, inserted)
+                nbytes = sum(len(data) for data, _ in updated) + sum(len(data) for _, data in inserted)
+            _observe_io('write', name, started, nbytes)
+            conn.execute('INSERT INTO _versions (name, version) VALUES (?, 1) '
+                         'ON CONFLICT(name) DO UPDATE SET version = version + 1', (name,))
+        conn.execute('COMMIT')
+
+    def _current_version(self, name):
+        row = self._conn().execute('SELECT version FROM _versions WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def version(self, name):
+        return self._current_version(name)
+
+    def _records(self, name):
+        self._ensure_table(name)
+        version = self._current_version(name)
+        cached = self._cache.get(name)
+        if cached and cached[0] == version:
+            self.hits[name] += 1
+            return cached[1]
+        self.misses[name] += 1
+        started = time.perf_counter()
+        # Read inside one transaction so the rows match the version we store
+        conn = self._conn()
+        own_transaction = not conn.in_transaction
+        if own_transaction:
+            conn.execute('BEGIN')
+        try:
+            version = self._current_version(name)
+            rows = conn.execute(f'SELECT data FROM "{name}" ORDER BY seq').fetchall()
+        finally:
+            if own_transaction:
+                conn.execute('COMMIT')
+        records = [json.loads(data) for (data,) in rows]
+        _observe_io('read', name, started, sum(len(data) for (data,) in rows))
+        self._cache[name] = (version, records)
+        return records
+
+    def count(self, name):
+        return self._query(name, 'SELECT COUNT(*) FROM {t}').fetchone()[0]
+
+    def next_id(self, name):
+        return self._query(name, 'SELECT COALESCE(MAX(id), 0) + 1 FROM {t}').fetchone()[0]
+
+    def get(self, name, id):
+        started = time.perf_counter()
+        row = self._query(name, 'SELECT data FROM {t} WHERE id = ? ORDER BY seq LIMIT 1', (id,)).fetchone()
+        _observe_io('read', name, started, len(row[0]) if row else 0)
+        return json.loads(row[0]) if row else None
+
+    def find(self, name, field, value):
+        started = time.perf_counter()
+        rows = self._query(name, f'SELECT data FROM {{t}} WHERE {self._field_expr(field)} = ? ORDER BY seq',
+                           (value,)).fetchall()
+        _observe_io('read', name, started, sum(len(data) for (data,) in rows))
+        return [json.loads(data) for (data,) in rows]
+
+    def load_range(self, name, since=None, until=None):
+        if not (since or until) or PARTITION_FIELD not in self.indexes.get(name, ()):
+            return super().load_range(name, since, until)
+        expr = self._field_expr(PARTITION_FIELD)
+        clauses, params = [], []
+        if since:
+            clauses.append(f'{expr} >= ?')
+            params.append(since)
+        if until:
+            # Same as in_range's prefix test, but in a form the index can serve
+            clauses.append(f'{expr} < ?')
+            params.append(until + '\U0010ffff')
+        rows = self._query(name, f'SELECT data FROM {{t}} WHERE {" AND ".join(clauses)} ORDER BY seq', params)
+        return [json.loads(data) for (data,) in rows]
+
+    def iter_range(self, name, since=None, until=None, archived=False):
+        # Rows are decoded as the cursor reaches them, bypassing the collection cache
+        expr = self._field_expr(PARTITION_FIELD)
+        clauses, params = ['1'], []
+        if since:
+            clauses.append(f'{expr} >= ?')
+            params.append(since)
+        if until:
+            clauses.append(f'{expr} < ?')
+            params.append(until + '\U0010ffff')
+        rows = self._query(name, f'SELECT data FROM {{t}} WHERE {" AND ".join(clauses)} ORDER BY seq', params)
+        for (data,) in rows:
+            yield json.loads(data)
+
+
+def _names(variable, default):
+    return [n.strip() for n in os.environ.get(variable, default).split(',') if n.strip()]
+
+
+def _log_collections():
+    return _names('POS_LOG_COLLECTIONS', DEFAULT_LOG_COLLECTIONS)
+
+
+def _partition_collections():
+    return _names('POS_PARTITION_COLLECTIONS', DEFAULT_PARTITION_COLLECTIONS)
+
+
+def open_json_storage(data_dir, collections=(), indexes=None, only=None):
+    """A ``JsonStorage`` configured from the environment.
+
+    ``only`` limits the log and partitioned collections to those names.
+    """
+    period = os.environ.get('POS_PARTITION_PERIOD', 'month').lower()
+    if period not in ('month', 'day'):
+        raise ValueError(f'Unknown POS_PARTITION_PERIOD: {period!r}')
+    if JSON_FORMAT not in JSON_FORMATS:
+        raise ValueError(f'Unknown POS_JSON_FORMAT: {JSON_FORMAT!r}')
+    keep = lambda names: [n for n in names if only is None or n in only]
+    return JsonStorage(data_dir, collections, keep(_log_collections()),
+                       int(os.environ.get('POS_LOG_COMPACT_BYTES', DEFAULT_LOG_COMPACT_BYTES)), indexes,
+                       keep(_partition_collections()), period, int(os.environ.get('POS_PARTITION_KEEP', 0)))
+
+
+def open_storage(data_dir, collections=(), indexes=None, only=None, db_path=None):
+    """Build the engine selected by ``POS_STORAGE``.
+
+    ``indexes`` maps a collection name to the fields to index besides ``id``.
+    ``only`` is passed on to ``open_json_storage``. ``db_path`` is the SQLite
+    file, by default ``POS_SQLITE_PATH`` or ``<data_dir>/pos.sqlite3``.
+    """
+    engine = os.environ.get('POS_STORAGE', 'json').lower()
+    if engine == 'sqlite':
+        db_path = db_path or os.environ.get('POS_SQLITE_PATH', os.path.join(data_dir, 'pos.sqlite3'))
+        indexes = dict(indexes or {})
+        for name in _partition_collections():
+            indexes[name] = list(indexes.get(name, ())) + [PARTITION_FIELD]
+        return SqliteStorage(db_path, collections, indexes)
+    if engine == 'json':
+        return open_json_storage(data_dir, collections, indexes, only)
+    raise ValueError(f'Unknown POS_STORAGE engine: {engine!r}')
+
+
+def import_json(source, target, collections):
+    """Copy every collection from one engine into another, replacing its contents."""
+    counts = {}
+    for name in collections:
+        records = source.load(name)
+        target.save(name, records)
+        counts[name] = len(records)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='POS storage maintenance')
+    sub = parser.add_subparsers(dest='command', required=True)
+    imp = sub.add_parser('import', help='Import data/*.json into the SQLite database')
+    imp.add_argument('--data-dir', default=os.path.join(os.path.dirname(__file__), 'data'))
+    imp.add_argument('--db', default=None, help='SQLite file (defaults to POS_SQLITE_PATH or <data-dir>/pos.sqlite3)')
+    comp = sub.add_parser('compact', help='Fold data/*.log mutation logs into their JSON snapshots')
+    comp.add_argument('--data-dir', default=os.path.join(os.path.dirname(__file__), 'data'))
+    maint = sub.add_parser('maintain', help='Close finished partitions and archive those past POS_PARTITION_KEEP')
+    maint.add_argument('--data-dir', default=os.path.join(os.path.dirname(__file__), 'data'))
+    fmt = sub.add_parser('reformat', help='Rewrite data/*.json in POS_JSON_FORMAT (or --format)')
+    fmt.add_argument('--data-dir', default=os.path.join(os.path.dirname(__file__), 'data'))
+    fmt.add_argument('--format', choices=JSON_FORMATS, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        open_json_storage(args.data_dir).compact()
+        print('Compacted mutation logs')
+
+    if args.command == 'maintain':
+        for name, (closed, archived) in open_json_storage(args.data_dir).maintain().items():
+            print(f"{name}: closed {', '.join(closed) or 'nothing'}, archived {', '.join(archived) or 'nothing'}")
+
+    if args.command == 'reformat':
+        sizes = open_json_storage(args.data_dir).reformat(args.format)
+        for path, (before, after) in sizes.items():
+            print(f'{os.path.relpath(path, args.data_dir)}: {before} -> {after} bytes')
+        before, after = (sum(s[i] for s in sizes.values()) for i in (0, 1))
+        print(f'Rewrote {len(sizes)} files in {args.format or JSON_FORMAT} format: {before} -> {after} bytes')
+
+    if args.command == 'import':
+        names = {f[:-5] for f in os.listdir(args.data_dir) if f.endswith('.json')}
+        names |= {n for n in _partition_collections() if os.path.isdir(os.path.join(args.data_dir, n))}
+        names = sorted(names)
+        db_path = args.db or os.environ.get('POS_SQLITE_PATH', os.path.join(args.data_dir, 'pos.sqlite3'))
+        source = open_json_storage(args.data_dir, only=names)
+        counts = import_json(source, SqliteStorage(db_path, names), names)
+        for name, count in counts.items():
+            print(f'{name}: {count} records')
+        print(f'Imported {sum(counts.values())} records into {db_path}')
+
+
+if __name__ == '__main__':
+    main()
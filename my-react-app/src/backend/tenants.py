@@ -0,0 +1,257 @@
+"""One store per shop.
+
+Each shop (tenant) keeps its products, sales and the rest of its data in
+a store of its own under ``<data dir>/tenants/<id>/``: a directory of
+collection files, or its own ``pos.sqlite3`` with ``POS_STORAGE=sqlite``.
+A shop's requests then only read, cache and lock its own collections,
+however many other shops there are. What spans shops stays in the
+account store in ``<data dir>``: users (each with a ``tenantId``), the
+``tenants`` registry, payments and the email queue.
+
+A shop's store, hooks and helpers are opened by the first request for
+it. At most ``POS_OPEN_TENANTS`` shops stay open per process; past that
+the least recently used shop no request is using has its store closed
+and its reminder scheduler stopped, and is opened again when needed.
+``Tenants.map`` runs a function over every shop on ``POS_TENANT_WORKERS``
+threads, for the main admin's views across shops.
+
+A data directory from before tenants holds a single shop at the top
+level. ``migrate`` copies it into shop 1 on first start. The maintenance
+commands of ``storage.py`` take a shop's directory as ``--data-dir``;
+``export.py``, ``aggregates.py`` and ``images.py`` take ``--tenant``.
+"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import aggregates
+import bom
+import events
+import fifo
+import images
+import reminder_schedule
+from changefeed import VERSIONS, ChangeFeed
+from producible import Producibility
+from reports import SalesColumns
+from storage import open_storage
+
+try:
+    import fcntl
+except ImportError:  # Windows: single worker only
+    fcntl = None
+
+TENANTS = 'tenants'
+DATA_DIR = os.environ.get('POS_DATA_DIR', os.path.join(os.path.dirname(__file__), 'data'))
+WORKERS = int(os.environ.get('POS_TENANT_WORKERS', 8))
+# Shops kept open per process (0 keeps every shop opened)
+MAX_OPEN = int(os.environ.get('POS_OPEN_TENANTS', 100))
+
+# A shop's collections, created empty with the shop
+COLLECTIONS = [
+    'products',
+    'sales',
+    'expenses',
+    'reminders',
+    'service_fees',
+    'discounts',
+    'credit_requests',
+    'settings',
+    'batches',
+    'production',
+    'price_history',
+    'time_entries',
+    'categories'
+]
+
+# Lookups kept indexed by the store, on top of the id index every collection gets
+INDEXES = {
+    'batches': ['productId'],
+    'sales': ['cashierId', 'clientId'],
+    'credit_requests': ['status'],
+    # The product change feed looks changes up by version
+    'products': ['syncVersion'],
+    'products_tombstones': ['syncVersion']
+}
+
+# Copied by migrate: the shop's data and the products change feed, so tills keep syncing where they were
+MIGRATED = COLLECTIONS + [VERSIONS, 'products_tombstones']
+
+
+def directory(data_dir, tenant_id):
+    return os.path.join(data_dir, 'tenants', str(tenant_id))
+
+
+def open_shop_storage(directory, collections=COLLECTIONS):
+    os.makedirs(directory, exist_ok=True)
+    return open_storage(directory, collections, INDEXES, db_path=os.path.join(directory, 'pos.sqlite3'))
+
+
+class Tenant:
+    """A shop's store, with the hooks and helpers the routes use on it."""
+
+    def __init__(self, id, directory, image_store):
+        self.id = id
+        self.store = store = open_shop_storage(directory)
+        aggregates.install(store)
+        bom.install(store)
+        fifo.install(store)
+        reminder_schedule.install(store)
+        self.product_feed = ChangeFeed(store, 'products')
+        events.install(store)  # After the change feed, so events carry the new syncVersion
+        self.event_hub = events.EventHub(store)
+        self.producibility = Producibility(store)
+        self.sales_columns = SalesColumns(store)
+        self.scheduler = reminder_schedule.ReminderScheduler(store)  # Started by Tenants, not by the CLIs
+        images.migrate(store, image_store)  # After the hooks, so tills reload the migrated products
+        self.users = 0  # Holders of the shop, see Tenants.get; guarded by the Tenants lock
+
+    def close(self):
+        self.scheduler.stop()
+        self.store.close()
+
+
+class Tenants:
+    """The ``Tenant`` of every shop in the ``tenants`` registry, opened on first use."""
+
+    def __init__(self, accounts, data_dir, image_store, workers=WORKERS, max_open=MAX_OPEN):
+        self.accounts = accounts
+        self.data_dir = data_dir
+        self.directory = os.path.join(data_dir, 'tenants')
+        self.image_store = image_store
+        self.max_open = max_open
+        self._open = OrderedDict()  # id -> Tenant, least recently used first
+        self._opening = {}  # id -> lock, so a slow shop to open doesn't hold up the others
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='tenant-fanout')
+
+    def path(self, tenant_id):
+        return directory(self.data_dir, tenant_id)
+
+    def _hold(self, tenant_id):
+        with self._lock:
+            tenant = self._open.get(tenant_id)
+            if tenant is not None:
+                tenant.users += 1
+                self._open.move_to_end(tenant_id)
+            return tenant
+
+    def get(self, tenant_id):
+        """The ``Tenant`` of a registered shop, or None.
+
+        The shop stays open until the caller hands it back with ``release``.
+        """
+        tenant = self._hold(tenant_id)
+        if tenant is not None:
+            return tenant
+        if not isinstance(tenant_id, int) or self.accounts.get(TENANTS, tenant_id) is None:
+            return None
+        with self._lock:
+            lock = self._opening.setdefault(tenant_id, threading.Lock())
+        with lock:
+            tenant = self._hold(tenant_id)
+            if tenant is not None:
+                return tenant
+            tenant = Tenant(tenant_id, self.path(tenant_id), self.image_store)
+            tenant.scheduler.start()
+            with self._lock:
+                tenant.users += 1
+                self._open[tenant_id] = tenant
+                evicted = self._evict()
+        for old in evicted:
+            old.close()
+        return tenant
+
+    def release(self, tenant):
+        with self._lock:
+            tenant.users -= 1
+            evicted = self._evict()
+        for old in evicted:
+            old.close()
+
+    def _evict(self):
+        """Take the least recently used idle shops past ``max_open`` out of ``_open``."""
+        evicted = []
+        for tenant_id, tenant in list(self._open.items()):
+            if not self.max_open or len(self._open) <= self.max_open:
+                break
+            if tenant.users == 0:
+                del self._open[tenant_id]
+                evicted.append(tenant)
+        return evicted
+
+    @contextmanager
+    def stores(self):
+        """Stores of the shops this process has open, held until the block exits."""
+        with self._lock:
+            tenants = list(self._open.values())
+            for tenant in tenants:
+                tenant.users += 1
+        try:
+            yield [tenant.store for tenant in tenants]
+        finally:
+            for tenant in tenants:
+                self.release(tenant)
+
+    def map(self, fn):
+        """``[(tenant record, fn(tenant))]`` for every shop, in id order, with the calls run in parallel."""
+        def call(record):
+            tenant = self.get(record['id'])
+            try:
+                return fn(tenant)
+            finally:
+                self.release(tenant)
+
+        records = self.accounts.load(TENANTS)
+        return list(zip(records, self._pool.map(call, records)))
+
+
+def registered(data_dir):
+    """Ids in the ``tenants`` registry of a data directory, for the command-line tools."""
+    return [record['id'] for record in open_storage(data_dir, (), only=()).load(TENANTS)]
+
+
+def shop_ids(parser, args):
+    """``[args.tenant]`` if that shop exists, else every registered shop; for CLIs with ``--tenant``."""
+    if args.tenant is None:
+        return registered(args.data_dir)
+    if not os.path.isdir(directory(args.data_dir, args.tenant)):
+        parser.error(f'No shop {args.tenant} in {args.data_dir}')
+    return [args.tenant]
+
+
+def migrate(tenants, data_dir):
+    """Copy the shop of a data directory from before tenants into shop 1.
+
+    Runs while some user has no ``tenantId``; those users then belong to
+    shop 1. The shop's files at the top of ``data_dir`` are left in place
+    and no longer used.
+    """
+    accounts = tenants.accounts
+    if all('tenantId' in user for user in accounts.load('users')):
+        return
+    os.makedirs(tenants.directory, exist_ok=True)
+    with open(os.path.join(tenants.directory, '.migrate.lock'), 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)  # Other workers wait, then find nothing to do
+        users = [user for user in accounts.load('users') if 'tenantId' not in user]
+        if not users:
+            return
+        copied = 0
+        if accounts.get(TENANTS, 1) is None:
+            legacy = open_storage(data_dir, (), INDEXES, only=MIGRATED)  # Declares nothing, so creates nothing
+            target = open_shop_storage(tenants.path(1))
+            for name in MIGRATED:
+                records = legacy.load_archived(name) + legacy.load(name)
+                target.save(name, records)
+                copied += len(records)
+        admin = next((user for user in users if user.get('role') == 'admin'), users[0])
+        with accounts.transaction() as txn:
+            if txn.get(TENANTS, 1) is None:
+                txn.insert(TENANTS, {'id': 1, 'name': admin.get('name', ''), 'createdAt': datetime.now().isoformat()})
+            for user in users:
+                txn.update('users', user['id'], {'tenantId': 1})
+        print(f"Moved {len(users)} users and {copied} shop records into {tenants.path(1)}; "
+              f"the shop's files in {data_dir} are no longer used")
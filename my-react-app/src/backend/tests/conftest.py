@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+# The backend modules import each other by name, as when run from src/backend
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def json_engine(monkeypatch):
+    """Tests get the JSON engine with its defaults, whatever the environment says."""
+    for name in list(os.environ):
+        if name.startswith('POS_'):
+            monkeypatch.delenv(name)
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def engine(request, monkeypatch):
+    """Runs the test once on each storage engine."""
+    monkeypatch.setenv('POS_STORAGE', request.param)
+    return request.param
+
+
+@pytest.fixture
+def store(tmp_path, engine):
+    """An empty shop store with the hooks checkout and stats rely on."""
+    import aggregates
+    import bom
+    import fifo
+    import tenants
+
+    store = tenants.open_shop_storage(str(tmp_path))
+    aggregates.install(store)
+    bom.install(store)
+    fifo.install(store)
+    return store
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    """The app module, imported afresh on an empty data directory, with owner@example.com as main admin."""
+    monkeypatch.setenv('POS_DATA_DIR', str(tmp_path))
+    monkeypatch.setenv('POS_MAIN_ADMIN_EMAILS', 'owner@example.com')
+    for name in ('app', 'tenants'):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    import app
+    return app
@@ -0,0 +1,49 @@
+from datetime import date
+
+import aggregates
+from aggregates import AGGREGATES, AGGREGATES_ID
+
+
+def stored(store):
+    return store.get(AGGREGATES, AGGREGATES_ID)
+
+
+def test_running_totals_match_a_rebuild_after_every_kind_of_write(store):
+    store.insert_many('sales', [
+        {'id': 1, 'total': 100, 'cogs': 60, 'createdAt': '2024-03-04T10:00:00'},
+        {'id': 2, 'total': 50, 'cogs': 20, 'createdAt': '2024-03-05T10:00:00'}
+    ])
+    store.insert('expenses', {'id': 1, 'amount': 30, 'createdAt': '2024-03-05T12:00:00'})
+    store.update('sales', 2, {'total': 80})
+    store.delete('sales', 1)
+    with store.transaction() as txn:
+        txn.insert('sales', {'id': 3, 'total': 10.1, 'cogs': 0.2, 'createdAt': '2024-03-06T10:00:00'})
+        txn.update('expenses', 1, {'amount': 35})
+
+    expected = aggregates.rebuild(store.load('sales'), store.load('expenses'))
+    assert aggregates.differences(stored(store), expected) == []
+    assert stored(store)['salesCount'] == 2 and stored(store)['totalExpenses'] == 35
+
+    summary = aggregates.summary(stored(store), today=date(2024, 3, 6))
+    assert summary['dailySales'] == 10.1
+    assert summary['weeklySales'] == 90.1  # Monday the 4th to Wednesday the 6th
+    assert summary['netProfit'] == 90.1 - 20.2 - 35
+
+
+def test_replacing_a_collection_rebuilds_the_totals(store):
+    store.insert('sales', {'id': 1, 'total': 100, 'cogs': 60, 'createdAt': '2024-03-04T10:00:00'})
+    store.save('sales', [{'id': 5, 'total': 7, 'cogs': 1, 'createdAt': '2024-03-08T10:00:00'}])
+    assert stored(store) == aggregates.rebuild(store.load('sales'), [])
+
+
+def test_differences_reports_drift(store):
+    store.insert('sales', {'id': 1, 'total': 100, 'cogs': 60, 'createdAt': '2024-03-04T10:00:00'})
+    expected = aggregates.rebuild(store.load('sales'), [])
+    drifted = {**expected, 'totalSales': 90}
+    assert aggregates.differences(drifted, expected) == ['totalSales: stored 90, expected 100']
+
+
+def test_records_without_a_date_are_counted_in_an_undated_bucket(store):
+    store.insert_many('expenses', [{'id': 1, 'amount': 5, 'createdAt': None}, {'id': 2, 'amount': 3}])
+    assert stored(store)['totalExpenses'] == 8
+    assert stored(store)['days'][''] == {'sales': 0, 'cogs': 0, 'count': 0, 'expenses': 8}
@@ -0,0 +1,83 @@
+import time
+
+import jwt
+import pytest
+
+import auth
+import tenants
+from auth import TokenCache, issue_token
+
+SECRET = 'test-secret'
+
+
+def users(store):
+    store.insert_many('users', [
+        {'id': 1, 'email': 'owner@example.com', 'role': 'admin', 'tenantId': 1},
+        {'id': 2, 'email': 'cashier@example.com', 'role': 'cashier', 'tenantId': 1}
+    ])
+    return issue_token(store.get('users', 1), SECRET), issue_token(store.get('users', 2), SECRET)
+
+
+def test_repeat_verifications_are_cache_hits(store):
+    owner, _ = users(store)
+    cache = TokenCache(store, SECRET)
+    claims, user = cache.verify(owner)
+    assert claims['id'] == 1 and claims['tenant'] == 1 and user['email'] == 'owner@example.com'
+    assert cache.verify(owner) == (claims, user)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    with pytest.raises(jwt.InvalidTokenError):
+        cache.verify(jwt.encode({'id': 1}, 'another-secret', algorithm='HS256'))
+
+
+def test_entries_live_until_the_token_expires(store, monkeypatch):
+    users(store)
+    cache = TokenCache(store, SECRET)
+    now = time.time()
+    token = jwt.encode({'id': 1, 'exp': int(now) + 60}, SECRET, algorithm='HS256')
+    legacy = jwt.encode({'id': 1}, SECRET, algorithm='HS256')
+    cache.verify(token)
+    cache.verify(legacy)
+
+    monkeypatch.setattr(auth.time, 'time', lambda: now + 59)
+    cache.verify(token)
+    cache.verify(legacy)
+    assert cache.hits == 2
+
+    # Past exp, and past NO_EXP_TTL for a token without one, both are checked again
+    monkeypatch.setattr(auth.time, 'time', lambda: now + 61 + auth.NO_EXP_TTL)
+    cache.verify(token)
+    cache.verify(legacy)
+    assert (cache.hits, cache.misses) == (2, 4)
+
+    with pytest.raises(jwt.ExpiredSignatureError):
+        cache.verify(jwt.encode({'id': 1, 'exp': int(now) - 10}, SECRET, algorithm='HS256'))
+
+
+def test_locked_and_deleted_users_are_seen_on_the_next_request(store, tmp_path):
+    owner, cashier = users(store)
+    cache = TokenCache(store, SECRET)
+    cache.verify(owner)
+    cache.verify(cashier)
+
+    other = tenants.open_shop_storage(str(tmp_path))  # Another worker
+    other.update('users', 1, {'locked': True})
+    assert cache.verify(owner)[1]['locked']
+    other.delete('users', 2)
+    claims, user = cache.verify(cashier)
+    assert claims['id'] == 2 and user is None
+    assert cache.hits == 0
+
+
+def test_the_least_recently_used_token_is_dropped(store):
+    owner, cashier = users(store)
+    legacy = jwt.encode({'id': 1}, SECRET, algorithm='HS256')
+    cache = TokenCache(store, SECRET, size=2)
+    cache.verify(owner)
+    cache.verify(cashier)
+    cache.verify(owner)
+    cache.verify(legacy)  # Drops the cashier's token, not the owner's
+    assert list(cache._entries) == [owner, legacy]
+
+    cache.verify(cashier)
+    assert (cache.hits, cache.misses) == (1, 4)
@@ -0,0 +1,35 @@
+import pytest
+
+import bom
+
+
+def test_nested_recipes_flatten_to_raw_materials(store):
+    store.insert_many('products', [
+        {'id': 1, 'name': 'Tomato'},
+        {'id': 2, 'name': 'Oil'},
+        {'id': 3, 'name': 'Sauce', 'recipe': [{'productId': 1, 'quantity': 3}, {'productId': 2, 'quantity': 1}]},
+        {'id': 4, 'name': 'Pasta', 'recipe': [{'productId': 3, 'quantity': 2}, {'productId': 2, 'quantity': 1}]}
+    ])
+    assert bom.requirements(store, 4) == [{'productId': 1, 'quantity': 6}, {'productId': 2, 'quantity': 3}]
+
+    # Changing the sauce updates the dishes made with it
+    store.update('products', 3, {'recipe': [{'productId': 1, 'quantity': 1}]})
+    assert bom.requirements(store, 4) == [{'productId': 1, 'quantity': 2}, {'productId': 2, 'quantity': 1}]
+
+
+def test_recipe_cycle_is_rejected_and_nothing_is_written(store):
+    store.insert_many('products', [
+        {'id': 1, 'name': 'Dough', 'recipe': [{'productId': 2, 'quantity': 1}]},
+        {'id': 2, 'name': 'Starter', 'recipe': [{'productId': 3, 'quantity': 1}]},
+        {'id': 3, 'name': 'Flour'}
+    ])
+    boms = store.load(bom.BOMS)
+
+    with pytest.raises(bom.RecipeCycleError, match='Recipe cycle'):
+        store.update('products', 2, {'recipe': [{'productId': 1, 'quantity': 1}]})
+    with pytest.raises(bom.RecipeCycleError):
+        store.update('products', 3, {'recipe': [{'productId': 3, 'quantity': 1}]})
+
+    assert store.get('products', 2)['recipe'] == [{'productId': 3, 'quantity': 1}]
+    assert 'recipe' not in store.get('products', 3)
+    assert store.load(bom.BOMS) == boms
@@ -0,0 +1,81 @@
+import changefeed
+from changefeed import ChangeFeed
+
+
+def ids(records):
+    return [r['id'] for r in records]
+
+
+def test_since_returns_writes_and_deletions_after_a_version(store):
+    feed = ChangeFeed(store, 'products')
+    store.insert_many('products', [{'id': 1, 'name': 'A'}, {'id': 2, 'name': 'B'}, {'id': 3, 'name': 'C'}])
+    seen = feed.version()
+    assert seen == 3
+
+    store.update('products', 2, {'price': 5})
+    store.delete('products', 3)
+
+    version, changed, deleted = feed.since(seen)
+    assert version == 5
+    assert ids(changed) == [2] and changed[0]['syncVersion'] == 4
+    assert deleted == [3]
+    assert feed.since(version) == (version, [], [])
+
+
+def test_a_record_deleted_and_recreated_is_not_reported_deleted(store):
+    feed = ChangeFeed(store, 'products')
+    store.insert('products', {'id': 1, 'name': 'A'})
+    seen = feed.version()
+    store.delete('products', 1)
+    store.insert('products', {'id': 1, 'name': 'A again'})
+
+    _, changed, deleted = feed.since(seen)
+    assert ids(changed) == [1] and deleted == []
+
+
+def test_replacing_the_collection_leaves_tombstones_for_dropped_records(store):
+    feed = ChangeFeed(store, 'products')
+    store.insert_many('products', [{'id': 1, 'name': 'A'}, {'id': 2, 'name': 'B'}])
+    seen = feed.version()
+    store.save('products', [{'id': 2, 'name': 'B'}, {'id': 4, 'name': 'D'}])
+
+    version, changed, deleted = feed.since(seen)
+    assert sorted(ids(changed)) == [2, 4] and deleted == [1]
+    assert all(r['syncVersion'] > seen for r in changed)
+
+
+def test_old_tombstones_are_pruned_behind_a_horizon(store, monkeypatch):
+    monkeypatch.setattr(changefeed, 'HORIZON', 10)
+    monkeypatch.setattr(changefeed, 'PRUNE_EVERY', 2)
+    feed = ChangeFeed(store, 'products')
+    store.insert_many('products', [{'id': id, 'name': f'P{id}'} for id in range(1, 5)])
+    store.delete('products', 1)  # Version 5
+    store.update('products', 3, {'quantity': 0})
+    store.delete('products', 2)  # Version 7
+
+    for quantity in range(1, 9):
+        store.update('products', 3, {'quantity': quantity})
+    assert feed.version() == 15
+    assert feed.horizon() == 0 and feed.since(4)[2] == [1, 2]
+
+    store.update('products', 3, {'quantity': 9})  # Version 16 prunes what is 10 versions old
+    assert [t['recordId'] for t in store.load('products_tombstones')] == [2]
+    assert feed.horizon() == 5
+    # Clients at or past the horizon still learn about every deletion they missed
+    assert feed.since(5)[2] == [2]
+
+
+def test_since_looks_versions_up_without_loading_the_collection(store, monkeypatch):
+    feed = ChangeFeed(store, 'products')
+    store.insert_many('products', [{'id': id, 'name': f'P{id}'} for id in range(1, 101)])
+    store.update('products', 50, {'price': 1})
+    store.delete('products', 7)
+
+    load = store.load
+
+    def no_products(name):
+        assert name != 'products'
+        return load(name)
+    monkeypatch.setattr(store, 'load', no_products)
+    version, changed, deleted = feed.since(100)
+    assert version == 102 and ids(changed) == [50] and deleted == [7]
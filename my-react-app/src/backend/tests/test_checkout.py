@@ -0,0 +1,71 @@
+import pytest
+
+from checkout import Checkout
+
+
+def sell(store, *items, total, **data):
+    return Checkout(store).run({'items': [{'productId': p, 'quantity': q, 'price': 0} for p, q in items],
+                                'total': total, **data}, cashier_id=7)
+
+
+def test_simple_product_sale_takes_stock_and_records_profit(store):
+    store.insert('products', {'id': 1, 'name': 'Soda', 'price': 50, 'cost': 30, 'quantity': 10})
+
+    sale = sell(store, (1, 3), total=150)
+
+    assert store.get('products', 1)['quantity'] == 7
+    assert sale['cogs'] == 90 and sale['profit'] == 60 and sale['cashierId'] == 7
+    assert store.load('sales') == [sale]
+    assert store.load('expenses') == []
+
+
+def test_recipe_sale_consumes_nested_ingredients_and_books_expense_only_ones(store):
+    store.insert_many('products', [
+        {'id': 1, 'name': 'Flour', 'quantity': 100, 'cost': 200, 'expenseOnly': True},
+        {'id': 2, 'name': 'Sugar', 'quantity': 20, 'cost': 40},
+        {'id': 3, 'name': 'Dough', 'recipe': [{'productId': 1, 'quantity': 2}]},
+        {'id': 4, 'name': 'Cake', 'price': 300, 'recipe': [{'productId': 3, 'quantity': 2}, {'productId': 2, 'quantity': 1}]}
+    ])
+
+    sale = sell(store, (4, 2), total=600)
+
+    assert store.get('products', 1)['quantity'] == 92  # 2 cakes x 2 dough x 2 flour
+    assert store.get('products', 2)['quantity'] == 18
+    assert 'quantity' not in store.get('products', 4)
+    # Without batches, an ingredient costs its cost spread over the stock on hand
+    assert sale['cogs'] == 8 * 2 + 2 * 2
+    [expense] = store.load('expenses')
+    assert expense['saleId'] == sale['id'] and expense['amount'] == 16 and expense['automatic']
+
+
+def test_offline_batch_skips_invalid_and_repeated_sales(store):
+    store.insert('products', {'id': 1, 'name': 'Soda', 'price': 50, 'cost': 30, 'quantity': 10})
+    queued = {'clientId': 'till-1', 'items': [{'productId': 1, 'quantity': 2}], 'total': 100,
+              'createdAt': '2024-03-01T09:30:00'}
+
+    results = Checkout(store).run_many([queued, queued, {'clientId': 'till-2', 'items': []}], cashier_id=7)
+    assert [r['status'] for r in results] == ['created', 'duplicate', 'error']
+    assert results[1]['saleId'] == results[0]['sale']['id']
+    assert results[0]['sale']['createdAt'] == '2024-03-01T09:30:00'
+
+    again = Checkout(store).run_many([queued], cashier_id=7)
+    assert again[0]['status'] == 'duplicate'
+    assert store.count('sales') == 1 and store.get('products', 1)['quantity'] == 8
+
+
+def test_replaying_old_sales_reads_only_their_partition(store, engine):
+    if engine != 'json':
+        pytest.skip('Only the JSON engine partitions sales')
+    store.insert('products', {'id': 1, 'name': 'Soda', 'price': 50, 'cost': 30, 'quantity': 10})
+    queued = [{'clientId': f'till-{month}', 'items': [{'productId': 1, 'quantity': 1}], 'total': 50,
+               'createdAt': f'2020-{month:02d}-10T09:30:00'} for month in (1, 2, 3)]
+    first = Checkout(store).run_many(queued, cashier_id=7)
+    assert [r['status'] for r in first] == ['created'] * 3
+
+    store.maintain()  # Closes the partitions of 2020, if background maintenance hasn't yet
+    partitions = store._partitions['sales']
+    partitions._closed.clear()
+    again = Checkout(store).run_many([queued[1]], cashier_id=7)
+    assert again == [{'clientId': 'till-2', 'status': 'duplicate', 'saleId': first[1]['sale']['id']}]
+    assert list(partitions._closed) == ['2020-02']
+    assert store.count('sales') == 3 and store.get('products', 1)['quantity'] == 7
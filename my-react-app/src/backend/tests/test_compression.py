@@ -0,0 +1,74 @@
+import gzip
+import zlib
+
+import pytest
+from flask import Flask, jsonify
+
+import compression
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(compression, 'MIN_BYTES', 100)
+    app = Flask(__name__)
+    compression.install(app)
+
+    @app.route('/api/items')
+    def items():
+        response = jsonify([{'id': i, 'name': 'Bread'} for i in range(50)])
+        response.set_etag('items-1')
+        return response
+
+    @app.route('/api/small')
+    def small():
+        return jsonify({'ok': True})
+
+    @app.route('/items')
+    def page():
+        return 'x' * 1000
+
+    return app.test_client()
+
+
+def test_picks_the_encoding_the_client_accepts(client):
+    plain = client.get('/api/items').get_data()
+
+    response = client.get('/api/items', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()) == plain
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+    response = client.get('/api/items', headers={'Accept-Encoding': 'gzip;q=0.5, deflate'})
+    assert response.headers['Content-Encoding'] == 'deflate'
+    assert zlib.decompress(response.get_data()) == plain
+
+    for accept in ('br', 'identity'):
+        response = client.get('/api/items', headers={'Accept-Encoding': accept})
+        assert 'Content-Encoding' not in response.headers and response.get_data() == plain
+
+
+def test_leaves_small_and_non_api_responses_alone(client):
+    for path in ('/api/small', '/items'):
+        response = client.get(path, headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+
+def test_a_compressed_response_has_a_weak_etag(client):
+    assert client.get('/api/items').headers['ETag'] == '"items-1"'
+    response = client.get('/api/items', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['ETag'] == 'W/"items-1"'
+
+
+def test_the_catalog_revalidates_with_a_weak_etag(api, monkeypatch):
+    monkeypatch.setattr(compression, 'MIN_BYTES', 1)
+    client = api.app.test_client()
+    token = client.post('/api/auth/signup', json={'email': 'owner@example.com', 'password': 'secret',
+                                                  'name': 'Owner'}).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}', 'Accept-Encoding': 'gzip'}
+    client.post('/api/products', json={'name': 'Bread', 'quantity': 5}, headers=headers)
+
+    response = client.get('/api/products', headers=headers)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+    assert client.get('/api/products', headers={**headers, 'If-None-Match': etag}).status_code == 304
@@ -0,0 +1,35 @@
+import events
+
+
+def test_old_events_are_trimmed_in_batches(store, monkeypatch):
+    monkeypatch.setattr(events, 'RETAIN', 10)
+    monkeypatch.setattr(events, 'TRIM_EVERY', 4)
+    events.install(store)
+    hub = events.EventHub(store)
+
+    counts = []
+    for id in range(1, 31):
+        store.insert('products', {'id': id, 'name': f'P{id}'})
+        counts.append(store.count(events.EVENTS))
+    assert max(counts) <= 10 + 4 - 1
+    assert counts[-1] >= 10
+    ids = [e['id'] for e in store.load(events.EVENTS)]
+    assert ids == list(range(31 - len(ids), 31))
+
+    # A client that missed trimmed events is told to reload; one that didn't gets them all
+    assert [e['type'] for e in hub.backlog(5)] == ['reset']
+    assert [e['id'] for e in hub.backlog(25)] == [26, 27, 28, 29, 30]
+
+
+def test_product_writes_become_events_for_their_audience(store):
+    events.install(store)
+    store.insert('products', {'id': 1, 'name': 'Flour', 'expenseOnly': True})
+    store.update('products', 1, {'expenseOnly': False})
+    store.delete('products', 1)
+
+    assert [(e['type'], e['audience']) for e in store.load(events.EVENTS)] == [
+        ('product.created', 'admin'),
+        ('product.updated', 'admin'),
+        ('product.created', 'cashier'),
+        ('product.deleted', 'all')
+    ]
@@ -0,0 +1,35 @@
+import json
+import sys
+from datetime import datetime
+
+import export
+import tenants
+from storage import JsonStorage
+
+
+def run(monkeypatch, capsys, *args):
+    monkeypatch.setattr(sys, 'argv', ['export.py', *args])
+    export.main()
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_cli_exports_live_and_archived_partitions(tmp_path, monkeypatch, capsys):
+    data_dir = str(tmp_path)
+    shop = JsonStorage(tenants.directory(data_dir, 1), ['sales'], partition_collections=['sales'], partition_keep=1)
+    line = {'productId': 1, 'quantity': 2, 'price': 5}
+    shop.insert_many('sales', [
+        {'id': 1, 'items': [line], 'total': 10, 'createdAt': '2020-01-05T10:00:00'},
+        {'id': 2, 'items': [line, {**line, 'productId': 2}], 'total': 20, 'createdAt': datetime.now().isoformat()}
+    ])
+    shop.maintain()
+    assert [s['id'] for s in shop.load_archived('sales')] == [1]
+
+    # The data directory defaults to the app's
+    monkeypatch.setattr(tenants, 'DATA_DIR', data_dir)
+    live = run(monkeypatch, capsys, 'sales', '--format', 'jsonl')
+    assert [(row['saleId'], row['productId']) for row in live] == [(2, 1), (2, 2)]
+    assert list(live[0]) == export.SALE_COLUMNS
+
+    everything = run(monkeypatch, capsys, 'sales', '--format', 'jsonl', '--archived', '--data-dir', data_dir)
+    assert [row['saleId'] for row in everything] == [1, 2, 2]
+    assert run(monkeypatch, capsys, 'sales', '--format', 'jsonl', '--archived', '--to', '2020-12-31') == everything[:1]
@@ -0,0 +1,41 @@
+import fifo
+from checkout import Checkout
+
+
+def receive(store, id, quantity, buying_price, created_at):
+    store.insert('batches', {'id': id, 'productId': 1, 'buyingPrice': buying_price, 'quantity': quantity,
+                             'remaining': quantity, 'createdAt': created_at})
+
+
+def sell(store, quantity):
+    return Checkout(store).run({'items': [{'productId': 1, 'quantity': quantity, 'price': 100}],
+                                'total': 100 * quantity}, cashier_id=1)
+
+
+def test_sales_are_costed_from_the_oldest_batches_first(store):
+    store.insert('products', {'id': 1, 'name': 'Rice', 'price': 100, 'cost': 70, 'quantity': 30})
+    receive(store, 2, 10, 60, '2024-02-01T00:00:00')
+    receive(store, 1, 10, 50, '2024-01-01T00:00:00')  # Received earlier, recorded later
+
+    first = sell(store, 12)
+    assert first['cogs'] == 10 * 50 + 2 * 60
+    assert first['items'][0]['batches'] == [{'batchId': 1, 'quantity': 10, 'unitCost': 50},
+                                            {'batchId': 2, 'quantity': 2, 'unitCost': 60}]
+    assert store.get(fifo.QUEUES, 1)['open'] == [['2024-02-01T00:00:00', 2]]
+
+    # Past the last batch, stock costs the product's own cost
+    second = sell(store, 10)
+    assert second['cogs'] == 8 * 60 + 2 * 70
+    assert store.get(fifo.QUEUES, 1) is None
+    assert [b['remaining'] for b in store.load('batches')] == [0, 0]
+
+
+def test_queues_follow_batch_edits_and_deletes(store):
+    receive(store, 1, 5, 50, '2024-01-01T00:00:00')
+    receive(store, 2, 5, 60, '2024-02-01T00:00:00')
+    receive(store, 3, 5, 70, '2024-03-01T00:00:00')
+
+    store.update('batches', 2, {'remaining': 0})
+    store.delete('batches', 1)
+    assert store.get(fifo.QUEUES, 1)['open'] == [['2024-03-01T00:00:00', 3]]
+    assert store.load(fifo.QUEUES) == fifo.build_all(store.load('batches'))
@@ -0,0 +1,91 @@
+import base64
+import hashlib
+import io
+import os
+
+import pytest
+
+import images
+from images import ImageError, ImageStore, ImageTooLarge
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 32  # Only the signature is checked without Pillow
+GIF = b'GIF89a' + b'\x01' * 32
+
+
+def data_url(data, mimetype='image/png'):
+    return f'data:{mimetype};base64,' + base64.b64encode(data).decode()
+
+
+def stored_files(directory):
+    return sorted(name for _, _, names in os.walk(directory) for name in names)
+
+
+@pytest.fixture
+def image_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, 'Image', None)  # Thumbnails are tested on their own
+    return ImageStore(str(tmp_path / 'images'))
+
+
+def test_the_same_bytes_are_stored_once(image_store):
+    digest = image_store.put(PNG)
+    assert digest == hashlib.sha256(PNG).hexdigest()
+    assert image_store.put_data_url(data_url(PNG)) == digest
+    assert image_store.put(GIF) != digest
+    assert stored_files(image_store.directory) == sorted([digest, hashlib.sha256(GIF).hexdigest()])
+
+    assert image_store.find(digest) == (image_store.path(digest), 'image/png')
+    assert image_store.find(digest, size=64) == (image_store.path(digest), 'image/png')  # No thumbnails
+    assert image_store.find('0' * 64) is None and image_store.find('../secret') is None
+
+
+def test_only_small_images_are_accepted(image_store, monkeypatch):
+    with pytest.raises(ImageError):
+        image_store.put(b'<svg></svg>')
+    with pytest.raises(ImageError):
+        image_store.put_data_url('data:image/png;base64,???')
+    monkeypatch.setattr(images, 'MAX_BYTES', 16)
+    with pytest.raises(ImageTooLarge):
+        image_store.put(PNG)
+    with pytest.raises(ImageTooLarge):
+        image_store.put_data_url(data_url(PNG))
+    assert stored_files(image_store.directory) == []
+
+
+def test_product_image_fields(image_store):
+    digest = hashlib.sha256(PNG).hexdigest()
+    assert images.image_changes(image_store, data_url(PNG)) == {'imageHash': digest}
+    assert images.image_changes(image_store, f'http://shop/api/images/{digest}?size=64',
+                                {'image': 'http://cdn/bread.png'}) == {'imageHash': digest, 'image': None}
+    assert images.image_changes(image_store, 'http://cdn/bread.png', {'imageHash': digest}) == \
+        {'image': 'http://cdn/bread.png', 'imageHash': None}
+    assert images.image_changes(image_store, '', {'imageHash': digest}) == {'imageHash': None}
+    assert images.image_changes(image_store, None, {'imageHash': digest}) == {}
+
+
+def test_migrate_moves_inline_images_out_of_products(store, image_store):
+    store.insert_many('products', [{'id': 1, 'name': 'Bread', 'image': data_url(PNG)},
+                                   {'id': 2, 'name': 'Rolls', 'image': data_url(PNG)},
+                                   {'id': 3, 'name': 'Soap', 'image': 'data:image/png;base64,PHN2Zz4='},
+                                   {'id': 4, 'name': 'Salt'}])
+    assert images.migrate(store, image_store) == 2
+    digest = hashlib.sha256(PNG).hexdigest()
+    products = {p['id']: p for p in store.load('products')}
+    assert products[1] == {'id': 1, 'name': 'Bread', 'imageHash': digest}
+    assert products[2]['imageHash'] == digest and 'image' not in products[2]
+    assert products[3]['image'].startswith('data:')  # Not an image; left inline
+    assert stored_files(image_store.directory) == [digest]
+    assert images.migrate(store, image_store) == 0
+
+
+def test_thumbnails_are_written_for_each_size(tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    out = io.BytesIO()
+    Image.new('RGB', (600, 300), 'red').save(out, 'JPEG')
+    image_store = ImageStore(str(tmp_path / 'images'), sizes=(64, 256))
+    digest = image_store.put(out.getvalue())
+
+    for size in (64, 256):
+        with Image.open(image_store.path(digest, size)) as thumb:
+            assert thumb.size == (size, size // 2) and thumb.format == 'JPEG'
+    assert image_store.find(digest, size=100) == (image_store.path(digest, 256), 'image/jpeg')
+    assert image_store.find(digest, size=1000) == (image_store.path(digest), 'image/jpeg')
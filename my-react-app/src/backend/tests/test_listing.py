@@ -0,0 +1,62 @@
+import json
+
+import pytest
+from flask import Flask
+
+import listing
+
+SALES = [{'id': i, 'cashierId': 7 if i % 2 else 8, 'createdAt': f'2025-12-{i:02d}T10:00:00'} for i in range(1, 11)]
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+
+    @app.route('/api/sales')
+    def sales():
+        return listing.list_response(SALES, filters={'cashierId': int})
+
+    return app.test_client()
+
+
+def pages(client, query):
+    """Follows X-Next-Cursor to the end; returns the ids of each page."""
+    ids, cursor = [], None
+    while True:
+        response = client.get(f'/api/sales?{query}' + (f'&cursor={cursor}' if cursor else ''))
+        assert response.status_code == 200
+        ids.append([sale['id'] for sale in response.get_json()])
+        cursor = response.headers.get('X-Next-Cursor')
+        if cursor is None:
+            return ids
+
+
+def test_cursor_walks_every_record_once(client):
+    assert pages(client, 'limit=4') == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+    assert pages(client, 'limit=5') == [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]]
+    assert 'X-Next-Cursor' not in client.get('/api/sales').headers
+    assert len(client.get('/api/sales').get_json()) == 10
+
+
+def test_cursor_skips_past_filtered_records(client):
+    assert pages(client, 'limit=2&cashierId=8') == [[2, 4], [6, 8], [10]]
+    assert pages(client, 'limit=2&cashierId=7&from=2025-12-04&to=2025-12-09') == [[5, 7], [9]]
+
+
+def test_limit_is_capped(client, monkeypatch):
+    monkeypatch.setattr(listing, 'MAX_LIMIT', 3)
+    response = client.get('/api/sales?limit=100')
+    assert [sale['id'] for sale in response.get_json()] == [1, 2, 3]
+    assert response.headers['X-Next-Cursor'] == '3'
+
+
+def test_streams_a_page_as_json_lines(client):
+    response = client.get('/api/sales?format=jsonl&limit=3&cursor=4')
+    assert response.mimetype == listing.NDJSON
+    assert [json.loads(line)['id'] for line in response.get_data(as_text=True).splitlines()] == [5, 6, 7]
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=x', 'cursor=-1', 'cashierId=x'])
+def test_bad_parameters_are_rejected(client, query):
+    response = client.get(f'/api/sales?{query}')
+    assert response.status_code == 400 and 'error' in response.get_json()
@@ -0,0 +1,100 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import mailer
+from smtp_sink import SMTPSink
+from storage import open_storage
+
+
+@pytest.fixture
+def sink(monkeypatch):
+    """An smtp_sink server on a free port, with the mailer pointed at it."""
+    server = SMTPSink(('localhost', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(mailer, 'SMTP_HOST', 'localhost')
+    monkeypatch.setattr(mailer, 'SMTP_PORT', server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    store = open_storage(str(tmp_path), ['emails'], {'emails': ['status']})
+    users = [{'id': id, 'email': f'user{id}@example.com', 'name': f'User {id}'} for id in range(1, 6)]
+    mailer.queue_emails(store, users, 'Hello', 'Your invoice is ready')
+    return store
+
+
+def run_once(worker, smtp=None):
+    """One round of a worker: claim, deliver and record a batch."""
+    emails = worker.claim()
+    if emails:
+        results, smtp = worker.deliver(smtp, emails)
+        worker.record(emails, results)
+    return emails, smtp
+
+
+def make_due(store):
+    with store.transaction() as txn:
+        for email in store.find(mailer.EMAILS, 'status', 'queued'):
+            txn.update(mailer.EMAILS, email['id'], {'nextAttemptAt': datetime.now().isoformat()})
+
+
+def test_batches_go_out_over_one_connection(sink, outbox, monkeypatch):
+    connections = []
+    connect = mailer.Mailer.connect
+    monkeypatch.setattr(mailer.Mailer, 'connect', staticmethod(lambda: connections.append(1) or connect()))
+    worker = mailer.Mailer(outbox, batch=2)
+
+    smtp, batches = None, []
+    while True:
+        emails, smtp = run_once(worker, smtp)
+        if not emails:
+            break
+        batches.append([e['id'] for e in emails])
+    worker.close(smtp)
+
+    assert batches == [[1, 2], [3, 4], [5]]
+    assert len(connections) == 1
+    assert sorted(m['to'][0] for m in sink.messages) == [f'<user{id}@example.com>' for id in range(1, 6)]
+    assert {e['status'] for e in outbox.load(mailer.EMAILS)} == {'sent'}
+    assert all(e['attempts'] == 1 and e['sentAt'] for e in outbox.load(mailer.EMAILS))
+
+
+def test_temporary_failures_are_retried_with_backoff_then_given_up(sink, outbox, monkeypatch):
+    sink.fail_rate = 1.0  # Every message gets a 451
+    monkeypatch.setattr(mailer, 'BACKOFF_SECONDS', 30)
+    monkeypatch.setattr(mailer, 'MAX_ATTEMPTS', 3)
+    worker = mailer.Mailer(outbox)
+
+    delays = []
+    for attempt in range(1, 3):
+        started = datetime.now()
+        assert len(run_once(worker)[0]) == 5
+        email = outbox.get(mailer.EMAILS, 1)
+        assert email['status'] == 'queued' and email['attempts'] == attempt and '451' in email['lastError']
+        delays.append((datetime.fromisoformat(email['nextAttemptAt']) - started).total_seconds())
+        assert worker.claim() == []  # Not due yet
+        make_due(outbox)
+    assert 30 <= delays[0] < 32 and 60 <= delays[1] < 62
+
+    run_once(worker)
+    assert {(e['status'], e['attempts']) for e in outbox.load(mailer.EMAILS)} == {('failed', 3)}
+    assert worker.claim() == [] and sink.messages == []
+
+
+def test_claims_left_by_a_dead_worker_are_taken_again(outbox):
+    worker = mailer.Mailer(outbox, batch=2)
+    assert [e['id'] for e in worker.claim()] == [1, 2]
+    long_ago = (datetime.now() - timedelta(seconds=mailer.CLAIM_TIMEOUT + 60)).isoformat()
+    outbox.update(mailer.EMAILS, 2, {'claimedAt': long_ago})
+
+    # Email 1 is still being sent; email 2's worker is presumed dead
+    assert [e['id'] for e in worker.claim()] == [2, 3]
+    assert [e['id'] for e in worker.claim()] == [4, 5]
+    assert worker.claim() == []
+    assert {e['status'] for e in outbox.load(mailer.EMAILS)} == {'sending'}
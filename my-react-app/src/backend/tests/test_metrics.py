@@ -0,0 +1,47 @@
+import metrics
+
+
+def samples(text):
+    """``{series: value}`` of a Prometheus text exposition."""
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in text.splitlines() if line and not line.startswith('#')}
+
+
+def test_metrics_need_the_token_when_one_is_set(api, monkeypatch):
+    client = api.app.test_client()
+    assert client.get('/metrics').status_code == 200
+
+    monkeypatch.setattr(api, 'METRICS_TOKEN', 's3cret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200 and response.content_type == metrics.CONTENT_TYPE
+
+
+def test_metrics_count_requests_storage_and_records(api):
+    client = api.app.test_client()
+    before = samples(client.get('/metrics').get_data(as_text=True))
+    token = client.post('/api/auth/signup', json={'email': 'owner@example.com', 'password': 'secret',
+                                                  'name': 'Owner'}).get_json()['token']
+    headers = {'Authorization': f'Bearer {token}'}
+    client.post('/api/products', json={'name': 'Bread', 'quantity': 5}, headers=headers)
+    client.post('/api/products', json={'name': 'Milk', 'quantity': 2}, headers=headers)
+    client.get('/api/products', headers=headers)
+    missing = client.delete('/api/products/99', headers=headers).status_code
+
+    after = samples(client.get('/metrics').get_data(as_text=True))
+
+    def added(series):
+        return after.get(series, 0) - before.get(series, 0)
+
+    assert added('pos_http_requests_total{route="/api/products",method="POST",status="201"}') == 2
+    assert added('pos_http_requests_total{route="/api/products",method="GET",status="200"}') == 1
+    assert added('pos_http_request_duration_seconds_count{route="/api/products",method="GET"}') == 1
+    assert added('pos_http_request_duration_seconds_bucket{route="/api/products",method="GET",le="+Inf"}') == 1
+    assert added(f'pos_http_requests_total{{route="/api/products/<int:id>",method="DELETE",status="{missing}"}}') == 1
+    assert added('pos_jwt_verify_duration_seconds_count') == 4
+    assert added('pos_storage_io_bytes_total{collection="products",op="write"}') > 0
+    assert after['pos_collection_records{collection="products"}'] == 2
+    assert after['pos_collection_records{collection="users"}'] == 1
+    assert 'pos_storage_cache_hits_total{collection="users"}' in after
+    assert after['pos_process_start_time_seconds'] == metrics.START_TIME
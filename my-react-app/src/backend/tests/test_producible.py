@@ -0,0 +1,68 @@
+import pytest
+
+import bom
+import producible
+from producible import Producibility
+
+
+def catalog(store):
+    store.insert_many('products', [
+        {'id': 1, 'name': 'Flour', 'quantity': 10},
+        {'id': 2, 'name': 'Sugar', 'quantity': 3},
+        {'id': 3, 'name': 'Yeast', 'quantity': 0},
+        {'id': 4, 'name': 'Cake', 'recipe': [{'productId': 1, 'quantity': 2}, {'productId': 2, 'quantity': 1}]},
+        {'id': 5, 'name': 'Cookie', 'recipe': [{'productId': 1, 'quantity': 4}, {'productId': 9, 'quantity': 1}]},
+        {'id': 6, 'name': 'Bread', 'recipe': [{'productId': 1, 'quantity': 1}, {'productId': 3, 'quantity': 1}]},
+        {'id': 7, 'name': 'Dough', 'recipe': [{'productId': 1, 'quantity': 1}]},
+        {'id': 8, 'name': 'Pie', 'recipe': [{'productId': 7, 'quantity': 4}, {'productId': 2, 'quantity': 1}]}
+    ])
+
+
+def test_units_and_limiting_ingredient_of_every_recipe(store):
+    catalog(store)
+    assert Producibility(store).all() == {
+        4: (3, 'Sugar'),  # 5 by flour, 3 by sugar
+        5: (2, 'Flour'),  # The missing ingredient 9 is ignored
+        6: (0, 'Yeast'),
+        7: (10, 'Flour'),
+        8: (2, 'Flour')  # Nested: 4 dough is 4 flour, so 10 // 4
+    }
+    assert Producibility(store).get(1) == (0, None)
+
+
+def test_matches_the_per_product_calculation(store):
+    catalog(store)
+    products = store.load('products')
+    stock = {p['id']: p.get('quantity') or 0 for p in products}
+    boms = {record['id']: record['requirements'] for record in store.load(bom.BOMS)}
+    for product_id, (units, _) in producible.compute(products, boms).items():
+        lines = [line for line in boms[product_id] if line['productId'] in stock]
+        assert units == min(int(stock[line['productId']] / line['quantity']) for line in lines)
+
+
+def test_a_rejected_recipe_cycle_leaves_the_results_alone(store):
+    catalog(store)
+    producibility = Producibility(store)
+    before = producibility.all()
+    with pytest.raises(bom.RecipeCycleError):
+        store.update('products', 7, {'recipe': [{'productId': 8, 'quantity': 1}]})
+    assert producibility.all() == before
+
+
+def test_results_are_cached_until_the_products_change(store, monkeypatch, tmp_path):
+    catalog(store)
+    calls = []
+    compute = producible.compute
+    monkeypatch.setattr(producible, 'compute', lambda *args: calls.append(1) or compute(*args))
+    producibility = Producibility(store)
+
+    assert producibility.get(4) == (3, 'Sugar')
+    assert producibility.get(8) == (2, 'Flour')
+    assert len(calls) == 1
+
+    store.update('products', 2, {'quantity': 1})
+    assert producibility.get(4) == (1, 'Sugar') and len(calls) == 2
+    # The new recipe's BOM comes with the same write
+    store.update('products', 8, {'recipe': [{'productId': 7, 'quantity': 1}]})
+    assert producibility.get(8) == (10, 'Flour') and len(calls) == 3
+    assert producibility.get(8) == (10, 'Flour') and len(calls) == 3
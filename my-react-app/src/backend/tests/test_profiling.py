@@ -0,0 +1,41 @@
+import pytest
+from flask import Flask
+
+import profiling
+
+HEADERS = {'X-Profile': '1', 'X-Profile-Secret': 'secret'}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'SECRET', 'secret')
+    app = Flask(__name__)
+    app.config['PROFILE_DIR'] = str(tmp_path)
+    profiling.install(app)
+
+    @app.route('/ok')
+    def ok():
+        return 'ok'
+
+    @app.route('/fail')
+    def fail():
+        raise RuntimeError('boom')
+    return app.test_client()
+
+
+def test_one_profile_at_a_time(client, tmp_path):
+    assert profiling.HEADER in client.get('/ok', headers=HEADERS).headers
+    assert [p['route'] for p in profiling.list_profiles(str(tmp_path))] == ['/ok']
+
+    with profiling._active:  # Another request is being profiled
+        response = client.get('/ok', headers=HEADERS)
+    assert response.status_code == 200 and profiling.HEADER not in response.headers
+    assert len(profiling.list_profiles(str(tmp_path))) == 1
+
+
+def test_a_failed_request_releases_the_profiler(client):
+    client.application.config['PROPAGATE_EXCEPTIONS'] = True
+    with pytest.raises(RuntimeError):
+        client.get('/fail', headers=HEADERS)
+    assert not profiling._active.locked()
+    assert profiling.HEADER in client.get('/ok', headers=HEADERS).headers
@@ -0,0 +1,51 @@
+from datetime import date
+
+import pytest
+
+import reminder_schedule
+
+MONDAY = date(2025, 12, 1)
+
+
+@pytest.fixture
+def reminders(store):
+    reminder_schedule.install(store)
+    store.insert_many('reminders', [
+        {'id': 1, 'frequency': 'daily', 'status': 'fulfilled', 'nextDate': '2025-11-28'},
+        {'id': 2, 'frequency': 'weekly', 'status': 'fulfilled', 'nextDate': '2025-11-17T09:00:00'},
+        {'id': 3, 'frequency': 'specific', 'days': ['Wednesday', 'fri'], 'status': 'fulfilled',
+         'nextDate': '2025-11-28'},
+        {'id': 4, 'frequency': 'daily', 'status': 'fulfilled', 'nextDate': '2025-12-05'},
+        {'id': 5, 'frequency': 'daily', 'status': 'pending', 'nextDate': '2025-11-20'},
+        {'id': 6, 'frequency': 'once', 'status': 'fulfilled', 'nextDate': '2025-11-20'}
+    ])
+    return store
+
+
+@pytest.mark.parametrize('batch', [1, 200])
+def test_fulfilled_recurring_reminders_roll_past_today(reminders, batch):
+    assert reminder_schedule.advance_due(reminders, MONDAY, batch=batch) == 3
+    moved = {r['id']: r for r in reminders.load('reminders')}
+    assert moved[1]['nextDate'] == '2025-12-02' and moved[1]['lastFulfilledDate'] == '2025-11-28'
+    assert moved[2]['nextDate'] == '2025-12-08'  # Still on Mondays
+    assert moved[3]['nextDate'] == '2025-12-03'  # The next Wednesday or Friday after today
+    assert all(moved[id]['status'] == 'pending' for id in (1, 2, 3))
+
+    # Not come yet, missed but never fulfilled, or not recurring: left alone
+    assert moved[4]['nextDate'] == '2025-12-05' and moved[4]['status'] == 'fulfilled'
+    assert moved[5]['nextDate'] == '2025-11-20' and moved[5]['status'] == 'pending'
+    assert 'lastFulfilledDate' not in moved[6]
+
+    assert reminder_schedule.advance_due(reminders, MONDAY, batch=batch) == 0
+
+
+def test_due_reads_pending_reminders_from_the_index(reminders):
+    assert [r['id'] for r in reminder_schedule.due(reminders, MONDAY)] == [5]
+    reminder_schedule.advance_due(reminders, MONDAY)
+    assert [r['id'] for r in reminder_schedule.due(reminders, date(2025, 12, 3))] == [5, 1, 3]
+
+    reminders.update('reminders', 5, {'status': 'fulfilled', 'frequency': 'once'})
+    reminders.delete('reminders', 1)
+    assert [r['id'] for r in reminder_schedule.due(reminders, date(2025, 12, 3))] == [3]
+    assert reminder_schedule.due_entries(reminders, '2025-12-31') == [['2025-12-03', 3], ['2025-12-05', 4],
+                                                                      ['2025-12-08', 2]]
@@ -0,0 +1,65 @@
+import pytest
+
+from reports import SalesColumns, parse_bound
+
+SALES = [
+    # Two lines; the discount is spread over them by price * quantity
+    {'id': 1, 'cashierId': 7, 'total': 90, 'createdAt': '2024-03-04T09:15:00',
+     'items': [{'productId': 1, 'quantity': 2, 'price': 30, 'cogs': 20}, {'productId': 2, 'quantity': 1, 'price': 40, 'cogs': 25}]},
+    # From before per-line cogs: the sale's cogs is shared the same way
+    {'id': 2, 'cashierId': 8, 'total': 60, 'cogs': 30, 'createdAt': '2024-03-04T17:40:00',
+     'items': [{'productId': 1, 'quantity': 2, 'price': 30}]},
+    {'id': 3, 'cashierId': 7, 'total': 40, 'createdAt': '2024-03-05T08:00:00',
+     'items': [{'productId': 2, 'quantity': 1, 'price': 40, 'cogs': 25}]},
+]
+
+
+def by_key(rows):
+    return {row['key']: row for row in rows}
+
+
+def test_group_totals_add_up_to_the_period_totals(store):
+    store.insert_many('sales', SALES)
+    columns = SalesColumns(store)
+
+    for group_by in ('hour', 'day', 'product', 'cashier'):
+        rows, totals = columns.report(group_by)
+        assert totals == {'quantity': 6, 'total': 190, 'cogs': 100, 'profit': 90, 'lines': 4, 'sales': 3}
+        assert sum(row['total'] for row in rows) == pytest.approx(190)
+        assert sum(row['cogs'] for row in rows) == pytest.approx(100)
+
+    products = by_key(columns.report('product')[0])
+    assert products[1]['total'] == pytest.approx(54 + 60) and products[1]['sales'] == 2
+    assert products[2]['total'] == pytest.approx(36 + 40) and products[2]['quantity'] == 2
+    assert list(by_key(columns.report('day')[0])) == ['2024-03-04', '2024-03-05']
+    assert by_key(columns.report('cashier')[0])[8]['profit'] == 30
+
+
+def test_period_bounds_and_new_sales(store):
+    store.insert_many('sales', SALES)
+    columns = SalesColumns(store)
+
+    rows, totals = columns.report('hour', parse_bound('2024-03-04T17:00'), parse_bound('2024-03-04', end=True))
+    assert [row['key'] for row in rows] == ['2024-03-04T17:00:00'] and totals['sales'] == 1
+
+    store.insert('sales', {'id': 4, 'cashierId': 7, 'total': 5, 'createdAt': '2024-03-05T09:00:00',
+                           'items': [{'productId': 3, 'quantity': 1, 'price': 5, 'cogs': 1}]})
+    rows, totals = columns.report('day', parse_bound('2024-03-05'))
+    assert totals['sales'] == 2 and totals['total'] == 45
+
+
+def test_updated_deleted_and_replaced_sales_are_picked_up(store):
+    store.insert_many('sales', SALES)
+    columns = SalesColumns(store)
+    other_worker = SalesColumns(store)
+    assert columns.report('day')[1]['total'] == 190 and other_worker.report('day')[1]['total'] == 190
+
+    store.update('sales', 3, {'total': 20})
+    store.delete('sales', 2)
+    for each in (columns, other_worker):
+        rows, totals = each.report('product')
+        assert totals['total'] == 110 and totals['sales'] == 2
+        assert by_key(rows)[1]['total'] == pytest.approx(54)
+
+    store.save('sales', SALES[:1])
+    assert other_worker.report('cashier')[1]['sales'] == 1
@@ -0,0 +1,271 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import storage
+import tenants
+from storage import UNDATED, AppendLog, JsonStorage, PartitionedLog, SqliteStorage, open_storage, write_temp_json
+
+
+def puts(*ids):
+    return [{'op': 'put', 'record': {'id': id, 'total': id * 10}} for id in ids]
+
+
+def log_lines(log):
+    with open(log.log_path, 'rb') as f:
+        return f.read().split(b'\n')
+
+
+def test_torn_log_line_is_ignored_and_cut_before_the_next_append(tmp_path):
+    log = AppendLog(str(tmp_path / 'sales.json'))
+    log.append(puts(1, 2, 3))
+    size = os.path.getsize(log.log_path)
+    with open(log.log_path, 'r+b') as f:
+        f.truncate(size - 10)  # A crash partway through writing the last line
+
+    reopened = AppendLog(str(tmp_path / 'sales.json'))
+    assert [r['id'] for r in reopened.records()] == [1, 2]
+
+    reopened.append(puts(4))
+    lines = log_lines(reopened)
+    assert lines[-1] == b''
+    assert [json.loads(line)['record']['id'] for line in lines[:-1]] == [1, 2, 4]
+    assert [r['id'] for r in AppendLog(str(tmp_path / 'sales.json')).records()] == [1, 2, 4]
+
+
+def test_delete_and_update_replay_from_the_log(tmp_path):
+    log = AppendLog(str(tmp_path / 'sales.json'))
+    log.append(puts(1, 2, 3))
+    log.append([{'op': 'delete', 'id': 2}, {'op': 'put', 'record': {'id': 3, 'total': 0}}])
+    reopened = AppendLog(str(tmp_path / 'sales.json'))
+    assert reopened.records() == [{'id': 1, 'total': 10}, {'id': 3, 'total': 0}]
+
+
+def test_commit_journal_left_by_a_crash_is_rolled_forward(tmp_path):
+    data_dir = str(tmp_path)
+    store = JsonStorage(data_dir, ['products', 'sales'], log_collections=['sales'])
+    store.insert('products', {'id': 1, 'name': 'Bread', 'quantity': 5})
+    store.insert('sales', {'id': 1, 'total': 10})
+
+    # A writer that crashed after recording its commit, before applying any of it
+    products = os.path.join(data_dir, 'products.json')
+    tmp = write_temp_json(products, [{'id': 1, 'name': 'Bread', 'quantity': 3}])
+    journal = {
+        'renames': [(os.path.basename(tmp), 'products.json')],
+        'logs': {'sales': [{'op': 'put', 'record': {'id': 2, 'total': 20}}]}
+    }
+    with open(os.path.join(data_dir, '.commit.json'), 'w') as f:
+        json.dump(journal, f)
+
+    reopened = JsonStorage(data_dir, ['products', 'sales'], log_collections=['sales'])
+    assert not os.path.exists(os.path.join(data_dir, '.commit.json'))
+    assert not os.path.exists(tmp)
+    assert reopened.get('products', 1)['quantity'] == 3
+    assert [s['id'] for s in reopened.load('sales')] == [1, 2]
+
+
+def test_torn_journal_is_discarded(tmp_path):
+    data_dir = str(tmp_path)
+    JsonStorage(data_dir, ['products']).insert('products', {'id': 1, 'name': 'Bread'})
+    with open(os.path.join(data_dir, '.commit.json'), 'w') as f:
+        f.write('{"renames": [["products.js')
+
+    reopened = JsonStorage(data_dir, ['products'])
+    assert not os.path.exists(os.path.join(data_dir, '.commit.json'))
+    assert reopened.load('products') == [{'id': 1, 'name': 'Bread'}]
+
+
+def test_closed_partitions_close_their_log_files(tmp_path):
+    directory = str(tmp_path / 'sales')
+    partitions = PartitionedLog(directory)
+    other_worker = PartitionedLog(directory)
+    partitions.append(puts(1, 2))  # Undated, so always open
+    partitions.append([{'op': 'put', 'record': {'id': 3, 'createdAt': '2020-01-05T10:00:00'}}])
+    assert [r['id'] for r in other_worker.records()] == [3, 1, 2]
+    log, others = partitions._open['2020-01'], other_worker._open['2020-01']
+
+    assert partitions.maintain() == (['2020-01'], [])
+    assert log.closed and '2020-01' not in partitions._open
+    # The other worker notices on its next read, closes its copy and reads the gzip file
+    assert [r['id'] for r in other_worker.records()] == [3, 1, 2]
+    assert others.closed
+    # A reader that picked up the log before it was closed gets the closed partition
+    assert other_worker._read('2020-01', False, AppendLog.count, lambda records, index: len(records)) == 1
+
+    # Replacing the collection drops the partitions it no longer has
+    undated = partitions._open[UNDATED]
+    partitions.replace([{'id': 9, 'createdAt': '2020-02-01T00:00:00'}])
+    assert undated.closed and partitions._open == {}
+    assert [r['id'] for r in other_worker.records()] == [9]
+    assert other_worker._open == {}
+
+
+def test_a_run_of_deletes_then_a_put_of_the_same_id(tmp_path):
+    log = AppendLog(str(tmp_path / 'events.json'), fields=('type',))
+    log.append(puts(1, 2, 3, 4))
+    log.append([{'op': 'delete', 'id': 1}, {'op': 'delete', 'id': 2}, {'op': 'delete', 'id': 9},
+                {'op': 'put', 'record': {'id': 2, 'total': 0}}, {'op': 'delete', 'id': 3}])
+    expected = [{'id': 4, 'total': 40}, {'id': 2, 'total': 0}]
+    assert log.records() == expected and log.get(2) == {'id': 2, 'total': 0} and log.get(3) is None
+    assert AppendLog(str(tmp_path / 'events.json')).records() == expected
+
+
+def test_ids_of_archived_partitions_are_not_reused(tmp_path):
+    data_dir = str(tmp_path)
+    store = JsonStorage(data_dir, ['sales'], partition_collections=['sales'], partition_keep=1)
+    store.insert_many('sales', [{'id': 1, 'createdAt': '2020-01-05T10:00:00'},
+                                {'id': 2, 'createdAt': '2020-02-05T10:00:00'}])
+
+    store.maintain()  # If the maintenance a new partition schedules hasn't run yet
+    assert store.load('sales') == [] and store.next_id('sales') == 3
+    store.insert('sales', {'id': store.next_id('sales'), 'total': 5})
+    # Survives a restart, and archiving again keeps the highest id seen
+    reopened = JsonStorage(data_dir, ['sales'], partition_collections=['sales'], partition_keep=1)
+    assert reopened.next_id('sales') == 4
+    assert [s['id'] for s in reopened.load_archived('sales')] == [1, 2]
+
+
+def test_inserts_updates_and_deletes_round_trip(store, tmp_path):
+    store.insert_many('sales', [{'id': 1, 'total': 10, 'cashierId': 7, 'createdAt': '2020-01-05T10:00:00'},
+                                {'id': 2, 'total': 20, 'cashierId': 8},
+                                {'id': 3, 'total': 30, 'cashierId': 7}])
+    store.update('sales', 1, {'total': 15})
+    store.delete('sales', 2)
+    store.insert('sales', {'id': store.next_id('sales'), 'total': 5, 'cashierId': 8})
+
+    expected = [{'id': 1, 'total': 15, 'cashierId': 7, 'createdAt': '2020-01-05T10:00:00'},
+                {'id': 3, 'total': 30, 'cashierId': 7},
+                {'id': 4, 'total': 5, 'cashierId': 8}]
+    for reader in (store, tenants.open_shop_storage(str(tmp_path))):
+        assert sorted(reader.load('sales'), key=lambda s: s['id']) == expected
+        assert reader.get('sales', 1) == expected[0] and reader.get('sales', 2) is None
+        assert sorted(s['id'] for s in reader.find('sales', 'cashierId', 7)) == [1, 3]
+        assert [s['id'] for s in reader.find('sales', 'cashierId', 8)] == [4]
+        assert reader.count('sales') == 3 and reader.next_id('sales') == 5
+
+
+def test_a_failing_hook_rolls_the_transaction_back(store, tmp_path):
+    store.insert('products', {'id': 1, 'name': 'Soda', 'quantity': 10})
+
+    def fail_on_sales(txn):
+        if 'sales' in txn.changes:
+            raise RuntimeError('hook failed')
+    store.add_hook(fail_on_sales)
+
+    with pytest.raises(RuntimeError):
+        with store.transaction() as txn:
+            txn.update('products', 1, {'quantity': 9})
+            txn.insert('sales', {'id': 1, 'total': 5})
+    for reader in (store, tenants.open_shop_storage(str(tmp_path))):
+        assert reader.get('products', 1)['quantity'] == 10 and reader.load('sales') == []
+
+    store.update('products', 1, {'quantity': 8})
+    assert store.get('products', 1)['quantity'] == 8
+
+
+def test_a_write_through_another_connection_invalidates_the_cache(store, tmp_path):
+    other = tenants.open_shop_storage(str(tmp_path))  # Another worker on the same shop
+    store.insert('products', {'id': 1, 'name': 'Soda'})
+    assert other.load('products') == [{'id': 1, 'name': 'Soda'}]
+    version = other.version('products')
+    assert other.version('products') == version and other.load('products') == [{'id': 1, 'name': 'Soda'}]
+
+    store.update('products', 1, {'name': 'Cola'})
+    assert other.version('products') != version
+    assert other.load('products') == [{'id': 1, 'name': 'Cola'}]
+    assert other.get('products', 1)['name'] == 'Cola'
+
+
+def test_import_copies_a_json_data_dir_into_sqlite(tmp_path, monkeypatch, capsys):
+    data_dir = str(tmp_path)
+    source = open_storage(data_dir, ['products', 'sales', 'expenses'])
+    source.insert_many('sales', [{'id': 1, 'total': 10, 'createdAt': '2020-01-05T10:00:00'}, {'id': 2, 'total': 20}])
+    source.insert('products', {'id': 1, 'name': 'Soda'})
+
+    monkeypatch.setattr(sys, 'argv', ['storage.py', 'import', '--data-dir', data_dir])
+    storage.main()
+    assert 'Imported 3 records' in capsys.readouterr().out
+
+    imported = SqliteStorage(os.path.join(data_dir, 'pos.sqlite3'), ['products', 'sales', 'expenses'])
+    for name in ('products', 'sales', 'expenses'):
+        assert imported.load(name) == source.load(name)
+    assert imported.next_id('sales') == 3
+
+
+def test_waiting_for_a_file_lock_under_gevent_lets_other_greenlets_run(tmp_path, monkeypatch):
+    gevent = pytest.importorskip('gevent')
+    fcntl = pytest.importorskip('fcntl')
+    monkeypatch.setattr(storage, '_gevent_patched', lambda: True)
+    log = AppendLog(str(tmp_path / 'sales.json'))
+    other_worker = open(log.log_path, 'a+b')
+    fcntl.flock(other_worker.fileno(), fcntl.LOCK_EX)
+    released = threading.Event()
+
+    def release():
+        fcntl.flock(other_worker.fileno(), fcntl.LOCK_UN)
+        released.set()
+    threading.Timer(0.2, release).start()
+
+    ticks = []
+
+    def tick():
+        while not released.is_set():
+            ticks.append(time.monotonic())
+            gevent.sleep(0.01)
+
+    gevent.joinall([gevent.spawn(log.append, puts(1)), gevent.spawn(tick)], timeout=5)
+    assert released.is_set() and len(ticks) > 5  # Ticked while the append waited
+    assert [r['id'] for r in log.records()] == [1]
+    other_worker.close()
+
+
+def test_cache_counts_hits_and_misses_per_collection(store, tmp_path):
+    def stats():
+        counts = store.cache_stats().get('products', {'hits': 0, 'misses': 0})
+        return counts['hits'], counts['misses']
+
+    store.insert('products', {'id': 1, 'name': 'Soda'})
+    store.load('products')
+    hits, misses = stats()
+    store.load('products')
+    store.load('products')
+    assert stats() == (hits + 2, misses)
+
+    # Only a write, here by another worker, costs a reload
+    tenants.open_shop_storage(str(tmp_path)).update('products', 1, {'name': 'Cola'})
+    assert store.load('products') == [{'id': 1, 'name': 'Cola'}]
+    assert stats() == (hits + 2, misses + 1)
+    store.load('products')
+    assert stats() == (hits + 3, misses + 1)
+
+
+def test_indexes_follow_updates_and_deletes(store, tmp_path):
+    store.insert_many('sales', [{'id': 1, 'total': 10, 'cashierId': 7, 'clientId': 'till-a'},
+                                {'id': 2, 'total': 20, 'cashierId': 7, 'clientId': 'till-b'},
+                                {'id': 3, 'total': 30, 'cashierId': 8}])
+    store.insert_many('credit_requests', [{'id': 1, 'status': 'pending'}, {'id': 2, 'status': 'pending'}])
+    for reader in (store, tenants.open_shop_storage(str(tmp_path))):
+        assert sorted(s['id'] for s in reader.find('sales', 'cashierId', 7)) == [1, 2]
+        assert [s['id'] for s in reader.find('credit_requests', 'status', 'pending')] == [1, 2]
+
+    store.update('sales', 2, {'cashierId': 8, 'clientId': 'till-c'})
+    store.delete('sales', 1)
+    store.update('credit_requests', 1, {'status': 'approved'})
+    store.delete('credit_requests', 2)
+    store.insert('credit_requests', {'id': 3, 'status': 'pending'})
+
+    other = tenants.open_shop_storage(str(tmp_path))
+    other.update('sales', 3, {'cashierId': 9})
+    for reader in (store, other):
+        assert reader.find('sales', 'cashierId', 7) == []
+        assert [s['id'] for s in reader.find('sales', 'cashierId', 8)] == [2]
+        assert [s['id'] for s in reader.find('sales', 'cashierId', 9)] == [3]
+        assert reader.find('sales', 'clientId', 'till-a') == reader.find('sales', 'clientId', 'till-b') == []
+        assert [s['id'] for s in reader.find('sales', 'clientId', 'till-c')] == [2]
+        assert [r['id'] for r in reader.find('credit_requests', 'status', 'approved')] == [1]
+        assert [r['id'] for r in reader.find('credit_requests', 'status', 'pending')] == [3]
+        assert reader.count('sales') == 2 and reader.get('sales', 1) is None
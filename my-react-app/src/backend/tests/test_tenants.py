@@ -0,0 +1,99 @@
+import images
+import tenants
+from storage import open_storage
+
+
+def signup(client, email, **data):
+    response = client.post('/api/auth/signup', json={'email': email, 'password': 'secret', 'name': email, **data})
+    return response.status_code, response.get_json()
+
+
+def auth(body):
+    return {'Authorization': f"Bearer {body['token']}"}
+
+
+def test_signup_joins_the_shop_unless_a_new_one_is_asked_for(api):
+    client = api.app.test_client()
+    status, first = signup(client, 'owner@example.com')
+    assert status == 200
+    assert first['user']['role'] == 'admin' and first['user']['active'] and first['user']['tenantId'] == 1
+
+    # Later signups join the shop as before shops had ids: inactive cashiers
+    status, cashier = signup(client, 'cashier@example.com')
+    assert status == 200
+    assert cashier['user']['role'] == 'cashier' and not cashier['user']['active']
+    assert cashier['user']['tenantId'] == 1 and cashier['user']['plan'] is None
+
+    status, other = signup(client, 'other@example.com', createShop=True, shopName='Corner Shop')
+    assert status == 200 and other['user']['role'] == 'admin' and other['user']['tenantId'] == 2
+    assert api.accounts.get('tenants', 2)['name'] == 'Corner Shop'
+
+    # With two shops, a signup has to say which one
+    assert signup(client, 'lost@example.com') == (400, {'error': 'tenantId or createShop is required'})
+    assert signup(client, 'lost@example.com', tenantId=9) == (404, {'error': 'Shop not found'})
+    status, joined = signup(client, 'lost@example.com', tenantId=2)
+    assert status == 200 and joined['user']['role'] == 'cashier' and joined['user']['tenantId'] == 2
+
+
+def test_shops_only_see_their_own_data(api):
+    client = api.app.test_client()
+    first = auth(signup(client, 'first@example.com')[1])
+    second = auth(signup(client, 'second@example.com', createShop=True)[1])
+
+    bread = client.post('/api/products', json={'name': 'Bread', 'quantity': 5}, headers=first).get_json()
+    soap = client.post('/api/products', json={'name': 'Soap', 'quantity': 3}, headers=second).get_json()
+    assert bread['id'] == soap['id'] == 1  # Each shop numbers its own records
+
+    assert [p['name'] for p in client.get('/api/products', headers=first).get_json()] == ['Bread']
+    assert [p['name'] for p in client.get('/api/products', headers=second).get_json()] == ['Soap']
+    client.put('/api/products/1', json={'quantity': 0}, headers=second)
+    assert client.get('/api/products', headers=first).get_json()[0]['quantity'] == 5
+
+    assert client.post('/api/sales', json={'items': [{'productId': 1, 'quantity': 2, 'price': 10}], 'total': 20},
+                       headers=first).status_code == 201
+    assert len(client.get('/api/sales', headers=first).get_json()) == 1
+    assert client.get('/api/sales', headers=second).get_json() == []
+
+
+def test_main_admin_routes_are_for_the_configured_emails_only(api):
+    client = api.app.test_client()
+    owner = signup(client, 'owner@example.com')[1]
+    admin = signup(client, 'admin@example.com', createShop=True)[1]
+
+    assert client.get('/api/main-admin/users').status_code == 401
+    # A shop's own admin is not a main admin
+    response = client.get('/api/main-admin/tenants', headers=auth(admin))
+    assert response.status_code == 403 and response.get_json() == {'error': 'Main admin access required'}
+    response = client.get('/api/main-admin/tenants', headers=auth(owner))
+    assert response.status_code == 200 and [t['id'] for t in response.get_json()] == [1, 2]
+
+    assert client.post(f"/api/main-admin/users/{owner['user']['id']}/lock", json={'locked': True},
+                       headers=auth(admin)).status_code == 403
+    # Locking the main admin takes effect at once, without a new token
+    api.accounts.update('users', owner['user']['id'], {'locked': True})
+    assert client.get('/api/main-admin/users', headers=auth(owner)).status_code == 403
+
+
+def test_least_recently_used_idle_shops_are_closed(tmp_path):
+    data_dir = str(tmp_path)
+    accounts = open_storage(data_dir, ['tenants'])
+    accounts.insert_many('tenants', [{'id': 1}, {'id': 2}, {'id': 3}])
+    shops = tenants.Tenants(accounts, data_dir, images.ImageStore(str(tmp_path / 'images')), max_open=2)
+
+    first = shops.get(1)
+    shops.release(first)
+    second = shops.get(2)
+    third = shops.get(3)  # Over the cap: the first shop is idle, so it goes
+    assert list(shops._open) == [2, 3]
+    assert first.store._lock_file.closed and not first.scheduler._thread.is_alive()
+
+    # Shops in use stay open past the cap until they are released
+    again = shops.get(1)
+    assert again is not first and list(shops._open) == [2, 3, 1]
+    shops.release(third)
+    assert list(shops._open) == [2, 1]
+    with shops.stores() as stores:
+        assert stores == [second.store, again.store]
+    assert second.users == again.users == 1
+    assert [record['id'] for record, _ in shops.map(lambda tenant: tenant.store.count('sales'))] == [1, 2, 3]
+    assert len(shops._open) == 2
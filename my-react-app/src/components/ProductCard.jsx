@@ -1,11 +1,12 @@
 import { ShoppingCart, Package, Tag } from 'lucide-react';
 import DiscountSelector from './DiscountSelector';
+import { productImage } from '../utils/images';
 
 export default function ProductCard({ product, onAddToCart, onRequestCredit, showDiscounts = false }) {
   return (
     <div className="bg-white rounded-xl shadow-lg overflow-hidden hover:shadow-2xl transition transform hover:-translate-y-1">
-      {product.image ? (
-        <img src={product.image} alt={product.name} className="w-full h-64 object-contain bg-gray-50" />
+      {productImage(product) ? (
+        <img src={productImage(product, 256)} alt={product.name} loading="lazy" className="w-full h-64 object-contain bg-gray-50" />
       ) : (
         <div className="w-full h-64 bg-gradient-to-br from-blue-400 to-purple-500 flex items-center justify-center">
           <Package size={64} className="text-white" />
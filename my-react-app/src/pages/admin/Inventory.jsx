@@ -1,5 +1,6 @@
 import { useState, useEffect } from 'react';
 import { products as productsApi } from '../../services/api';
+import { productImage } from '../../utils/images';
 import { Plus, Search, Edit2, Trash2, ChevronDown, ChevronUp, AlertTriangle } from 'lucide-react';
 
 export default function Inventory() {
@@ -322,9 +323,10 @@ export default function Inventory() {
                     <tr key={product.id} className="border-t border-gray-100 hover:bg-gray-50 transition-colors">
 
                       <td className="px-4 py-3">
-                        {product.image ? (
+                        {productImage(product) ? (
                           <img 
-                            src={product.image} 
+                            src={productImage(product, 64)} 
+                            loading="lazy"
                             alt={product.name}
                             className="w-12 h-12 object-cover rounded-lg"
                             onError={(e) => {
@@ -333,7 +335,7 @@ export default function Inventory() {
                             }}
                           />
                         ) : null}
-                        <div className="w-12 h-12 bg-gray-200 rounded-lg flex items-center justify-center" style={{ display: product.image ? 'none' : 'flex' }}>
+                        <div className="w-12 h-12 bg-gray-200 rounded-lg flex items-center justify-center" style={{ display: productImage(product) ? 'none' : 'flex' }}>
                           <span className="text-xs text-gray-400">No Image</span>
                         </div>
                       </td>
@@ -627,8 +629,8 @@ export default function Inventory() {
                     }}
                   />
                 </div>
-                {editProduct.image && (
-                  <img src={editProduct.image} alt="Preview" className="w-20 h-20 object-cover rounded" />
+                {productImage(editProduct) && (
+                  <img src={productImage(editProduct, 256)} alt="Preview" className="w-20 h-20 object-cover rounded" />
                 )}
               </div>
               <div className="grid grid-cols-2 gap-4">
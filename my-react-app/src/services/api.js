@@ -5,7 +5,7 @@ import { saveData, loadData, getDataWithSync, refreshData, initializeStorage } f
 const API_URL = import.meta.env.PROD ? '/api' : 'http://localhost:5002/api';
 
 // Force production URL for deployment fix
-const BASE_API_URL = window.location.hostname === 'localhost' ? 'http://localhost:5002/api' : '/api';
+export const BASE_API_URL = window.location.hostname === 'localhost' ? 'http://localhost:5002/api' : '/api';
 
 const getToken = () => localStorage.getItem('token');
 
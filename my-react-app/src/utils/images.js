@@ -0,0 +1,13 @@
+// Product image URLs. Uploaded images live on the backend under their
+// content hash (product.imageHash); older or external ones are plain URLs.
+
+import { BASE_API_URL } from '../services/api';
+
+// URL of a product's image, or of its thumbnail closest to `size` pixels
+export const productImage = (product, size) => {
+  if (product?.image && product.image.startsWith('data:')) return product.image;
+  if (product?.imageHash) {
+    return `${BASE_API_URL}/images/${product.imageHash}${size ? `?size=${size}` : ''}`;
+  }
+  return product?.image || '';
+};